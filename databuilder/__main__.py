@@ -38,6 +38,16 @@ def main(args=None):
             backend_id=os.environ.get("OPENSAFELY_BACKEND"),
             dummy_data_file=options.dummy_data_file,
             temporary_database=os.environ.get("TEMP_DATABASE_NAME"),
+            population_first=options.population_first,
+            setup_connections=options.setup_connections,
+            shared_cache=options.shared_cache,
+            sample_percent=options.sample_percent,
+            shards=options.shards,
+            download_connections=options.download_connections,
+            incremental=options.incremental,
+            resumable=options.resumable,
+            vectorise_index_dates=options.vectorise_index_dates,
+            jobs=options.jobs,
         )
     elif options.which == "validate_cohort":
         run_cohort_action(
@@ -83,7 +93,11 @@ def build_parser():
     )
     generate_cohort_parser.add_argument(
         "--output",
-        help="Path and filename (or pattern) of the file(s) where the output will be written",
+        help=(
+            "Path and filename (or pattern) of the file(s) where the output will be "
+            "written, as CSV or, for files ending .parquet, .arrow or .feather, in "
+            "that format with a typed column for each variable"
+        ),
         type=Path,
     )
     generate_cohort_parser.add_argument(
@@ -91,6 +105,109 @@ def build_parser():
         help="Provide dummy data from a file to be validated and used as output",
         type=Path,
     )
+    generate_cohort_parser.add_argument(
+        "--population-first",
+        help=(
+            "Find the patients in the population before evaluating any other "
+            "variables, and only evaluate them for those patients. This is faster "
+            "when the population is a small fraction of all patients."
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--vectorise-index-dates",
+        help=(
+            "Extract all the dates in the study's index_date_range in a single pass "
+            "over the data, rather than one date at a time. Requires a study "
+            "definition which sets parameterise_index_date. If the output filename "
+            "has no '*' pattern then a single file is written, with an index_date "
+            "column."
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--setup-connections",
+        help=(
+            "The number of database connections to use at once while preparing the "
+            "results. Currently only backends which use MSSQL make use of this, and "
+            "only with a temporary database (TEMP_DATABASE_NAME) to hold intermediate "
+            "tables."
+        ),
+        type=positive_int,
+        default=1,
+    )
+    generate_cohort_parser.add_argument(
+        "--shared-cache",
+        help=(
+            "Keep intermediate results in the temporary database (TEMP_DATABASE_NAME) "
+            "for other studies to reuse, and reuse any which they have left there. "
+            "Currently only backends which use MSSQL support this. Results are only "
+            "matched by the queries which produced them, so after the data in the "
+            "database is refreshed stale results may still be reused until they're "
+            "evicted from the cache, at most 7 days after they were created."
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--sample-percent",
+        help=(
+            "Only extract a sample of roughly this percentage of patients, for "
+            "quicker results while developing a study. The same patients are sampled "
+            "every time."
+        ),
+        type=percentage,
+    )
+    generate_cohort_parser.add_argument(
+        "--download-connections",
+        help=(
+            "The number of database connections to use at once while downloading "
+            "the results. Currently only backends which use MSSQL make use of this, "
+            "and only with a temporary database (TEMP_DATABASE_NAME) to hold the "
+            "results."
+        ),
+        type=positive_int,
+        default=1,
+    )
+    generate_cohort_parser.add_argument(
+        "--shards",
+        help=(
+            "Split the patients into this many groups by patient ID and extract each "
+            "group in turn, so that the database need only hold the intermediate "
+            "results for one group at a time"
+        ),
+        type=positive_int,
+        default=1,
+    )
+    generate_cohort_parser.add_argument(
+        "--incremental",
+        help=(
+            "Write a manifest alongside the output describing how each column was "
+            "defined, and on later runs only extract those columns whose definitions "
+            "have changed, reusing the rest from the existing output. This assumes "
+            "the data in the database hasn't changed in between."
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--resumable",
+        help=(
+            "Record our progress alongside the output as we write it so that, if "
+            "the extraction fails part way through, the next run can carry on from "
+            "where it stopped rather than downloading everything again. Backends "
+            "which use MSSQL with a temporary database (TEMP_DATABASE_NAME) also "
+            "keep the intermediate tables there for the next run to reuse."
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--jobs",
+        help=(
+            "The number of index dates in the study's index_date_range to extract "
+            "concurrently, each using its own database connection"
+        ),
+        type=positive_int,
+        default=1,
+    )
 
     validate_cohort_parser = subparsers.add_parser(
         "validate_cohort",
@@ -173,5 +290,25 @@ def existing_python_file(value):
     return path
 
 
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not an integer")
+    if number < 1:
+        raise ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def percentage(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not a number")
+    if not 0 < number <= 100:
+        raise ArgumentTypeError(f"{value} is not a percentage between 0 and 100")
+    return number
+
+
 if __name__ == "__main__":
     main()
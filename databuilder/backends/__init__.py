@@ -1,7 +1,14 @@
 # All backends need to be imported here so they get registered
 from .base import BACKENDS
 from .databricks import DatabricksBackend
+from .duckdb import DuckDBBackend
 from .graphnet import GraphnetBackend
 from .tpp import TPPBackend
 
-__all__ = ("BACKENDS", "DatabricksBackend", "TPPBackend", "GraphnetBackend")
+__all__ = (
+    "BACKENDS",
+    "DatabricksBackend",
+    "DuckDBBackend",
+    "TPPBackend",
+    "GraphnetBackend",
+)
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import sqlalchemy
 
-from ..query_engines.base_sql import BaseSQLQueryEngine
+from ..query_engines.base import BaseQueryEngine
 from ..sqlalchemy_types import TYPES_BY_NAME
 
 # Mutable global for storing registered backends
@@ -15,7 +15,7 @@ def register_backend(backend_class):
 
 class BaseBackend:
     backend_id: str
-    query_engine_class: type[BaseSQLQueryEngine]
+    query_engine_class: type[BaseQueryEngine]
     patient_join_column: str
 
     tables = None
@@ -70,18 +70,19 @@ class BaseBackend:
             if isinstance(value, SQLTable):
                 cls.validate_contract(name, value)
 
-    def get_table_expression(self, table_name):
+    def get_table_expression(self, table_name, columns=None):
         """
         Gets SQL expression for a table
         Args:
             table_name: Name of Table
+            columns: Names of the columns required, or None for all columns
         Returns:
             A SQL subquery
         Raises:
             ValueError: If unknown table passed in
         """
         table = self.tables[table_name]
-        return table.get_query().alias(table_name)
+        return table.get_query(columns).alias(table_name)
 
     def get_table_implementing(self, contract):
         """Return table implementing given contract."""
@@ -95,11 +96,22 @@ class SQLTable:
     def learn_patient_join(self, source):
         raise NotImplementedError()
 
-    def _make_columns(self):
+    def _make_columns(self, names=None):
         return [
-            self._make_column(name, column) for name, column in self.columns.items()
+            self._make_column(name, column)
+            for name, column in self._get_columns(names).items()
         ]
 
+    def _get_columns(self, names=None):
+        """
+        Return the declared columns restricted to just those in `names` (if supplied),
+        always including `patient_id`
+        """
+        if names is None:
+            return self.columns
+        names = set(names) | {"patient_id"}
+        return {name: column for name, column in self.columns.items() if name in names}
+
     def _make_column(self, name, column):
         source = column.source or name
         type_ = TYPES_BY_NAME[column.type].value
@@ -120,8 +132,8 @@ class MappedTable(SQLTable):
         if "patient_id" not in self.columns:
             self.columns["patient_id"] = Column("integer", source)
 
-    def get_query(self):
-        columns = self._make_columns()
+    def get_query(self, columns=None):
+        columns = self._make_columns(columns)
         query = sqlalchemy.select(columns).select_from(
             sqlalchemy.table(self.source, schema=self._schema)
         )
@@ -138,9 +150,17 @@ class QueryTable(SQLTable):
         if "patient_id" not in self.columns:
             self.columns["patient_id"] = Column("integer")
 
-    def get_query(self):
-        columns = self._make_columns()
-        return sqlalchemy.text(self.query).columns(*columns)
+    def get_query(self, columns=None):
+        query = sqlalchemy.text(self.query).columns(*self._make_columns())
+        if columns is None:
+            return query
+        # We can't alter the query text, but we can wrap it in an outer query which
+        # selects just the columns we need and allow the database to push the
+        # projection down
+        subquery = query.subquery()
+        return sqlalchemy.select(
+            [subquery.c[name] for name in self._get_columns(columns)]
+        )
 
 
 class Column:
@@ -0,0 +1,88 @@
+from ..contracts import tables
+from ..query_engines.duckdb import DuckDBQueryEngine
+from .base import BaseBackend, Column, MappedTable
+
+
+class DuckDBBackend(BaseBackend):
+    """Backend for working with local data held in DuckDB or in Parquet files.
+
+    The database URL should point either at a DuckDB database file, or at a directory
+    containing one `<table_name>.parquet` file per table, e.g.
+    `duckdb:////path/to/data.duckdb` or `duckdb:////path/to/parquet_dir`.
+
+    Tables are stored under the same names and with the same columns as the logical
+    tables below, which makes it straightforward to export a dummy dataset (or a
+    download from a real backend) and run extractions against it locally.
+    """
+
+    backend_id = "duckdb"
+    query_engine_class = DuckDBQueryEngine
+    patient_join_column = "patient_id"
+
+    patients = MappedTable(
+        source="patients",
+        columns=dict(
+            sex=Column("varchar", source="sex"),
+            date_of_birth=Column("date", source="date_of_birth"),
+        ),
+    )
+
+    patient_demographics = MappedTable(
+        implements=tables.PatientDemographics,
+        source="patient_demographics",
+        columns=dict(
+            sex=Column("varchar", source="sex"),
+            date_of_birth=Column("date", source="date_of_birth"),
+            date_of_death=Column("date", source="date_of_death"),
+        ),
+    )
+
+    clinical_events = MappedTable(
+        source="clinical_events",
+        columns=dict(
+            code=Column("varchar", source="code"),
+            system=Column("varchar", source="system"),
+            date=Column("datetime", source="date"),
+            numeric_value=Column("float", source="numeric_value"),
+        ),
+    )
+
+    practice_registrations = MappedTable(
+        source="practice_registrations",
+        columns=dict(
+            pseudo_id=Column("integer", source="pseudo_id"),
+            nuts1_region_name=Column("varchar", source="nuts1_region_name"),
+            date_start=Column("datetime", source="date_start"),
+            date_end=Column("datetime", source="date_end"),
+        ),
+    )
+
+    sgss_sars_cov_2 = MappedTable(
+        source="sgss_sars_cov_2",
+        columns=dict(
+            date=Column("date", source="date"),
+            positive_result=Column("boolean", source="positive_result"),
+        ),
+    )
+
+    hospitalizations = MappedTable(
+        source="hospitalizations",
+        columns=dict(
+            date=Column("date", source="date"),
+            code=Column("varchar", source="code"),
+            system=Column("varchar", source="system"),
+        ),
+    )
+
+    patient_address = MappedTable(
+        source="patient_address",
+        columns=dict(
+            patientaddress_id=Column("integer", source="patientaddress_id"),
+            date_start=Column("date", source="date_start"),
+            date_end=Column("date", source="date_end"),
+            index_of_multiple_deprivation_rounded=Column(
+                "integer", source="index_of_multiple_deprivation_rounded"
+            ),
+            has_postcode=Column("boolean", source="has_postcode"),
+        ),
+    )
@@ -268,7 +268,7 @@ class PatientSeries:
         return BoolSeries(value=self.value != other)
 
     def __hash__(self) -> int:
-        return hash(repr(self.value))
+        return hash(self.value)
 
     def __invert__(self) -> PatientSeries:
         if self._is_comparator():
@@ -1,11 +1,18 @@
 from __future__ import annotations
 
 import csv
+import datetime
+import hashlib
 import importlib.util
 import inspect
+import io
+import json
+import os
+import secrets
 import shutil
 import sys
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from typing import Generator
 
@@ -16,11 +23,17 @@ from .backends.base import BaseBackend
 from .definition.base import cohort_registry
 from .dsl import Cohort
 from .measure import MeasuresManager, combine_csv_files_with_dates
-from .query_utils import get_column_definitions, get_measures
+from .query_graph import QueryGraph, get_structural_hashes
+from .query_model import Parameter
+from .query_utils import get_column_definitions, get_column_types, get_measures
 from .validate_dummy_data import validate_dummy_data
 
 log = structlog.getLogger()
 
+# The placeholder passed to the `cohort` function of study definitions which set
+# `parameterise_index_date`
+INDEX_DATE = Parameter("index_date")
+
 
 def run_cohort_action(
     cohort_action_function, definition_path, output_file, **function_kwargs
@@ -30,35 +43,119 @@ def run_cohort_action(
 
     output_file.parent.mkdir(parents=True, exist_ok=True)
     module = load_module(definition_path)
+    vectorise_index_dates = function_kwargs.pop("vectorise_index_dates", False)
+    jobs = function_kwargs.pop("jobs", 1)
 
     cohort_class_generator, index_date_range = load_cohort_generator(module)
-    if len(index_date_range) > 1 and "*" not in output_file.name:
+    is_parameterised = is_index_date_parameterised(module, index_date_range)
+    if vectorise_index_dates and not is_parameterised:
+        raise ValueError(
+            "Extracting all index dates at once requires a study definition with an "
+            "index_date_range which sets parameterise_index_date"
+        )
+    if (
+        len(index_date_range) > 1
+        and "*" not in output_file.name
+        and not vectorise_index_dates
+    ):
         # ensure we have a replaceable pattern as an output file when multiple
         # dates ranges are to be output
         raise ValueError(f"No output pattern found in output file {output_file}")
 
-    for index_date in index_date_range:
-        if index_date is not None:
-            log.info(f"Setting index_date to {index_date}")
-            date_suffix = index_date
-        else:
-            date_suffix = ""
-
-        if cohort_registry.cohorts:
-            # Currently we expect at most one cohort to be registered
-            assert (
-                len(cohort_registry.cohorts) == 1
-            ), f"At most one registered cohort is allowed, found {len(cohort_registry.cohorts)}"
-            (cohort,) = cohort_registry.cohorts
-        else:
-            cohort = (
-                cohort_class_generator(index_date)
-                if index_date
-                else cohort_class_generator()
+    parameterised_cohort = None
+    if is_parameterised:
+        # Build the cohort just once, with a placeholder for the index date which is
+        # only filled in when its queries are executed
+        parameterised_cohort = cohort_class_generator(INDEX_DATE)
+        if cohort_action_function is generate_cohort:
+            generate_cohort_for_index_dates(
+                parameterised_cohort,
+                index_date_range,
+                output_file,
+                vectorise_index_dates=vectorise_index_dates,
+                jobs=jobs,
+                **function_kwargs,
             )
-        cohort_action_function(
-            cohort, index_date, output_file, date_suffix, **function_kwargs
-        )
+            return
+
+    def run_for_index_dates(index_dates):
+        kwargs = dict(function_kwargs)
+        with ExitStack() as stack:
+            if (
+                cohort_action_function is generate_cohort
+                and kwargs.get("db_url")
+                and len(index_dates) > 1
+            ):
+                # Share a single database session between all the index dates, so
+                # that we connect just once and anything they have in common
+                # (codelists, say) is created just once
+                kwargs["session"] = stack.enter_context(
+                    open_session(
+                        kwargs["backend_id"],
+                        kwargs["db_url"],
+                        kwargs.get("temporary_database"),
+                    )
+                )
+
+            for index_date in index_dates:
+                if index_date is not None:
+                    log.info(f"Setting index_date to {index_date}")
+                    date_suffix = index_date
+                else:
+                    date_suffix = ""
+
+                if cohort_registry.cohorts:
+                    # Currently we expect at most one cohort to be registered
+                    assert (
+                        len(cohort_registry.cohorts) == 1
+                    ), f"At most one registered cohort is allowed, found {len(cohort_registry.cohorts)}"
+                    (cohort,) = cohort_registry.cohorts
+                elif parameterised_cohort is not None:
+                    cohort = parameterised_cohort
+                else:
+                    cohort = (
+                        cohort_class_generator(index_date)
+                        if index_date
+                        else cohort_class_generator()
+                    )
+                cohort_action_function(
+                    cohort, index_date, output_file, date_suffix, **kwargs
+                )
+
+    run_in_parallel(run_for_index_dates, index_date_range, jobs)
+
+
+def run_in_parallel(function, index_dates, jobs):
+    """
+    Split `index_dates` into (at most) `jobs` batches and call `function` with each
+    batch in its own thread
+
+    Extracting a date spends nearly all its time waiting on the database, so threads
+    are enough to keep several connections busy at once. Any exception raised by
+    `function` is re-raised here once all the threads have finished.
+    """
+    if jobs <= 1 or len(index_dates) <= 1:
+        function(index_dates)
+        return
+    # Deal the dates out in turn so that each batch covers the whole range, as later
+    # dates can take longer to extract than earlier ones
+    batches = [index_dates[i::jobs] for i in range(min(jobs, len(index_dates)))]
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = [executor.submit(function, batch) for batch in batches]
+    for future in futures:
+        future.result()
+
+
+@contextmanager
+def open_session(backend_id, db_url, temporary_database=None):
+    """
+    Open a session which can be shared by the query engines of several extractions, see
+    `BaseQueryEngine.session()`
+    """
+    backend = BACKENDS[backend_id](db_url, temporary_database=temporary_database)
+    query_engine = backend.query_engine_class({}, backend)
+    with query_engine.session() as session:
+        yield session
 
 
 def generate_cohort(
@@ -70,7 +167,13 @@ def generate_cohort(
     db_url,
     dummy_data_file=None,
     temporary_database=None,
+    incremental=False,
+    resumable=False,
+    **extract_kwargs,
 ):
+    """
+    Generate the cohort for `index_date`, passing `extract_kwargs` on to `extract()`
+    """
     output_file_with_date = _replace_filepath_pattern(output_file, date_suffix)
     if index_date:
         log.info("Generating cohort for index date", index_date=index_date)
@@ -81,8 +184,339 @@ def generate_cohort(
         shutil.copyfile(dummy_data_file_with_date, output_file_with_date)
     else:
         backend = BACKENDS[backend_id](db_url, temporary_database=temporary_database)
-        results = extract(cohort, backend)
-        write_output(results, output_file_with_date)
+        columnar = output_file_with_date.suffix in COLUMNAR_FORMATS
+        if (incremental or resumable) and columnar:
+            log.warning(
+                "Incremental and resumable extractions are only supported for CSV "
+                "output, extracting everything"
+            )
+        elif incremental and resumable:
+            log.warning(
+                "Incremental extractions can't also be resumable, extracting without "
+                "recording our progress"
+            )
+        if incremental and not columnar:
+            write_output_incrementally(
+                cohort, backend, output_file_with_date, **extract_kwargs
+            )
+        elif resumable and not columnar:
+            write_output_resumably(
+                cohort, backend, output_file_with_date, **extract_kwargs
+            )
+        else:
+            results = extract(cohort, backend, **extract_kwargs)
+            write_output(results, output_file_with_date, cohort, backend)
+
+
+def write_output_incrementally(cohort, backend, output_file, **extract_kwargs):
+    """
+    Extract `cohort` and write it to `output_file`, reusing the columns of the existing
+    output wherever we can
+
+    Alongside the output we write a manifest recording a hash of the definition of
+    each column. If we find a manifest from a previous run against the same database,
+    with the same population, then we only extract those columns whose definitions are
+    new or have changed and take the rest from the previous output.
+
+    This assumes that the data in the database hasn't changed in the meantime. As a
+    check on this, we extract everything if the population's patients have changed.
+    We merge the new columns with the previous output a row at a time, which relies on
+    both being in patient_id order, so for engines which don't give us the results in
+    that order we always extract everything.
+    """
+    manifest_path = get_manifest_path(output_file)
+    manifest = make_manifest(cohort, backend, extract_kwargs.get("sample_percent"))
+    previous_manifest = read_manifest(manifest_path)
+    column_names = list(manifest["columns"])
+    query_engine = backend.query_engine_class({}, backend)
+
+    # Remove the old manifest first so that it can't be mistaken for a description of
+    # the new output if we fail part way through writing it
+    manifest_path.unlink(missing_ok=True)
+    merged = False
+    if (
+        previous_manifest is not None
+        and output_file.exists()
+        and previous_manifest["database"] == manifest["database"]
+        and previous_manifest["population"] == manifest["population"]
+        and previous_manifest.get("sample_percent") == manifest["sample_percent"]
+        and query_engine.yields_results_in_patient_id_order()
+    ):
+        changed = [
+            name
+            for name, column_hash in manifest["columns"].items()
+            if previous_manifest["columns"].get(name) != column_hash
+        ]
+        log.info(
+            "Reusing unchanged columns from previous output",
+            changed_columns=changed,
+            reused_columns=len(column_names) - len(changed),
+        )
+        new_rows = extract(cohort, backend, columns=changed, **extract_kwargs)
+        merged = merge_with_previous_output(new_rows, output_file, column_names)
+        if not merged:
+            log.warning("Population has changed since previous output, ignoring it")
+
+    if not merged:
+        write_output(extract(cohort, backend, **extract_kwargs), output_file)
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+
+
+def get_manifest_path(output_file):
+    return output_file.with_name(f"{output_file.name}.manifest.json")
+
+
+# How many rows to write between checkpoints, see `write_output_resumably()`
+CHECKPOINT_INTERVAL = 10000
+
+
+def write_output_resumably(cohort, backend, output_file, **extract_kwargs):
+    """
+    Extract `cohort` and write it to `output_file`, recording our progress in a
+    checkpoint alongside it so that an interrupted extraction can be resumed
+
+    Every `CHECKPOINT_INTERVAL` rows we record the last patient_id we've written and
+    the size of the output at that point. If we find a checkpoint for the same cohort
+    and database then we truncate the output to that size and ask the engine for just
+    the patients after that one. This relies on the engine giving us the results in
+    patient_id order, so for engines which don't we always extract everything.
+
+    The checkpoint also records a random key for the extraction, which we write before
+    we start so that even an attempt which fails before writing any rows lets the
+    next one reuse the engine's intermediate results (see `resume_key` on
+    `BaseQueryEngine`).
+    """
+    checkpoint_path = get_checkpoint_path(output_file)
+    query_engine = backend.query_engine_class({}, backend)
+    if not query_engine.yields_results_in_patient_id_order():
+        log.warning("Extractions from this backend can't be resumed")
+        checkpoint_path.unlink(missing_ok=True)
+        write_output(extract(cohort, backend, **extract_kwargs), output_file)
+        return
+
+    manifest = make_manifest(cohort, backend, extract_kwargs.get("sample_percent"))
+    checkpoint = read_manifest(checkpoint_path)
+    if (
+        checkpoint is not None
+        and checkpoint["manifest"] == manifest
+        and (
+            checkpoint["offset"] == 0
+            or output_file.exists()
+            and output_file.stat().st_size >= checkpoint["offset"]
+        )
+    ):
+        log.info(
+            "Resuming extraction from checkpoint",
+            after_patient_id=checkpoint["patient_id"],
+        )
+        resume_after, offset = checkpoint["patient_id"], checkpoint["offset"]
+        resume_key = checkpoint["resume_key"]
+    else:
+        resume_after, offset = None, 0
+        resume_key = secrets.token_hex(16)
+        # This also replaces any stale checkpoint, so that it can't be mistaken for
+        # one of this run's
+        write_checkpoint(
+            checkpoint_path,
+            dict(manifest=manifest, resume_key=resume_key, patient_id=None, offset=0),
+        )
+
+    results = extract(
+        cohort,
+        backend,
+        resume_after=resume_after,
+        resume_key=resume_key,
+        **extract_kwargs,
+    )
+    # We open the file in binary mode so that its position, which we record in the
+    # checkpoint and truncate to on resuming, is a count of bytes. The text layer on
+    # top has no newline translation, so what we write is exactly what we count.
+    raw = output_file.open(mode="r+b" if offset else "wb")
+    with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+        raw.seek(offset)
+        raw.truncate()
+        writer = csv.writer(f)
+        headers = None
+        for n, entry in enumerate(results, start=1):
+            if headers is None:
+                headers = entry.keys()
+                if not offset:
+                    writer.writerow(headers)
+            writer.writerow(entry.values())
+            if n % CHECKPOINT_INTERVAL == 0:
+                # Make sure that everything up to the checkpoint is really on disk
+                f.flush()
+                os.fsync(raw.fileno())
+                write_checkpoint(
+                    checkpoint_path,
+                    dict(
+                        manifest=manifest,
+                        resume_key=resume_key,
+                        patient_id=entry["patient_id"],
+                        offset=raw.tell(),
+                    ),
+                )
+    checkpoint_path.unlink(missing_ok=True)
+
+
+def get_checkpoint_path(output_file):
+    return output_file.with_name(f"{output_file.name}.checkpoint.json")
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file and then move it into place, so that we never leave a
+    # half-written checkpoint
+    temporary_path = checkpoint_path.with_name(f"{checkpoint_path.name}.tmp")
+    temporary_path.write_text(json.dumps(checkpoint, indent=2))
+    os.replace(temporary_path, checkpoint_path)
+
+
+def make_manifest(cohort, backend, sample_percent=None):
+    """
+    Return a description of where and how each column of `cohort` is extracted, which
+    we can compare with that of a later run, see `write_output_incrementally()`
+    """
+    column_hashes = get_structural_hashes(QueryGraph(get_column_definitions(cohort)))
+    database = f"{backend.backend_id}:{backend.database_url}"
+    return {
+        # We don't want to write the database URL itself, with its credentials, to disk
+        "database": hashlib.sha256(database.encode("utf-8")).hexdigest(),
+        "population": column_hashes.pop("population"),
+        "sample_percent": sample_percent,
+        "columns": column_hashes,
+    }
+
+
+def read_manifest(manifest_path):
+    try:
+        return json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+class PopulationChanged(Exception):
+    pass
+
+
+def merge_with_previous_output(new_rows, output_file, column_names):
+    """
+    Replace `output_file` with its rows merged with `new_rows` (see `merge_columns()`),
+    returning False and leaving it untouched if they don't have the same patients
+
+    We write to a temporary file which we move into place only once we're done, so we
+    never hold more than a row of each in memory.
+    """
+    temporary_path = output_file.with_name(f"{output_file.name}.tmp")
+    try:
+        with output_file.open(newline="") as f:
+            previous_rows = csv.DictReader(f)
+            write_output(
+                merge_columns(new_rows, previous_rows, column_names), temporary_path
+            )
+    except PopulationChanged:
+        temporary_path.unlink(missing_ok=True)
+        return False
+    os.replace(temporary_path, output_file)
+    return True
+
+
+def merge_columns(new_rows, previous_rows, column_names):
+    """
+    Combine each of `new_rows` with the corresponding row of `previous_rows`, taking
+    each of `column_names` from the new row if it has it and from the previous row
+    otherwise
+
+    Both must be in patient_id order, and we raise PopulationChanged if they don't
+    have exactly the same patients.
+    """
+    previous_rows = iter(previous_rows)
+    for new_row in new_rows:
+        previous_row = next(previous_rows, None)
+        if previous_row is None or previous_row["patient_id"] != str(
+            new_row["patient_id"]
+        ):
+            raise PopulationChanged()
+        row = {"patient_id": new_row["patient_id"]}
+        for name in column_names:
+            row[name] = new_row[name] if name in new_row else previous_row[name]
+        yield row
+    if next(previous_rows, None) is not None:
+        raise PopulationChanged()
+
+
+def generate_cohort_for_index_dates(
+    cohort,
+    index_dates,
+    output_file,
+    backend_id,
+    db_url,
+    dummy_data_file=None,
+    temporary_database=None,
+    incremental=False,
+    resumable=False,
+    vectorise_index_dates=False,
+    jobs=1,
+    **engine_options,
+):
+    """
+    Generate a cohort whose index date is a Parameter once for each of `index_dates`
+
+    The queries are built and compiled just once and then executed for each date in
+    turn, or for up to `jobs` dates at a time. Or, with `vectorise_index_dates`,
+    executed just once for all the dates together. In that case, if `output_file` has
+    no `*` pattern we write a single file with an extra `index_date` column rather than
+    a file per date. Any `engine_options` are passed on to the query engine.
+    """
+    if dummy_data_file and not db_url:
+        for index_date in index_dates:
+            generate_cohort(
+                cohort,
+                index_date,
+                output_file,
+                index_date,
+                backend_id,
+                db_url,
+                dummy_data_file=dummy_data_file,
+            )
+        return
+
+    if incremental:
+        log.warning(
+            "Incremental extraction isn't supported with parameterise_index_date, "
+            "extracting every column"
+        )
+    if resumable:
+        log.warning(
+            "Resuming extractions isn't supported with parameterise_index_date, "
+            "extracting every patient"
+        )
+    backend = BACKENDS[backend_id](db_url, temporary_database=temporary_database)
+    if vectorise_index_dates:
+        log.info("Generating cohort for all index dates at once")
+        results = extract_all_index_dates(
+            cohort, backend, index_dates, **engine_options
+        )
+        if "*" in output_file.name:
+            write_output_by_index_date(results, output_file, index_dates)
+        else:
+            write_output(results, output_file, cohort, backend)
+        return
+
+    def generate_for_index_dates(index_dates):
+        # Each batch of dates gets its own query engine, and so its own connection
+        all_results = extract_for_index_dates(
+            cohort, backend, index_dates, **engine_options
+        )
+        for index_date, results in all_results:
+            log.info("Generating cohort for index date", index_date=index_date)
+            write_output(
+                results,
+                _replace_filepath_pattern(output_file, index_date),
+                cohort,
+                backend,
+            )
+
+    run_in_parallel(generate_for_index_dates, index_dates, jobs)
 
 
 def validate_cohort(
@@ -200,6 +634,22 @@ def load_cohort_generator(definition_module):
     return cohort_function, index_date_range or [None]
 
 
+def is_index_date_parameterised(definition_module, index_date_range):
+    """
+    Does the study definition ask for its index date to be treated as a parameter?
+
+    Study definitions opt in to this by setting `parameterise_index_date = True`. The
+    `cohort` function is then called just once and its `index_date` argument is a
+    placeholder rather than a date string, so it can only be passed to Query Model
+    methods and not manipulated in Python.
+    """
+    return (
+        index_date_range != [None]
+        and not cohort_registry.cohorts
+        and bool(getattr(definition_module, "parameterise_index_date", False))
+    )
+
+
 def load_module(definition_path):
     # Add the directory containing the definition to the path so that the definition can import library modules from
     # that directory
@@ -221,19 +671,94 @@ def added_to_path(directory):
 
 
 def extract(
-    cohort_definition: Cohort | type, backend: BaseBackend
+    cohort_definition: Cohort | type,
+    backend: BaseBackend,
+    columns: list[str] | None = None,
+    **engine_options,
 ) -> Generator[dict[str, str], None, None]:
     """
     Extracts the cohort from the backend specified
     Args:
         cohort_definition: The definition of the Cohort
         backend: The Backend that the Cohort is being extracted from
+        columns: The names of the columns to extract, if not all of them
+        engine_options: Passed on to the backend's query engine, which describes
+            them (see `BaseQueryEngine`): `population_first`, `setup_connections`,
+            `shared_cache`, `sample_percent`, `shards`, `download_connections`,
+            `session` (from `open_session()`), `resume_after` and `resume_key`
     Returns:
         Yields the cohort as rows
     """
     backend.validate_all_contracts()
     cohort = get_column_definitions(cohort_definition)
-    query_engine = backend.query_engine_class(cohort, backend)
+    if columns is not None:
+        cohort = {
+            name: value
+            for name, value in cohort.items()
+            if name == "population" or name in columns
+        }
+    query_engine = backend.query_engine_class(cohort, backend, **engine_options)
+    with query_engine.execute_query() as results:
+        for row in results:
+            yield dict(row)
+
+
+def extract_for_index_dates(
+    cohort_definition: Cohort | type,
+    backend: BaseBackend,
+    index_dates: list[str],
+    **engine_options,
+) -> Generator[tuple[str, Generator[dict[str, str], None, None]], None, None]:
+    """
+    Extracts a cohort whose index date is a Parameter for each of the supplied dates
+    Args:
+        cohort_definition: The definition of the Cohort
+        backend: The Backend that the Cohort is being extracted from
+        index_dates: The values of the index date to extract the Cohort for
+        engine_options: As for `extract()`
+    Returns:
+        Yields pairs of the index date and an iterator over the cohort's rows for that
+        date, which must be consumed before moving on to the next date
+    """
+    backend.validate_all_contracts()
+    cohort = get_column_definitions(cohort_definition)
+    # A single query engine, so that we build and compile the queries just once, and a
+    # single session so that anything which doesn't depend on the index date is
+    # evaluated just once too
+    query_engine = backend.query_engine_class(cohort, backend, **engine_options)
+    with query_engine.session():
+        for index_date in index_dates:
+            parameters = {INDEX_DATE.name: index_date}
+            with query_engine.execute_query(parameters) as results:
+                yield index_date, (dict(row) for row in results)
+
+
+def extract_all_index_dates(
+    cohort_definition: Cohort | type,
+    backend: BaseBackend,
+    index_dates: list[str],
+    **engine_options,
+) -> Generator[dict[str, str], None, None]:
+    """
+    Extracts a cohort whose index date is a Parameter for all of the supplied dates in
+    a single pass over the data
+    Args:
+        cohort_definition: The definition of the Cohort
+        backend: The Backend that the Cohort is being extracted from
+        index_dates: The values of the index date to extract the Cohort for
+        engine_options: As for `extract()`
+    Returns:
+        Yields the cohort as rows, ordered by index date and then patient_id, with an
+        `index_date` column following the `patient_id`
+    """
+    backend.validate_all_contracts()
+    cohort = get_column_definitions(cohort_definition)
+    query_engine = backend.query_engine_class(
+        cohort,
+        backend,
+        parameter_sets=[{INDEX_DATE.name: index_date} for index_date in index_dates],
+        **engine_options,
+    )
     with query_engine.execute_query() as results:
         for row in results:
             yield dict(row)
@@ -251,7 +776,16 @@ def validate(cohort_class, backend):
         raise
 
 
-def write_output(results, output_file):
+def write_output(results, output_file, cohort=None, backend=None):
+    """
+    Write results to `output_file` as CSV or, depending on its extension, in one of the
+    `COLUMNAR_FORMATS`, in which case we need the `cohort` and `backend` the results
+    were extracted with in order to know the type of each column
+    """
+    if output_file.suffix in COLUMNAR_FORMATS:
+        column_definitions = get_column_definitions(cohort)
+        write_columnar_output(results, output_file, column_definitions, backend)
+        return
     with output_file.open(mode="w") as f:
         writer = csv.writer(f)
         headers = None
@@ -265,6 +799,184 @@ def write_output(results, output_file):
             writer.writerow(entry.values())
 
 
+# Output file extensions for which we write typed columns rather than CSV, see
+# `write_columnar_output()`
+COLUMNAR_FORMATS = (".parquet", ".arrow", ".feather")
+
+# How many rows to write to columnar output at a time
+COLUMNAR_BATCH_SIZE = 64000
+
+
+def write_columnar_output(results, output_file, column_definitions, backend):
+    """
+    Write results to `output_file` as Parquet, or for `.arrow` and `.feather` files as
+    Arrow IPC (which is also version 2 of the Feather format)
+
+    Each column has the type we expect from its definition, see `get_column_types()`,
+    so that whatever reads the output needn't parse dates and numbers out of text.
+    Categories with string labels are dictionary encoded, and any columns we can't
+    type (such as an `index_date` column) are written as strings. We write the results
+    a batch of rows at a time as they arrive, so we never hold more than a batch in
+    memory.
+    """
+    # pyarrow is only needed for columnar output, so we only import it here
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    column_types = get_column_types(column_definitions, backend)
+    column_types["patient_id"] = "integer"
+
+    results = iter(results)
+    first_row = next(results, None)
+    if first_row is not None:
+        names = list(first_row.keys())
+    else:
+        names = ["patient_id"] + [
+            name for name in column_definitions if name != "population"
+        ]
+
+    converters = {}
+    fields = []
+    for name in names:
+        type_name = column_types.get(name)
+        if type_name == "category":
+            definition = column_definitions[name]
+            labels = list(definition.definitions)
+            if definition.default is not None:
+                labels.append(definition.default)
+            converters[name] = make_category_converter(labels)
+        else:
+            converters[name] = make_converter(type_name)
+        fields.append(pyarrow.field(name, converters[name].arrow_type))
+    schema = pyarrow.schema(fields)
+
+    if output_file.suffix == ".parquet":
+        writer = pyarrow.parquet.ParquetWriter(output_file, schema)
+    else:
+        writer = pyarrow.ipc.new_file(output_file, schema)
+    with writer:
+        if first_row is None:
+            return
+        batch = [first_row]
+        for entry in results:
+            assert entry.keys() == first_row.keys(), (
+                f"Expected fields {list(first_row.keys())}, "
+                f"but got {list(entry.keys())}"
+            )
+            batch.append(entry)
+            if len(batch) == COLUMNAR_BATCH_SIZE:
+                writer.write_batch(make_record_batch(batch, schema, converters))
+                batch = []
+        if batch:
+            writer.write_batch(make_record_batch(batch, schema, converters))
+
+
+def make_record_batch(rows, schema, converters):
+    import pyarrow
+
+    arrays = [
+        converters[field.name]([row[field.name] for row in rows]) for field in schema
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def make_converter(type_name):
+    """
+    Return a function which converts a list of the values of a column of the given type
+    (as returned by `get_column_types()`) into a pyarrow Array, coercing them as
+    necessary: some databases give us integers for booleans, say, or strings for dates
+
+    The function's `arrow_type` attribute is the type of the Arrays it returns.
+    """
+    import pyarrow
+
+    coerce, arrow_type = {
+        "boolean": (bool, pyarrow.bool_()),
+        "integer": (int, pyarrow.int64()),
+        "float": (float, pyarrow.float64()),
+        "date": (to_date, pyarrow.date32()),
+        "datetime": (to_datetime, pyarrow.timestamp("us")),
+    }.get(type_name, (str, pyarrow.string()))
+
+    def convert(values):
+        return pyarrow.array(
+            [None if value is None else coerce(value) for value in values],
+            type=arrow_type,
+        )
+
+    convert.arrow_type = arrow_type
+    return convert
+
+
+def make_category_converter(labels):
+    """
+    As `make_converter()` but for category labels, which we dictionary encode with a
+    fixed dictionary so that every batch shares the same one (as the Arrow IPC file
+    format requires)
+    """
+    import pyarrow
+
+    dictionary = pyarrow.array(labels, type=pyarrow.string())
+    codes = {label: code for code, label in enumerate(labels)}
+
+    def convert(values):
+        indices = pyarrow.array(
+            [None if value is None else codes[value] for value in values],
+            type=pyarrow.int32(),
+        )
+        return pyarrow.DictionaryArray.from_arrays(indices, dictionary)
+
+    convert.arrow_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return convert
+
+
+def to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    elif isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def to_datetime(value):
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def write_output_by_index_date(results, output_file, index_dates):
+    """
+    Write results with an `index_date` column to a file per index date, substituting
+    the date for the `*` in `output_file`
+    """
+    if output_file.suffix in COLUMNAR_FORMATS:
+        raise ValueError(
+            "Columnar output formats aren't supported when writing a file per index "
+            "date at once, use CSV output instead"
+        )
+    with ExitStack() as stack:
+        writers = {}
+        for index_date in index_dates:
+            path = _replace_filepath_pattern(output_file, index_date)
+            writers[index_date] = csv.writer(stack.enter_context(path.open(mode="w")))
+        headers = None
+        headers_written = set()
+        for entry in results:
+            index_date = str(entry.pop(INDEX_DATE.name))
+            writer = writers[index_date]
+            fields = entry.keys()
+            if not headers:
+                headers = fields
+            else:
+                assert fields == headers, f"Expected fields {headers}, but got {fields}"
+            # As with `write_output`, files for dates without any results are empty
+            if writer not in headers_written:
+                writer.writerow(headers)
+                headers_written.add(writer)
+            writer.writerow(entry.values())
+
+
 def write_validation_output(results, output_file):
     with output_file.open(mode="w") as f:
         for entry in results:
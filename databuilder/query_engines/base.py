@@ -1,3 +1,34 @@
+import contextlib
+
+# We sample patients by Fibonacci hashing their patient_id: multiplying by this constant
+# (roughly 2**32 divided by the golden ratio) modulo 2**32 scatters the ids evenly
+# across [0, 2**32), whatever patterns there are in how they were allocated. It needs
+# only integer arithmetic, so each engine can evaluate it identically.
+SAMPLE_HASH_MULTIPLIER = 2654435761
+SAMPLE_HASH_MODULUS = 2 ** 32
+
+
+def get_sample_hash(patient_id):
+    """
+    Return `(patient_id * SAMPLE_HASH_MULTIPLIER) % SAMPLE_HASH_MODULUS`, with the
+    remainder taken as in Python (so it's never negative)
+
+    This only uses `%`, `*` and `+`, so it works on a plain int, a pandas Series or a
+    SQLAlchemy expression alike. A 64-bit `patient_id` times the multiplier can
+    overflow, so we reduce the id first and then multiply it by each 16-bit half of
+    the multiplier in turn, which keeps every intermediate value below 2**49. And we
+    correct for databases whose remainders take the sign of the dividend, so that
+    negative ids get the same hash everywhere.
+    """
+    patient_id = (
+        patient_id % SAMPLE_HASH_MODULUS + SAMPLE_HASH_MODULUS
+    ) % SAMPLE_HASH_MODULUS
+    high, low = divmod(SAMPLE_HASH_MULTIPLIER, 2 ** 16)
+    return (
+        patient_id * low + (patient_id * high % 2 ** 16) * 2 ** 16
+    ) % SAMPLE_HASH_MODULUS
+
+
 class BaseQueryEngine:
     """
     A base QueryEngine to hold methods that are agnostic to how the specific queries are built.
@@ -5,19 +36,124 @@ class BaseQueryEngine:
     of linear node paths into their particular flavour of tables (SQL, pandas dataframes etc)
     """
 
-    def __init__(self, column_definitions, backend):
+    def __init__(
+        self,
+        column_definitions,
+        backend,
+        population_first=False,
+        parameter_sets=None,
+        session=None,
+        setup_connections=1,
+        shared_cache=False,
+        sample_percent=None,
+        shards=1,
+        download_connections=1,
+        resume_after=None,
+        resume_key=None,
+    ):
         """
         `column_definitions` is a dictionary mapping output column names to
         Values, which are leaf nodes in DAG of QueryNodes
 
         `backend` is a Backend instance
+
+        `population_first` asks the engine to determine the population before anything
+        else and to restrict all other work to just those patients. This is purely a
+        performance hint and engines for which it makes no difference may ignore it.
+
+        `parameter_sets` is a list of dicts, each supplying a value for every
+        `Parameter` node in the column definitions. If given, the engine evaluates the
+        column definitions for all of them in one go rather than taking `parameters` in
+        `execute_query()`, and each row of the results has a column for each parameter
+        giving the values it was evaluated with.
+
+        `session` is the value of the `session()` context of another instance of the
+        same engine class. This engine will execute its queries within that session,
+        sharing whatever the other engine has left there for it.
+
+        `setup_connections` allows the engine to use up to this many database
+        connections at once while preparing the results. Like `population_first` this
+        is just a hint, and engines which can't make use of it may ignore it.
+
+        `shared_cache` allows the engine to keep intermediate results in a cache which
+        persists between extractions, so that other (possibly concurrent) extractions
+        can reuse them, and to reuse those which others have left there. Engines
+        without anywhere to keep such a cache may ignore it.
+
+        `sample_percent` restricts every table to a deterministic sample of roughly this
+        percentage of patients, see `get_sample_threshold()`. Unlike the other options
+        this changes the results, so all engines must support it.
+
+        `shards` allows the engine to split the patients into this many groups and
+        evaluate the column definitions for each group in turn, so that no
+        intermediate result need ever hold more than one group's patients. Like
+        `population_first` this is just a hint.
+
+        `download_connections` allows the engine to use up to this many database
+        connections at once to download the results. Again, this is just a hint.
+
+        `resume_after` is a patient_id, and asks the engine to omit the results for
+        this patient and all those with lower patient_ids, so that an interrupted
+        extraction can carry on where it stopped. It's only given to engines whose
+        `yields_results_in_patient_id_order()` is true, which must support it.
+
+        `resume_key` is a string identifying this extraction, which stays the same if
+        it's interrupted and run again. Engines may use it to name intermediate results
+        so that a later attempt at the same extraction can find and reuse them, but no
+        other extraction can. Like `population_first` this is just a hint.
         """
         self.column_definitions = column_definitions
         self.backend = backend
+        self.population_first = population_first
+        self.parameter_sets = parameter_sets
+        self.shared_session = session
+        self.setup_connections = setup_connections
+        self.shared_cache = shared_cache
+        self.sample_percent = sample_percent
+        self.shards = shards
+        self.download_connections = download_connections
+        self.resume_after = resume_after
+        self.resume_key = resume_key
 
-    def execute_query(self):
+    def execute_query(self, parameters=None):
         """
         Override this method to do the things necessary to generate query code and execute
         it against a particular backend
+
+        `parameters` is a dict supplying the value of each `Parameter` node in the
+        column definitions. Engines should do as much of the work as possible just once,
+        so that executing the same query with many different parameters is cheap.
         """
         raise NotImplementedError
+
+    def yields_results_in_patient_id_order(self):
+        """
+        Override this method to return True if the results of `execute_query()` are
+        always in ascending order of patient_id (with one row per patient), which means
+        that an interrupted extraction can be resumed part way through
+        """
+        return False
+
+    def get_sample_threshold(self):
+        """
+        Return the threshold for sampling patients, or None if we're not sampling
+
+        A patient is in the sample if the hash of their patient_id (see
+        `get_sample_hash()`) is less than the threshold. The same patients are sampled
+        every time, so results for a sample are consistent between runs, and a larger
+        sample includes a smaller one.
+        """
+        if self.sample_percent is None:
+            return None
+        return int(SAMPLE_HASH_MODULUS * self.sample_percent / 100)
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Override this method to hold any state which can be shared between calls to
+        `execute_query()` within this context, for engines which can make use of it
+
+        The context's value can be passed to other instances of the engine so that
+        they share it too.
+        """
+        yield
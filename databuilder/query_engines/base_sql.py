@@ -39,11 +39,14 @@ order.
 
 # mypy: ignore-errors
 
+import concurrent.futures
 import contextlib
-import copy
 import dataclasses
+import logging
+import queue
 import typing
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from typing import Any, Optional, Union
 
@@ -63,12 +66,15 @@ from sqlalchemy.sql.selectable import Select
 
 from .. import sqlalchemy_types
 from ..functools_utils import singledispatchmethod_with_unions
+from ..query_graph import QueryGraph, get_parameter_dependent_nodes
 from ..query_model import (
+    BaseTable,
     Codelist,
     Column,
     Comparator,
     DateDifference,
     FilteredTable,
+    Parameter,
     QueryNode,
     RoundToFirstOfMonth,
     RoundToFirstOfYear,
@@ -83,14 +89,22 @@ from ..query_model import (
 )
 from ..sqlalchemy_utils import (
     TemporaryTable,
+    get_bind_parameters,
     get_primary_table,
     get_referenced_tables,
     get_setup_and_cleanup_queries,
+    get_setup_dependencies,
+    get_temporary_tables,
+    get_temporary_tables_in_setup_order,
     group_and_aggregate,
+    group_and_aggregate_many,
     include_joined_tables,
     select_first_row_per_partition,
+    select_first_rows_per_partition,
 )
-from .base import BaseQueryEngine
+from .base import BaseQueryEngine, get_sample_hash
+
+log = logging.getLogger(__name__)
 
 # These are nodes which select a single column from a query (regardless of whether that
 # results in a single value per patient or in multiple values per patient)
@@ -99,7 +113,7 @@ ColumnSelectorNode = Union[ValueFromRow, ValueFromAggregate, Column]
 
 # This is an internal class that is injected into the DAG by the QueryEngine, but that
 # does not form part of the public Query Model
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, eq=False)
 class ReifiedQuery(QueryNode):
     source: QueryNode
     columns: tuple[str]
@@ -108,6 +122,40 @@ class ReifiedQuery(QueryNode):
         return (self.source,)
 
 
+# Another internal node type: a table-like node holding the rows of `source`, which is
+# written to a temporary table rather than queried in place. This is useful when many
+# different queries all start by scanning the same, expensive, set of rows.
+@dataclasses.dataclass(frozen=True, eq=False)
+class MaterializedTable(BaseTable):
+    source: QueryNode
+
+    def _get_referenced_nodes(self):
+        return (self.source,)
+
+
+# Several aggregations over the same source, combined so that they can be evaluated in a
+# single GROUP BY query. `aggregates` is a tuple of (function, input_column,
+# output_column) triples, one for each RowFromAggregate node this replaces.
+@dataclasses.dataclass(frozen=True, eq=False)
+class RowFromAggregates(QueryNode):
+    source: QueryNode
+    aggregates: tuple[tuple[str, str, str]]
+
+    def _get_referenced_nodes(self):
+        return (self.source,)
+
+
+# The first row per patient according to each of several orderings of the same source,
+# evaluated in a single pass. See `combine_rows_over_same_source`.
+@dataclasses.dataclass(frozen=True, eq=False)
+class FirstRowsByOrdering(BaseTable):
+    source: QueryNode
+    orderings: tuple[tuple[tuple[str], bool]]
+
+    def _get_referenced_nodes(self):
+        return (self.source,)
+
+
 class MissingString(str):
     def __init__(self, message):
         self.message = message
@@ -116,6 +164,58 @@ class MissingString(str):
         raise NotImplementedError(self.message)
 
 
+class SQLSession:
+    """
+    A database connection, along with the temporary tables created in it which can be
+    reused by later executions of one or more query engines (see `session()`)
+
+    The connection is only opened once something needs it: some engines (MSSQL with a
+    temporary database, say) do all their work on connections of their own, and then
+    there's no point holding one open for the whole session.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._connection = None
+        # Tables which have been created and kept, in the order they were created
+        self.tables: list[TemporaryTable] = []
+        # Those of the above which any query engine in the session can reuse, keyed by
+        # the Query Model node they were created from. As nodes are interned, a query
+        # engine needing a table with the same contents will have the very same node.
+        self.tables_by_node: dict[QueryNode, TemporaryTable] = {}
+        # Temporary table names must be unique across all the query engines sharing
+        # the session, see `get_temp_table_name`
+        self.temp_table_count = 0
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = self.engine.connect()
+            # Our temporary tables are scoped to the session so we mustn't return this
+            # connection to the pool, where the next session would find them
+            self._connection.detach()
+        return self._connection
+
+    def keep_table(self, table):
+        self.tables.append(table)
+        if table.content_key is not None:
+            self.tables_by_node[table.content_key] = table
+
+    def cleanup(self):
+        if not any(table.cleanup_queries for table in self.tables):
+            # There's nothing to drop, so no need to connect
+            return
+        for table in reversed(self.tables):
+            for query in table.cleanup_queries:
+                self.connection.execute(query)
+        self.connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
 class BaseSQLQueryEngine(BaseQueryEngine):
 
     sqlalchemy_dialect: type[Dialect]
@@ -132,10 +232,42 @@ class BaseSQLQueryEngine(BaseQueryEngine):
     # Use a simple counter to generate unique (per session) temporary table names
     temp_table_count: int = 0
 
+    # Whether to add NULLS FIRST/LAST when sorting, see `get_order_by_columns()`
+    explicit_nulls_order: bool = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # See docstring on `get_sql_element` for details on this
         self.sql_element_cache: dict[QueryNode, ClauseElement] = {}
+        # Table of patient IDs in the population, when running "population first"
+        self.population_table: Optional[TemporaryTable] = None
+        # Names of the columns we need from each table, see `get_required_columns`
+        self.table_columns: dict[str, set[str]] = {}
+        # Table of all the sets of parameter values, when evaluating the column
+        # definitions for several sets at once (see `get_element_from_table`)
+        self.parameter_table: Optional[TemporaryTable] = None
+        # The table from which we take the values of parameters used in the column
+        # definitions, when evaluating for several sets at once
+        self.key_table: Optional[Any] = None
+        # Every intermediate query has a row per value of these columns (or rather, at
+        # most one such row). Usually this is just the patient, but when we evaluate
+        # several sets of parameters at once each patient has a row per set in any
+        # query which depends on the parameters (see `get_key_columns`).
+        self.key_columns: tuple[str, ...] = ("patient_id",)
+        if self.parameter_sets:
+            self.key_columns += tuple(self.parameter_sets[0])
+        # Nodes whose values depend on a Parameter, see `get_parameter_dependent_nodes`
+        self.parameter_dependent_nodes: set[QueryNode] = set()
+        # Names of the tables which determine which patients can be in the population,
+        # see `get_patient_id_range()`
+        self.population_table_names: list[str] = []
+        # The session within which queries are currently executed, see `session()`
+        self.current_session: Optional[SQLSession] = None
+        # Tables already created in the session we're sharing, which we can use rather
+        # than creating our own
+        self.shared_tables: dict[QueryNode, TemporaryTable] = (
+            self.shared_session.tables_by_node if self.shared_session else {}
+        )
 
     def get_queries(self) -> tuple[list[Executable], Executable, list[Executable]]:
         """
@@ -147,17 +279,29 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         """
         # Modify the Query Model graph to make it easier to work with, or to generate
         # more efficient SQL
-        column_definitions = apply_optimisations(self.column_definitions)
+        graph = apply_optimisations(self.column_definitions, self.first_row_strategy)
+        column_definitions = dict(graph.column_definitions)
 
-        # Convert each column definition to SQL
-        column_queries = {
-            column: self.get_sql_element(definition)
-            for column, definition in column_definitions.items()
-        }
+        # Work out which columns we need from each table so we don't carry unused
+        # columns through all the intermediate queries
+        self.table_columns = get_required_columns(graph)
+
+        # Work out which parts of the graph are affected by the values of parameters,
+        # anything else need only be evaluated once however many values we use
+        self.parameter_dependent_nodes = get_parameter_dependent_nodes(graph)
+
+        if self.parameter_sets:
+            self.parameter_table = self.get_parameter_table()
 
         # `population` is a special-cased boolean column, it doesn't appear
         # itself in the output but it determines what rows are included
-        population_query = column_queries.pop("population")
+        population_definition = column_definitions.pop("population")
+        self.population_table_names = [
+            node.name
+            for node in QueryGraph({"population": population_definition})
+            if isinstance(node, Table)
+        ]
+        population_query = self.get_sql_element(population_definition)
 
         # TODO: Not sure why we require just a single table here for the population. I
         # think this could be lifted as long as we did a FULL OUTER JOIN between all the
@@ -173,6 +317,44 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             .select_from(population_table)
             .where(population_query == True)  # noqa: E712
         )
+        self.key_table = population_table
+        if self.parameter_table is not None:
+            if population_definition not in self.parameter_dependent_nodes:
+                # The population is the same whatever the parameters, but we still
+                # need a row for each patient for each set of parameters
+                self.key_table = self.parameter_table
+                results_query = results_query.select_from(
+                    population_table.join(self.parameter_table, sqlalchemy.true())
+                )
+            results_query = results_query.add_columns(
+                *[self.key_table.c[name] for name in self.key_columns[1:]]
+            )
+
+        if self.population_first:
+            # Write the population's patient IDs to a table up front and restrict every
+            # table we read from to just those patients (see `get_element_from_table`).
+            # When the population is a small fraction of the patients in the database
+            # this shrinks all the downstream sorts and aggregations accordingly.
+            self.population_table = self.write_query_to_temp_table(
+                results_query,
+                "population",
+                depends_on_parameters=self.depends_on_parameters(population_definition),
+            )
+            self.population_table.setup_queries.extend(
+                self.get_index_queries(self.population_table, "patient_id")
+            )
+            # Anything already converted to SQL was built without the restriction
+            self.sql_element_cache = {}
+            results_query = sqlalchemy.select(
+                [self.population_table.c[name] for name in self.key_columns]
+            ).select_from(self.population_table)
+            self.key_table = self.population_table
+
+        # Convert each column definition to SQL
+        column_queries = {
+            column: self.get_sql_element(definition)
+            for column, definition in column_definitions.items()
+        }
 
         # For each column to be included in the output ...
         for column_name, column_query in column_queries.items():
@@ -181,7 +363,7 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             results_query = include_joined_tables(
                 results_query,
                 get_referenced_tables(column_query),
-                join_column="patient_id",
+                join_columns=self.key_columns,
             )
             # Add this column to the final selected results using the supplied name
             results_query = results_query.add_columns(column_query.label(column_name))
@@ -192,17 +374,266 @@ class BaseSQLQueryEngine(BaseQueryEngine):
 
         return setup_queries, results_query, cleanup_queries
 
+    def get_key_columns(self, query):
+        """
+        Return the key columns of `query`: those of `key_columns` which it selects
+
+        When we evaluate several sets of parameters at once only queries which depend on
+        the parameters have a row per set, so these may be fewer than `key_columns`.
+        """
+        return [name for name in self.key_columns if name in query.selected_columns]
+
+    def include_parameter_columns(self, query):
+        """
+        Ensure that `query` has a row for each set of parameter values, with columns
+        giving the values, by cross-joining the parameter table if necessary
+        """
+        if self.parameter_table is None:
+            return query
+        if all(name in query.selected_columns for name in self.key_columns):
+            return query
+        subquery = query.subquery()
+        query = sqlalchemy.select([*subquery.c, *self.parameter_table.c]).select_from(
+            subquery.join(self.parameter_table, sqlalchemy.true())
+        )
+        # Wrap this up so that the query has a single primary table with all the columns
+        return query.subquery().select()
+
+    @cached_property
+    def queries(self):
+        """
+        The queries returned by `get_queries()`, built just once however many times
+        they're executed
+
+        As the queries themselves are identical on each execution, SQLAlchemy's compiled
+        cache means they're only compiled to SQL once too.
+        """
+        return self.get_queries()
+
     @contextlib.contextmanager
-    def execute_query(self):
-        setup_queries, results_query, cleanup_queries = self.get_queries()
-        with self.engine.connect() as cursor:
-            for query in setup_queries:
-                cursor.execute(query)
+    def session(self):
+        """
+        Execute all queries within this context on a single connection, creating any
+        temporary tables which don't depend on the parameters just once
+
+        So when we execute the query for each of a range of index dates, anything which
+        doesn't involve the index date (codelists, say, or the date of a patient's first
+        ever diagnosis) is evaluated on the first execution and reused after that.
+
+        If this engine was created with the session of another engine then we join that
+        session, and it's left open for the other engine to close.
+        """
+        if self.shared_session is not None:
+            self.current_session = self.shared_session
+            try:
+                yield self.shared_session
+            finally:
+                self.current_session = None
+            return
+
+        self.current_session = SQLSession(self.engine)
+        try:
+            yield self.current_session
+            self.current_session.cleanup()
+        finally:
+            self.current_session.close()
+            self.current_session = None
+
+    def depends_on_parameters(self, node):
+        """
+        Do the results of `node` depend on the values of the parameters we execute the
+        queries with?
+
+        When we're sharding, the range of patient_ids in each shard is passed as
+        parameters, so everything derived from a table depends on them.
+        """
+        return self.shards > 1 or node in self.parameter_dependent_nodes
+
+    @contextlib.contextmanager
+    def execute_query(self, parameters=None):
+        if self.shards <= 1:
+            with self.execute_query_for_shard(parameters) as results:
+                yield results
+        else:
+            yield self.get_sharded_results(parameters or {})
+
+    def get_sharded_results(self, parameters):
+        """
+        Execute the queries separately for each of `shards` contiguous ranges of
+        patient_ids in turn, and yield the results of each range in order
+
+        Every table we read from is restricted to the current range (see
+        `get_element_from_table`), so the intermediate tables only ever hold the
+        patients in one shard, and we drop them before moving on to the next.
+        """
+        # Make sure the queries are built, so we know which tables to look at
+        self.queries
+        with self.engine.connect() as connection:
+            start, end = self.get_patient_id_range(connection)
+        for shard_start, shard_end in split_range(start, end, self.shards):
+            if self.resume_after is not None and shard_end <= self.resume_after + 1:
+                # We've already got the results for every patient in this shard
+                continue
+            log.info(f"Extracting patients with IDs from {shard_start} to {shard_end}")
+            shard_parameters = dict(
+                parameters, shard_start=shard_start, shard_end=shard_end
+            )
+            with self.execute_query_for_shard(shard_parameters) as results:
+                yield from results
+
+    def yields_results_in_patient_id_order(self):
+        # See `execute_query_for_shard()`. When we evaluate several sets of parameters
+        # there's a row for each of them.
+        return not self.parameter_sets
+
+    def get_patient_id_range(self, connection):
+        """
+        Return a range of patient_ids (as a start and an exclusive end) which includes
+        every patient who could be in the population
+        """
+        start, end = None, None
+        for name in self.population_table_names:
+            patient_id = self.backend.get_table_expression(name, ["patient_id"]).c[
+                "patient_id"
+            ]
+            low, high = connection.execute(
+                sqlalchemy.select(
+                    sqlalchemy.func.min(patient_id), sqlalchemy.func.max(patient_id)
+                )
+            ).one()
+            if low is not None:
+                start = low if start is None else min(start, low)
+                end = high + 1 if end is None else max(end, high + 1)
+        if start is None:
+            # There are no patients at all
+            return 0, 0
+        return start, end
+
+    @contextlib.contextmanager
+    def execute_query_for_shard(self, parameters=None):
+        """
+        Execute the queries for a single shard of patients (or for all of them, if
+        we're not sharding) and return the results
+        """
+        _, results_query, _ = self.queries
+        # When evaluating several sets of parameters at once, their values are all
+        # written to `parameter_table` instead
+        parameters = parameters or {}
+        if self.parameter_table is not None:
+            # Return the results for each set of parameters in patient_id order, as we
+            # would if we'd evaluated them separately
+            results_query = results_query.order_by(
+                *[
+                    results_query.selected_columns[name]
+                    for name in self.key_columns[1:] + self.key_columns[:1]
+                ]
+            )
+        else:
+            # Shards are contiguous ranges of patient_ids taken in ascending order, so
+            # this puts all the results in patient_id order
+            patient_id = results_query.selected_columns["patient_id"]
+            results_query = results_query.order_by(patient_id)
+            if self.resume_after is not None:
+                results_query = results_query.where(patient_id > self.resume_after)
+        # Outside of a session, each execution gets a session of its own
+        in_session = self.current_session is not None
+        with contextlib.nullcontext() if in_session else self.session():
+            session = self.current_session
+            connection = session.connection
+            # We only need to create those tables which we haven't already kept from
+            # an earlier execution
+            tables = [
+                table
+                for table in get_temporary_tables_in_setup_order(results_query)
+                if table not in session.tables
+            ]
+            if self.can_create_tables_concurrently():
+                self.create_tables_concurrently(tables, parameters)
+            else:
+                for table in tables:
+                    self.create_table(connection, table, parameters)
+            disposable_tables = []
+            for table in tables:
+                if self.can_keep_table(table, session):
+                    session.keep_table(table)
+                else:
+                    disposable_tables.append(table)
+
+            yield connection.execute(
+                results_query, get_bind_parameters(results_query, parameters)
+            )
+
+            if in_session:
+                # Get rid of anything we can't reuse, e.g. because it depends on the
+                # parameters, so that it can be recreated next time
+                for table in reversed(disposable_tables):
+                    connection.execute(self.get_drop_temp_table_query(table))
+            else:
+                # The session is about to end anyway, so just clean up as normal
+                session.tables.extend(disposable_tables)
 
-            yield cursor.execute(results_query)
+    def create_table(self, connection, table, parameters):
+        """
+        Run the setup queries for `table` using `connection`
+        """
+        for query in table.setup_queries:
+            connection.execute(query, get_bind_parameters(query, parameters))
+
+    def create_tables_concurrently(self, tables, parameters):
+        """
+        Create each of `tables` using a pool of up to `setup_connections` connections
 
-            for query in cleanup_queries:
-                cursor.execute(query)
+        Most of the tables we create don't depend on each other (e.g. those for
+        variables using different codelists) so there's no need to wait for one to be
+        finished before starting on the next. We just need to make sure that a table
+        isn't created until all the tables it uses exist.
+        """
+        # Connections are handed out to the worker threads and returned here once each
+        # table is done. We open them all here on the calling thread, as the ExitStack
+        # which closes them again isn't safe to use from several threads at once.
+        idle_connections = queue.SimpleQueue()
+
+        with contextlib.ExitStack() as stack:
+            for _ in range(min(self.setup_connections, len(tables))):
+                idle_connections.put(stack.enter_context(self.engine.connect()))
+
+            def create_on_idle_connection(table):
+                connection = idle_connections.get()
+                try:
+                    self.create_table(connection, table, parameters)
+                    # Other connections can't see the table until we commit
+                    connection.commit()
+                finally:
+                    idle_connections.put(connection)
+
+            dependencies = {
+                table: [
+                    other for other in get_setup_dependencies(table) if other in tables
+                ]
+                for table in tables
+            }
+            run_in_dependency_order(
+                dependencies, create_on_idle_connection, self.setup_connections
+            )
+
+    def can_keep_table(self, table, session):
+        """
+        Can `table` be kept for reuse by later executions within `session`?
+
+        Note that the check on dependencies below matters for correctness, not just
+        tidiness: a table built from one which is recreated for each execution (e.g. a
+        per-date population table with `population_first`) would otherwise be kept with
+        stale contents. `write_query_to_temp_table()` already marks such tables as
+        depending on the parameters, but tables we share between query engines can
+        also depend on tables which another engine didn't keep.
+        """
+        if table.depends_on_parameters:
+            return False
+        if self.shared_session is not None and table.content_key is None:
+            # Other query engines sharing the session have no way of finding the table
+            return False
+        # We can't keep anything which relies on tables we're not keeping
+        return all(other in session.tables for other in get_setup_dependencies(table))
 
     def get_sql_element(self, node: QueryNode) -> ClauseElement:
         """
@@ -247,13 +678,53 @@ class BaseSQLQueryEngine(BaseQueryEngine):
 
     @get_sql_element_no_cache.register
     def get_element_from_table(self, node: Table) -> Select:
-        table = self.backend.get_table_expression(node.name)
-        return table.select()
+        table = self.backend.get_table_expression(
+            node.name, self.table_columns.get(node.name)
+        )
+        query = table.select()
+        if self.shards > 1:
+            query = query.where(
+                (table.c.patient_id >= sqlalchemy.bindparam("shard_start"))
+                & (table.c.patient_id < sqlalchemy.bindparam("shard_end"))
+            )
+        if self.sample_percent is not None:
+            query = query.where(self.get_sample_condition(table.c.patient_id))
+        if self.population_table is not None:
+            population_ids = sqlalchemy.select(self.population_table.c.patient_id)
+            query = query.where(table.c.patient_id.in_(population_ids))
+        return query
+
+    def get_sample_condition(self, patient_id):
+        """
+        Return a condition which is true for the patients in the sample, see
+        `BaseQueryEngine.get_sample_threshold()`
+        """
+        # The constants in the hash all take the type of the patient_id, so we need
+        # it to be a BIGINT for them to fit
+        patient_hash = get_sample_hash(
+            sqlalchemy.cast(patient_id, sqlalchemy.BigInteger)
+        )
+        return patient_hash < self.get_sample_threshold()
 
     @get_sql_element_no_cache.register
     def get_element_from_filtered_table(self, node: FilteredTable) -> Select:
         query = self.get_sql_element(node.source)
-        filter_value = self.get_sql_element_or_value(node.value)
+        if node in self.parameter_dependent_nodes:
+            # Repeat every row for each set of parameter values (if we're evaluating
+            # several at once) so that everything downstream is evaluated for all of
+            # them together
+            query = self.include_parameter_columns(query)
+        if (
+            isinstance(node.value, QueryNode)
+            and node.value in self.parameter_dependent_nodes
+            and self.parameter_table is not None
+        ):
+            # Each row carries its own values for the parameters
+            filter_value = self.get_value_from_parameter_columns(
+                node.value, get_primary_table(query)
+            )
+        else:
+            filter_value = self.get_sql_element_or_value(node.value)
         return apply_filter(
             query,
             column=node.column,
@@ -263,6 +734,7 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             # rewrite the `apply_filter` function
             value_query_node=node.value,
             or_null=node.or_null,
+            key_columns=self.get_key_columns(query),
         )
 
     @get_sql_element_no_cache.register
@@ -270,9 +742,22 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         query = self.get_sql_element(node.source)
         return select_first_row_per_partition(
             query,
-            partition_column="patient_id",
+            partition_columns=self.get_key_columns(query),
             sort_columns=node.sort_columns,
             descending=node.descending,
+            explicit_nulls_order=self.explicit_nulls_order,
+        )
+
+    @get_sql_element_no_cache.register
+    def get_element_from_first_rows_by_ordering(
+        self, node: FirstRowsByOrdering
+    ) -> Select:
+        query = self.get_sql_element(node.source)
+        return select_first_rows_per_partition(
+            query,
+            partition_columns=self.get_key_columns(query),
+            orderings=node.orderings,
+            explicit_nulls_order=self.explicit_nulls_order,
         )
 
     @get_sql_element_no_cache.register
@@ -280,12 +765,21 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         query = self.get_sql_element(node.source)
         return group_and_aggregate(
             query,
-            group_by_column="patient_id",
+            group_by_columns=self.get_key_columns(query),
             input_column=node.input_column,
             function_name=node.function,
             output_column=node.output_column,
         )
 
+    @get_sql_element_no_cache.register
+    def get_element_from_row_from_aggregates(self, node: RowFromAggregates) -> Select:
+        query = self.get_sql_element(node.source)
+        return group_and_aggregate_many(
+            query,
+            group_by_columns=self.get_key_columns(query),
+            aggregates=node.aggregates,
+        )
+
     @get_sql_element_no_cache.register
     def get_element_from_reified_query(self, node: ReifiedQuery) -> TemporaryTable:
         """
@@ -302,16 +796,66 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         and the tests will still pass (other than those which assert specific things
         about the generated SQL)
         """
+        # The contents of the table are determined by the node alone unless they're
+        # restricted to the population, or to a shard of patients
+        shareable = self.population_table is None and self.shards <= 1
+        if shareable and node in self.shared_tables:
+            return self.shared_tables[node]
         query = self.get_sql_element(node.source)
         # Select just the specified columns. This is a performance optimisation to avoid
         # reifying more data than we need.
-        column_names = {"patient_id"} | set(node.columns)
+        column_names = set(self.get_key_columns(query)) | set(node.columns)
         columns = [query.selected_columns[name] for name in column_names]
         query = query.with_only_columns(columns)
+        table = self.write_query_to_temp_table(
+            query,
+            "group_table",
+            depends_on_parameters=self.depends_on_parameters(node),
+        )
+        if shareable:
+            table.content_key = node
+        return table
 
-        table_columns = [sqlalchemy.Column(c.name, c.type) for c in columns]
-        table_name = self.get_temp_table_name("group_table")
-        table = TemporaryTable(table_name, sqlalchemy.MetaData(), *table_columns)
+    @get_sql_element_no_cache.register
+    def get_element_from_materialized_table(self, node: MaterializedTable) -> Select:
+        query = self.get_sql_element(node.source)
+        table = self.write_query_to_temp_table(
+            query,
+            "materialized_table",
+            depends_on_parameters=self.depends_on_parameters(node),
+        )
+        return table.select()
+
+    def write_query_to_temp_table(self, query, name_hint, depends_on_parameters):
+        """
+        Return a TemporaryTable with the setup and cleanup queries needed to populate it
+        with the results of `query`
+
+        `depends_on_parameters` says whether the results of `query` depend on the values
+        of any parameters, in which case the table can't be reused between executions
+        with different values (see `session()`).
+
+        The table also depends on the parameters if anything it's built from does, even
+        if its own node doesn't: with `population_first`, say, every table is restricted
+        to the patients in a population which may itself depend on the index date.
+        """
+        depends_on_parameters = depends_on_parameters or any(
+            other.depends_on_parameters for other in get_temporary_tables(query)
+        )
+        table_columns = [
+            sqlalchemy.Column(c.name, c.type) for c in query.selected_columns
+        ]
+        table_name = self.get_temp_table_name(
+            name_hint, contents=None if depends_on_parameters else query
+        )
+        # Tables which other connections need to see, or which need to outlive the
+        # connection, have to live in the temporary database, just like codelists
+        schema = (
+            self.get_temp_database() if self.persists_intermediate_tables() else None
+        )
+        table = TemporaryTable(
+            table_name, sqlalchemy.MetaData(), *table_columns, schema=schema
+        )
 
         create_query = self.query_to_create_temp_table_from_select_query(table, query)
         cleanup_queries = (
@@ -321,6 +865,7 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         )
         table.setup_queries = [create_query]
         table.cleanup_queries = cleanup_queries
+        table.depends_on_parameters = depends_on_parameters
         return table
 
     @get_sql_element_no_cache.register
@@ -365,6 +910,65 @@ class BaseSQLQueryEngine(BaseQueryEngine):
 
         return condition_expression
 
+    @get_sql_element_no_cache.register
+    def get_element_from_parameter(self, node: Parameter) -> ClauseElement:
+        if self.parameter_table is not None:
+            # Each row of the results has its own value for the parameter
+            if self.key_table is None:
+                raise ValueError(
+                    f"'{node.name}' can only be used to filter tables in the population "
+                    f"definition when evaluating several values of it at once"
+                )
+            return self.key_table.c[node.name]
+        # The only parameter we currently support is the index date. We cast it
+        # explicitly because, unlike a literal, the database can't always infer the type
+        # of a parameter from the way it's used (e.g. as the argument to `year()`).
+        date_type = sqlalchemy_types.Date()
+        return sqlalchemy.cast(
+            sqlalchemy.bindparam(node.name, type_=date_type), date_type
+        )
+
+    def get_value_from_parameter_columns(self, value, table):
+        """
+        Convert `value`, which depends on the parameters, to SQL which takes their
+        values from the columns of `table`
+
+        When evaluating several sets of parameters at once this lets us filter each row
+        of `table` by the value for its own set. We can only do this for values which
+        are functions of the parameters (and of constants), not for values which also
+        depend on other tables.
+        """
+        if isinstance(value, Parameter):
+            return table.c[value.name]
+        if not isinstance(value, ValueFromFunction):
+            raise ValueError(
+                "Can't filter a table by a value which depends on both the index date "
+                "and another table when evaluating several index dates at once"
+            )
+        argument_expressions = [
+            self.get_value_from_parameter_columns(arg, table)
+            if isinstance(arg, QueryNode) and arg in self.parameter_dependent_nodes
+            else self.get_sql_element_or_value(arg)
+            for arg in value.arguments
+        ]
+        return self.apply_function(value, argument_expressions)
+
+    def get_parameter_table(self):
+        """
+        Return a TemporaryTable containing a row for each set of parameter values
+        """
+        rows = [tuple(values.values()) for values in self.parameter_sets]
+        table = TemporaryTable(
+            self.get_temp_table_name("parameters", contents=rows),
+            sqlalchemy.MetaData(),
+            *[
+                sqlalchemy.Column(name, sqlalchemy_types.Date(), nullable=False)
+                for name in self.parameter_sets[0]
+            ],
+            schema=self.get_temp_database(),
+        )
+        return self.populate_temp_table(table, rows)
+
     @get_sql_element_no_cache.register
     def get_element_from_codelist(self, codelist: Codelist) -> TemporaryTable:
         """
@@ -372,10 +976,13 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         needed to store that codelist and then generate the queries necessary to create
         and populate that table
         """
+        if codelist in self.shared_tables:
+            return self.shared_tables[codelist]
         codes = codelist.codes
         max_code_len = max(map(len, codes))
         collation = "Latin1_General_BIN"
-        table_name = self.get_temp_table_name("codelist")
+        rows = [(code, codelist.system) for code in codes]
+        table_name = self.get_temp_table_name("codelist", contents=rows)
         table = TemporaryTable(
             table_name,
             sqlalchemy.MetaData(),
@@ -395,16 +1002,20 @@ class BaseSQLQueryEngine(BaseQueryEngine):
             schema=self.get_temp_database(),
         )
 
+        table = self.populate_temp_table(table, rows)
+        table.content_key = codelist
+        return table
+
+    def populate_temp_table(self, table, rows):
+        """
+        Attach to `table` the queries needed to create it, insert `rows` into it and
+        clean it up afterwards
+        """
         # Constuct the queries needed to create and populate this table
         create_query = sqlalchemy.schema.CreateTable(table)
         insert_queries = []
-        for codes_batch in split_list_into_batches(
-            codes, size=self.max_rows_per_insert
-        ):
-            insert_query = table.insert().values(
-                [(code, codelist.system) for code in codes_batch]
-            )
-            insert_queries.append(insert_query)
+        for rows_batch in split_list_into_batches(rows, size=self.max_rows_per_insert):
+            insert_queries.append(table.insert().values(rows_batch))
 
         # Construct the queries needed to clean it up
         cleanup_queries = (
@@ -415,12 +1026,22 @@ class BaseSQLQueryEngine(BaseQueryEngine):
 
         table.setup_queries = [create_query] + insert_queries
         table.cleanup_queries = cleanup_queries
+        table.depends_on_parameters = False
         return table
 
     @get_sql_element_no_cache.register
     def get_element_from_value_from_function(
         self, value: ValueFromFunction
     ) -> ClauseElement:
+        argument_expressions = [
+            self.get_sql_element_or_value(arg) for arg in value.arguments
+        ]
+        return self.apply_function(value, argument_expressions)
+
+    def apply_function(self, value: ValueFromFunction, argument_expressions):
+        """
+        Return the SQL which applies the function of `value` to `argument_expressions`
+        """
         # TODO: I'd quite like to build this map by decorating the methods e.g.
         #
         #   @handler_for(DateDifferenceInYears)
@@ -437,14 +1058,45 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         assert value.__class__ in class_method_map, f"Unsupported function: {value}"
 
         method = class_method_map[value.__class__]
-        argument_expressions = [
-            self.get_sql_element_or_value(arg) for arg in value.arguments
-        ]
         return method(*argument_expressions)
 
+    def first_row_strategy(self, row, selected_columns):
+        """
+        Return the cheapest strategy which correctly selects `selected_columns` from the
+        first row per patient of `row`, either:
+
+            "aggregate": MIN/MAX of the sort column
+            "window": ROW_NUMBER() over the sort columns
+
+        The same rules currently apply to every engine. Subclasses may override this to
+        refuse strategies which the database handles poorly, or to add their own (e.g.
+        CROSS APPLY with TOP 1 on MSSQL, or `min_by`/`max_by` on Spark). Note that TOP 1
+        with an ORDER BY sorts NULLs in the same way as ROW_NUMBER() over that ordering,
+        so unlike MIN/MAX it's correct in either direction.
+        """
+        if (
+            len(row.sort_columns) == 1
+            and selected_columns == set(row.sort_columns)
+            # MIN/MAX ignore NULLs, so they only give the same answer as sorting where
+            # NULLs sort last, which is in descending order (see
+            # `get_order_by_columns()`)
+            and row.descending
+        ):
+            return "aggregate"
+        return "window"
+
+    def as_date(self, value):
+        """
+        Return `value`, which may be a date column or a date given as a string, as an
+        expression of DATE type
+
+        By default we rely on the database to convert strings to dates implicitly.
+        """
+        return type_coerce(value, sqlalchemy_types.Date())
+
     def date_difference(self, start_date, end_date, units):
-        start_date = type_coerce(start_date, sqlalchemy_types.Date())
-        end_date = type_coerce(end_date, sqlalchemy_types.Date())
+        start_date = self.as_date(start_date)
+        end_date = self.as_date(end_date)
 
         # We do the arithmetic ourselves, to be portable across dbs.
         start = (
@@ -507,6 +1159,15 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         """
         raise NotImplementedError()
 
+    def get_index_queries(self, table, column_name):
+        """
+        Return any queries needed to index `table` on `column_name`
+
+        By default we don't create indexes: the databases we support either don't have
+        them or don't need them for the sorts of queries we run.
+        """
+        return []
+
     def temp_table_needs_dropping(self, create_table_query: Executable) -> bool:
         """
         Given the query used to create a temporary table, return whether the table needs
@@ -515,6 +1176,33 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         """
         raise NotImplementedError()
 
+    def can_create_tables_concurrently(self) -> bool:
+        """
+        Can we create temporary tables using several connections at once?
+
+        This is only possible if tables created by one connection are visible to the
+        others, which rules out the session-scoped temporary tables most databases
+        provide, and so by default we can't.
+        """
+        return False
+
+    def persists_intermediate_tables(self) -> bool:
+        """
+        Do we write intermediate tables to the temporary database, rather than
+        creating them as session-scoped temporary tables?
+
+        This is necessary to create them concurrently, and means that they can be
+        reused by a later attempt if an extraction fails part way through.
+        """
+        return self.can_create_tables_concurrently()
+
+    def get_drop_temp_table_query(self, table: TemporaryTable) -> Executable:
+        """
+        Return a query to drop `table` so that it can be recreated within the same
+        session, whether or not the database would otherwise discard it for us
+        """
+        return sqlalchemy.schema.DropTable(table, if_exists=True)
+
     #
     # DATABASE CONNECTION
     #
@@ -531,22 +1219,36 @@ class BaseSQLQueryEngine(BaseQueryEngine):
         assert isinstance(engine.dialect, self.sqlalchemy_dialect)
         return engine
 
-    def get_temp_table_name(self, name_hint):
+    def get_temp_table_name(self, name_hint, contents=None):
         """
         Return a table name based on `name_hint` suitable for use as a temporary table.
 
         `name_hint` is arbitrary and is only present to make the resulting SQL slightly
         more comprehensible when debugging.
+
+        `contents` is the query which populates the table, or the rows inserted into
+        it, if these alone determine what the table contains. Engines which keep their
+        tables beyond a single run can use this to give them names which identify
+        their contents.
         """
-        self.temp_table_count += 1
-        return f"{self.temp_table_prefix}{name_hint}_{self.temp_table_count}"
+        counter = self.shared_session or self
+        counter.temp_table_count += 1
+        return f"{self.temp_table_prefix}{name_hint}_{counter.temp_table_count}"
 
     def get_temp_database(self):
         """Which schema/database should we write temporary tables to."""
         return None
 
 
-def apply_filter(query, column, operator, value, value_query_node, or_null=False):
+def apply_filter(
+    query,
+    column,
+    operator,
+    value,
+    value_query_node,
+    or_null=False,
+    key_columns=("patient_id",),
+):
     """
     Applies a WHERE condition to the supplied query, specifically:
 
@@ -569,7 +1271,7 @@ def apply_filter(query, column, operator, value, value_query_node, or_null=False
         # If we have a "Value" (i.e. a single value per patient) then we
         # include the other tables in the join
         if isinstance(value_query_node, Value):
-            query = include_joined_tables(query, other_tables, "patient_id")
+            query = include_joined_tables(query, other_tables, key_columns)
         # If we have a "Column" (i.e. multiple values per patient) then we
         # can't directly join this with our single-value-per-patient query,
         # so we have to use a correlated subquery
@@ -582,7 +1284,13 @@ def apply_filter(query, column, operator, value, value_query_node, or_null=False
             value = (
                 sqlalchemy.select(value)
                 .select_from(other_table)
-                .where(other_table.c.patient_id == table_expr.c.patient_id)
+                .where(
+                    *[
+                        other_table.c[key_column] == table_expr.c[key_column]
+                        for key_column in key_columns
+                        if key_column in other_table.c
+                    ]
+                )
             )
         else:
             assert False
@@ -604,21 +1312,144 @@ def apply_filter(query, column, operator, value, value_query_node, or_null=False
     return query.where(filter_expr)
 
 
-def apply_optimisations(column_definitions):
+def apply_optimisations(column_definitions, first_row_strategy):
     """
     Apply various transformations to the supplied query DAG which make it easier to
     generate better performing SQL
+
+    `first_row_strategy` is the query engine's `first_row_strategy()` method.
+    """
+    graph = QueryGraph(column_definitions)
+
+    graph = consolidate_codelist_filters(graph)
+    graph = replace_rows_with_aggregates(graph, first_row_strategy)
+    graph = combine_aggregates_over_same_source(graph)
+    graph = combine_rows_over_same_source(graph)
+    graph = reify_query_before_selecting_column(graph)
+
+    return graph
+
+
+def consolidate_codelist_filters(graph):
+    """
+    Studies typically filter the same large table (e.g. `clinical_events`) by many
+    different codelists, and each of these filters would otherwise be a separate scan
+    over the whole table. Where we find several codelist filters on the same column of
+    the same source we first materialize the rows which match *any* of the codelists
+    and then apply each of the original filters to that (much smaller) table instead.
+    """
+    filters_by_source = defaultdict(list)
+    for node in graph:
+        if (
+            isinstance(node, FilteredTable)
+            and node.operator == "in_"
+            and isinstance(node.value, Codelist)
+            # Rows with NULL values are excluded from the combined table
+            and not node.or_null
+        ):
+            key = (node.source, node.column, node.value.system)
+            filters_by_source[key].append(node)
+
+    replacements = {}
+    for (source, column, system), filters in filters_by_source.items():
+        if len(filters) < 2:
+            continue
+        all_codes = {code for node in filters for code in node.value.codes}
+        combined_codelist = Codelist(tuple(sorted(all_codes)), system)
+        prefiltered = MaterializedTable(
+            FilteredTable(source, column, "in_", combined_codelist)
+        )
+        for node in filters:
+            replacements[node] = dataclasses.replace(node, source=prefiltered)
+    return graph.rewrite(replacements)
+
+
+def replace_rows_with_aggregates(graph, first_row_strategy):
     """
-    # It's algorithmically easier to apply these transformations by modifying the graph
-    # in place, so we copy it first
-    column_definitions = copy.deepcopy(column_definitions)
+    Selecting the first row per patient needs a window function and a sort over the
+    whole source. But where the only thing we select from the row is the column we're
+    sorting by (e.g. `earliest().get("date")`) the query engine may be able to use a
+    MIN/MAX aggregation instead, which is much cheaper. Where it says it can, we replace
+    the Row with the equivalent aggregation (which may then be combined with other
+    aggregations over the same source, see `combine_aggregates_over_same_source`).
+    """
+    replacements = {}
+    for node in graph:
+        if not isinstance(node, Row):
+            continue
+        selectors = graph.get_parents(node)
+        selected_columns = {selector.column for selector in selectors}
+        if first_row_strategy(node, selected_columns) != "aggregate":
+            continue
+        (column,) = node.sort_columns
+        function = "max" if node.descending else "min"
+        aggregate = RowFromAggregate(
+            node.source, function, column, f"{column}_{function}"
+        )
+        for selector in selectors:
+            replacements[selector] = ValueFromAggregate(
+                aggregate, aggregate.output_column
+            )
+    return graph.rewrite(replacements)
 
-    reify_query_before_selecting_column(column_definitions)
 
-    return column_definitions
+def combine_aggregates_over_same_source(graph):
+    """
+    Each call to `exists()`, `count()`, `sum()` etc. produces its own RowFromAggregate
+    node and hence its own GROUP BY query over the source. Where we have several
+    aggregations over the same source we replace them with a single RowFromAggregates
+    node which computes all of them in one query (and, after reification, one temporary
+    table).
+    """
+    aggregates_by_source = defaultdict(list)
+    for node in graph:
+        if isinstance(node, RowFromAggregate):
+            aggregates_by_source[node.source].append(node)
+
+    replacements = {}
+    for source, nodes in aggregates_by_source.items():
+        if len(nodes) < 2:
+            continue
+        combined = RowFromAggregates(
+            source,
+            tuple(
+                (node.function, node.input_column, node.output_column) for node in nodes
+            ),
+        )
+        for node in nodes:
+            replacements[node] = combined
+    return graph.rewrite(replacements)
+
+
+def combine_rows_over_same_source(graph):
+    """
+    It's very common to want e.g. both the first and the last matching event for a
+    patient, and each of these Row nodes would otherwise need its own sort over the
+    source. Where we have several Rows over the same source we instead number the rows
+    according to every ordering in a single pass over the source and write just the
+    rows which come first in any ordering to a temporary table. Each original Row then
+    becomes a cheap filter on its row number over that (small) table.
+    """
+    rows_by_source = defaultdict(list)
+    for node in graph:
+        if isinstance(node, Row):
+            rows_by_source[node.source].append(node)
+
+    replacements = {}
+    for source, rows in rows_by_source.items():
+        if len(rows) < 2:
+            continue
+        first_rows = MaterializedTable(
+            FirstRowsByOrdering(
+                source, tuple((row.sort_columns, row.descending) for row in rows)
+            )
+        )
+        for i, row in enumerate(rows):
+            replacements[row] = FilteredTable(first_rows, f"_row_num_{i}", "__eq__", 1)
+    return graph.rewrite(replacements)
 
 
-def reify_query_before_selecting_column(column_definitions):
+def reify_query_before_selecting_column(graph):
     """
     We sometimes need to be able to take a SQLAlchemy query and treat it as something
     table-like from which we can select columns (a process we describe as
@@ -632,30 +1463,102 @@ def reify_query_before_selecting_column(column_definitions):
     # Find all ColumnSelectorNodes and group them by the source node they reference
     selector_types = typing.get_args(ColumnSelectorNode)
     nodes_by_source = defaultdict(list)
-    for node in get_all_nodes(column_definitions):
+    for node in graph:
         if isinstance(node, selector_types):
             nodes_by_source[node.source].append(node)
     # Inject a ReifyQuery node between the ColumnSelectorNodes and their source
+    replacements = {}
     for source, child_nodes in nodes_by_source.items():
         # As an optimisation to avoid reifying more data than we need, we determine what
         # columns we're selecting and pass these to the reification method
-        columns = {node.column for node in child_nodes}
+        columns = sorted({node.column for node in child_nodes})
         new_source = ReifiedQuery(source, tuple(columns))
         for node in child_nodes:
-            # These are frozen instances, so we can't set the attribute directly
-            object.__setattr__(node, "source", new_source)
+            replacements[node] = dataclasses.replace(node, source=new_source)
+    return graph.rewrite(replacements)
 
 
-def get_all_nodes(column_definitions):
-    return list(recurse_over_nodes(column_definitions.values(), set()))
+def get_required_columns(graph):
+    """
+    Return a dict mapping each table name to the set of its columns which are referenced
+    anywhere in the graph
+    """
+    table_columns = defaultdict(set)
+    for node in graph:
+        if isinstance(node, FilteredTable):
+            columns = {node.column}
+            if isinstance(node.value, Codelist):
+                # Codelist filters also match on the `system` column, if there is one
+                columns.add("system")
+        elif isinstance(node, Row):
+            columns = set(node.sort_columns)
+        elif isinstance(node, FirstRowsByOrdering):
+            columns = {
+                column for sort_columns, _ in node.orderings for column in sort_columns
+            }
+        elif isinstance(node, RowFromAggregate):
+            columns = {node.input_column}
+        elif isinstance(node, RowFromAggregates):
+            columns = {input_column for _, input_column, _ in node.aggregates}
+        elif isinstance(node, (ValueFromRow, Column)):
+            columns = {node.column}
+        else:
+            # Other nodes either don't reference columns, or reference columns which
+            # were themselves selected by some other node (e.g. ReifiedQuery)
+            continue
+        table_columns[get_source_table(node).name].update(columns)
+    return dict(table_columns)
+
+
+def get_source_table(node):
+    """Return the Table node at the root of the chain of table-like nodes below `node`"""
+    source = node.source
+    while not isinstance(source, Table):
+        source = source.source
+    return source
+
+
+def run_in_dependency_order(dependencies, function, max_workers):
+    """
+    Call `function` on each of the keys of `dependencies`, with up to `max_workers`
+    calls running at once in separate threads
+
+    Each key maps to a list of the other keys which it depends on, and we don't call
+    `function` on a key until it has returned for each of them. Any exception raised
+    by `function` is re-raised here, once the calls already running have finished.
+    """
+    waiting = {item: set(depends_on) for item, depends_on in dependencies.items()}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            ready = [item for item, depends_on in waiting.items() if not depends_on]
+            for item in ready:
+                del waiting[item]
+                running[executor.submit(function, item)] = item
+            if not running:
+                raise ValueError("Dependencies contain a cycle")
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                item = running.pop(future)
+                future.result()
+                for depends_on in waiting.values():
+                    depends_on.discard(item)
 
 
-def recurse_over_nodes(nodes, seen):
-    for node in nodes:
-        yield from recurse_over_nodes(node._get_referenced_nodes(), seen)
-        if node not in seen:
-            seen.add(node)
-            yield node
+def split_range(start, end, parts):
+    """
+    Split the range of integers from `start` to (exclusive) `end` into at most `parts`
+    contiguous, non-empty ranges of as near equal size as possible, returned as (start,
+    end) pairs
+
+    An empty range is returned as a single empty range, rather than none at all.
+    """
+    boundaries = sorted({start + (end - start) * i // parts for i in range(parts + 1)})
+    if len(boundaries) == 1:
+        return [(start, end)]
+    return list(zip(boundaries[:-1], boundaries[1:]))
 
 
 def split_list_into_batches(lst, size=None):
@@ -0,0 +1,79 @@
+import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable, type_coerce
+from sqlalchemy.sql.visitors import InternalTraversal
+
+from .. import sqlalchemy_types
+from .base_sql import BaseSQLQueryEngine
+from .duckdb_dialect import DuckDBDialect
+
+
+class CreateTemporaryTableAs(Executable, ClauseElement):
+    # Allows SQLAlchemy to cache the compiled form of these queries
+    _traverse_internals = [
+        ("name", InternalTraversal.dp_string),
+        ("query", InternalTraversal.dp_clauseelement),
+    ]
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+
+    def __str__(self):
+        return str(self.query)
+
+    def get_children(self):
+        return (self.query,)
+
+
+@compiles(CreateTemporaryTableAs, "duckdb")
+def _create_temporary_table_as(element, compiler, **kw):
+    return "CREATE TEMPORARY TABLE {} AS {}".format(
+        compiler.preparer.quote(element.name),
+        compiler.process(element.query),
+    )
+
+
+class DuckDBQueryEngine(BaseSQLQueryEngine):
+    """
+    Query engine for running against an embedded DuckDB database, either a DuckDB
+    database file or a directory of Parquet files (see `DuckDBDialect`)
+    """
+
+    sqlalchemy_dialect = DuckDBDialect
+
+    temp_table_prefix = "tmp_"
+
+    def query_to_create_temp_table_from_select_query(self, table, select_query):
+        """
+        Return a query to create `table` and populate it with the results of
+        `select_query`
+        """
+        return CreateTemporaryTableAs(table.name, select_query)
+
+    def temp_table_needs_dropping(self, create_table_query):
+        # All the tables we create are session-scoped TEMPORARY tables which DuckDB
+        # discards when the connection closes
+        return False
+
+    def as_date(self, value):
+        # DuckDB won't implicitly convert a string to a DATE as an argument to a
+        # function like `month()`, so we cast explicitly
+        return type_coerce(
+            sqlalchemy.cast(value, sqlalchemy.Date), sqlalchemy_types.Date()
+        )
+
+    def round_to_first_of_month(self, date):
+        date = self.as_date(date)
+        # DuckDB's `date_trunc` returns a TIMESTAMP so we need to cast back to a DATE
+        first_of_month = sqlalchemy.cast(
+            sqlalchemy.func.date_trunc("month", date), sqlalchemy.Date
+        )
+        return type_coerce(first_of_month, sqlalchemy_types.Date())
+
+    def round_to_first_of_year(self, date):
+        date = self.as_date(date)
+        first_of_year = sqlalchemy.cast(
+            sqlalchemy.func.date_trunc("year", date), sqlalchemy.Date
+        )
+        return type_coerce(first_of_year, sqlalchemy_types.Date())
@@ -0,0 +1,70 @@
+"""
+Provides a SQLAlchemy Dialect for talking to an embedded DuckDB database which uses the
+dialect provided by duckdb_engine with a small layer of customisations on top.
+"""
+from pathlib import Path
+
+from duckdb_engine import Dialect as DuckDBEngineDialect
+from sqlalchemy.dialects.postgresql.base import PGDDLCompiler, PGTypeCompiler
+
+from ..sqlalchemy_utils import TemporaryTable
+
+
+class DuckDBTypeCompiler(PGTypeCompiler):
+    def _render_string_type(self, type_, name):
+        """
+        DuckDB doesn't know about the MSSQL-specific collations we attach to codelist
+        columns. But as DuckDB always compares strings byte-wise by default we can just
+        drop the collation and retain the same behaviour.
+        """
+        text = name
+        if type_.length:
+            text += "(%d)" % type_.length
+        return text
+
+
+class DuckDBDDLCompiler(PGDDLCompiler):
+    def visit_create_table(self, create, **kw):
+        """
+        Create our TemporaryTables (i.e. codelist tables) as session-scoped TEMPORARY
+        tables so that they never need cleaning up and never touch the main database,
+        which may well be read-only
+        """
+        sql = super().visit_create_table(create, **kw)
+        if isinstance(create.element, TemporaryTable):
+            sql = sql.replace("CREATE TABLE", "CREATE TEMPORARY TABLE", 1)
+        return sql
+
+
+class DuckDBDialect(DuckDBEngineDialect):
+    """Customisation of the duckdb_engine SQLAlchemy dialect.
+
+    As well as the DDL changes above, this lets us point the database URL at a
+    directory of Parquet files rather than at a DuckDB database file. In that case we
+    open an in-memory database and expose each `<table_name>.parquet` file as a view
+    named `<table_name>`.
+    """
+
+    supports_statement_cache = True
+    type_compiler = DuckDBTypeCompiler
+    ddl_compiler = DuckDBDDLCompiler
+
+    def connect(self, *cargs, **cparams):
+        database = cparams.get("database")
+        parquet_directory = None
+        if database and Path(database).is_dir():
+            parquet_directory = Path(database)
+            cparams["database"] = ":memory:"
+        connection = super().connect(*cargs, **cparams)
+        if parquet_directory is not None:
+            create_parquet_views(connection, parquet_directory)
+        return connection
+
+
+def create_parquet_views(connection, directory):
+    for path in sorted(directory.glob("*.parquet")):
+        view_name = path.stem.replace('"', '""')
+        path_literal = str(path).replace("'", "''")
+        connection.execute(
+            f"CREATE VIEW \"{view_name}\" AS SELECT * FROM read_parquet('{path_literal}')"
+        )
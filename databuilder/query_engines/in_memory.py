@@ -0,0 +1,594 @@
+"""
+This module provides a query engine which evaluates the Query Model directly against
+in-memory pandas DataFrames, rather than translating it into SQL and running it against
+a database server. It's intended for local runs over files of synthetic data, and as a
+reference implementation against which the SQL engines can be compared.
+
+Each backend table is read from a CSV or Parquet file in the directory given as the
+backend's `database_url`. `MappedTable`s are read from a file named after their
+`source` and use the source column names (exactly as they'd be laid out in the
+database); `QueryTable`s are read from a file named after the table itself, using the
+output column names.
+
+Query Model nodes are evaluated as follows:
+
+  * `Table`, `FilteredTable`, `Row` and `RowFromAggregate` nodes become DataFrames.
+    Filters are applied as boolean masks, rows are selected by sorting and then taking
+    the first row per patient, and aggregates are computed with a `groupby`.
+
+  * `Value` and `Comparator` nodes become Series indexed by patient_id. These are always
+    evaluated against an explicit index of patients, which mirrors the way the SQL
+    engines LEFT JOIN every column onto the population table.
+
+We follow SQL's three-valued logic throughout by using pandas' nullable "boolean" type,
+so that e.g. comparisons against missing values are neither true nor false.
+
+Dates are held as pandas Periods rather than Timestamps. Timestamps are limited to the
+years 1677-2262 which rules out the "9999-12-31" sentinel value that some backends use
+for open-ended date ranges.
+"""
+import contextlib
+import datetime
+import operator
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from ..functools_utils import singledispatchmethod_with_unions
+from ..query_graph import QueryGraph, get_parameter_dependent_nodes
+from ..query_model import (
+    Codelist,
+    Column,
+    Comparator,
+    DateDifference,
+    FilteredTable,
+    Parameter,
+    QueryNode,
+    RoundToFirstOfMonth,
+    RoundToFirstOfYear,
+    Row,
+    RowFromAggregate,
+    Table,
+    ValueFromAggregate,
+    ValueFromCategory,
+    ValueFromFunction,
+    ValueFromRow,
+)
+from .base import BaseQueryEngine, get_sample_hash
+
+FILE_EXTENSIONS = (".parquet", ".csv")
+
+# Period frequencies used to represent values of each of our date types
+DATE_FREQ = "D"
+DATETIME_FREQ = "S"
+
+
+class InMemoryQueryEngine(BaseQueryEngine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Evaluated table-like nodes, see `get_frame`
+        self.frame_cache: dict[QueryNode, pd.DataFrame] = {}
+        # Values of any `Parameter` nodes, see `execute_query`
+        self.parameters: dict[str, object] = {}
+        # Nodes whose values we must re-evaluate when the parameters change
+        self.parameter_dependent_nodes = get_parameter_dependent_nodes(
+            QueryGraph(self.column_definitions)
+        )
+
+    @contextlib.contextmanager
+    def execute_query(self, parameters=None):
+        if self.parameter_sets:
+            yield self.get_results_for_parameter_sets()
+        else:
+            self.set_parameters(parameters or {})
+            yield self.get_results()
+
+    def yields_results_in_patient_id_order(self):
+        # When we evaluate several sets of parameters there's a row for each of them
+        return not self.parameter_sets
+
+    def set_parameters(self, parameters):
+        if parameters != self.parameters:
+            # Anything we've already evaluated may depend on the old parameter values
+            self.frame_cache = {
+                node: frame
+                for node, frame in self.frame_cache.items()
+                if node not in self.parameter_dependent_nodes
+            }
+            self.parameters = dict(parameters)
+
+    def get_results_for_parameter_sets(self):
+        """
+        As `get_results()` but for each of the `parameter_sets` in turn, and with a
+        column for each parameter. Unlike the SQL engines we don't gain anything by
+        evaluating them all at once.
+        """
+        for parameters in self.parameter_sets:
+            self.set_parameters(parameters)
+            for row in self.get_results():
+                yield {"patient_id": row.pop("patient_id"), **parameters, **row}
+
+    def get_results(self):
+        """
+        Evaluate the column definitions and return an iterator of dicts, one per patient
+        in the population, ordered by patient_id
+        """
+        column_definitions = dict(self.column_definitions)
+        population_definition = column_definitions.pop("population")
+
+        # Evaluate the population condition for every patient in any of the tables it
+        # references and keep just those for whom it's true
+        candidates = self.get_patient_ids_for_tables(population_definition)
+        population = as_boolean(self.get_series(population_definition, candidates))
+        patient_ids = candidates[population.fillna(False).to_numpy(dtype=bool)]
+        if self.resume_after is not None:
+            patient_ids = patient_ids[patient_ids > self.resume_after]
+
+        columns = {
+            name: to_python_values(self.get_series(definition, patient_ids))
+            for name, definition in column_definitions.items()
+        }
+        for n, patient_id in enumerate(patient_ids):
+            row = {"patient_id": int(patient_id)}
+            for name, values in columns.items():
+                row[name] = values[n]
+            yield row
+
+    def get_patient_ids_for_tables(self, node):
+        """
+        Return a sorted index of all patient_ids in all tables referenced by `node`
+        """
+        tables = [
+            referenced
+            for referenced in walk_nodes(node)
+            if isinstance(referenced, Table)
+        ]
+        patient_ids = [self.get_frame(table)["patient_id"] for table in tables]
+        return pd.Index(np.unique(np.concatenate(patient_ids)), name="patient_id")
+
+    #
+    # TABLE-LIKE NODES
+    #
+    def get_frame(self, node):
+        """
+        Caching wrapper around `get_frame_no_cache()`: we want each table-like node to
+        be evaluated at most once, however many times it's referenced
+        """
+        if node in self.frame_cache:
+            return self.frame_cache[node]
+        else:
+            frame = self.get_frame_no_cache(node)
+            self.frame_cache[node] = frame
+            return frame
+
+    @singledispatchmethod_with_unions
+    def get_frame_no_cache(self, node):
+        raise TypeError(f"Unhandled query node type: {node!r}")
+
+    @get_frame_no_cache.register
+    def get_frame_from_table(self, node: Table):
+        table = self.backend.tables[node.name]
+        frame = read_table(Path(self.backend.database_url), node.name, table)
+        if self.sample_percent is not None:
+            patient_hash = get_sample_hash(frame["patient_id"].astype("int64"))
+            frame = frame[patient_hash < self.get_sample_threshold()]
+        return frame
+
+    @get_frame_no_cache.register
+    def get_frame_from_filtered_table(self, node: FilteredTable):
+        frame = self.get_frame(node.source)
+        column = frame[node.column]
+
+        if isinstance(node.value, Codelist):
+            matches = self.filter_by_codelist(frame, column, node.operator, node.value)
+        elif isinstance(node.value, Column):
+            matches = self.filter_by_column(frame, column, node.operator, node.value)
+        else:
+            # Values are evaluated for each patient in this frame and then broadcast out
+            # to each of that patient's rows
+            value = self.get_series_or_value(
+                node.value, pd.Index(frame["patient_id"].unique())
+            )
+            if isinstance(value, pd.Series):
+                value = pd.Series(value.reindex(frame["patient_id"]).array, frame.index)
+            if node.operator in ("in_", "not_in"):
+                matches = isin(column, value)
+                if node.operator == "not_in":
+                    matches = ~matches
+            else:
+                matches = compare(column, node.operator, value)
+
+        mask = matches.fillna(False).to_numpy(dtype=bool)
+        if node.or_null:
+            mask |= column.isna().to_numpy()
+        return frame[mask]
+
+    def filter_by_codelist(self, frame, column, operator_name, codelist):
+        matches = isin(column, codelist.codes)
+        # Codelist queries must also match on `system` column if it's present. Note
+        # that, as in SQL, a `NOT IN` filter against a codelist for a different system
+        # matches everything.
+        if "system" in frame.columns:
+            system_matches = (frame["system"] == codelist.system).to_numpy()
+            matches[~system_matches] = False
+        if operator_name == "not_in":
+            matches = ~matches
+        else:
+            assert operator_name == "in_"
+        return matches
+
+    def filter_by_column(self, frame, column, operator_name, value):
+        # A Column has multiple values per patient, so we match each row against the
+        # set of values the other table holds for that same patient
+        other = self.get_frame(value.source)
+        other = other[other[value.column].notna()]
+        other_keys = pd.MultiIndex.from_arrays(
+            [other["patient_id"].array, other[value.column].array]
+        )
+        keys = pd.MultiIndex.from_arrays([frame["patient_id"].array, column.array])
+        matches = with_nulls(pd.Series(keys.isin(other_keys), frame.index), column)
+        if operator_name == "not_in":
+            matches = ~matches
+        else:
+            assert operator_name == "in_"
+        return matches
+
+    @get_frame_no_cache.register
+    def get_frame_from_row(self, node: Row):
+        frame = self.get_frame(node.source)
+        # Null values sort first in ascending order and last in descending order, as
+        # in the SQL query engines (see `get_order_by_columns()`)
+        frame = frame.sort_values(
+            list(node.sort_columns),
+            ascending=not node.descending,
+            na_position="last" if node.descending else "first",
+            kind="mergesort",
+        )
+        frame = frame.drop_duplicates("patient_id", keep="first")
+        frame.index = pd.Index(frame["patient_id"].to_numpy())
+        return frame
+
+    @get_frame_no_cache.register
+    def get_frame_from_row_from_aggregate(self, node: RowFromAggregate):
+        frame = self.get_frame(node.source)
+        grouped = frame.groupby("patient_id", sort=True)[node.input_column]
+        if node.function == "exists":
+            patient_ids = np.unique(frame["patient_id"])
+            values = pd.Series(True, index=patient_ids, dtype="boolean")
+        elif node.function == "count":
+            values = grouped.count().astype("Int64")
+        elif node.function == "sum":
+            # As in SQL, the sum of nothing but nulls is null
+            values = grouped.sum(min_count=1)
+        else:
+            values = getattr(grouped, node.function)()
+        values.index = pd.Index(values.index.to_numpy())
+        return values.to_frame(node.output_column)
+
+    #
+    # VALUE NODES
+    #
+    def get_series_or_value(self, value, index):
+        """
+        As with `BaseSQLQueryEngine.get_sql_element_or_value`, certain places in the
+        Query Model accept either QueryNodes or plain static values
+        """
+        if isinstance(value, Parameter):
+            return self.parameters[value.name]
+        elif isinstance(value, QueryNode):
+            return self.get_series(value, index)
+        else:
+            return value
+
+    @singledispatchmethod_with_unions
+    def get_series(self, node, index):
+        """
+        Given a QueryNode which represents a single value per patient return a Series of
+        those values for each patient in `index`
+        """
+        raise TypeError(f"Unhandled query node type: {node!r}")
+
+    @get_series.register
+    def get_series_from_value(
+        self, node: Union[ValueFromRow, ValueFromAggregate], index
+    ):
+        frame = self.get_frame(node.source)
+        return frame[node.column].reindex(index)
+
+    @get_series.register
+    def get_series_from_comparator(self, node: Comparator, index):
+        if node.connector is not None:
+            assert node.operator is None
+            lhs = as_boolean(self.get_series(node.lhs, index))
+            rhs = as_boolean(self.get_series(node.rhs, index))
+            if node.connector == "and_":
+                result = lhs & rhs
+            elif node.connector == "or_":
+                result = lhs | rhs
+            else:
+                assert False
+        else:
+            lhs = self.get_series_or_value(node.lhs, index)
+            rhs = self.get_series_or_value(node.rhs, index)
+            result = compare(lhs, node.operator, rhs)
+
+        if node.negated:
+            result = ~result
+        return result
+
+    @get_series.register
+    def get_series_from_category(self, node: ValueFromCategory, index):
+        result = pd.Series(node.default, index=index, dtype=object)
+        unmatched = np.ones(len(index), dtype=bool)
+        # As with a CASE expression, each patient gets the first matching category
+        for label, condition in node.definitions.items():
+            matches = as_boolean(self.get_series(condition, index))
+            matches = matches.fillna(False).to_numpy(dtype=bool) & unmatched
+            result[matches] = label
+            unmatched &= ~matches
+        return result
+
+    @get_series.register
+    def get_series_from_function(self, node: ValueFromFunction, index):
+        class_method_map = {
+            DateDifference: self.date_difference,
+            RoundToFirstOfMonth: self.round_to_first_of_month,
+            RoundToFirstOfYear: self.round_to_first_of_year,
+        }
+
+        assert node.__class__ in class_method_map, f"Unsupported function: {node}"
+
+        method = class_method_map[node.__class__]
+        arguments = [self.get_series_or_value(arg, index) for arg in node.arguments]
+        return method(index, *arguments)
+
+    def date_difference(self, index, start_date, end_date, units):
+        start_year, start_month, start_day = get_date_parts(start_date, index)
+        end_year, end_month, end_day = get_date_parts(end_date, index)
+        year_diff = end_year - start_year
+        # Each of these is false (i.e. we subtract one) where the final year or month
+        # is incomplete. We do the same arithmetic as the SQL engines, see
+        # `BaseSQLQueryEngine.date_difference`.
+        if units == "years":
+            complete = (end_month > start_month) | (
+                (end_month == start_month) & (end_day >= start_day)
+            )
+            return year_diff - (~complete).astype("Int64")
+        elif units == "months":
+            complete = end_day >= start_day
+            month_diff = year_diff * 12 + (end_month - start_month)
+            return month_diff - (~complete).astype("Int64")
+        else:
+            assert False, f"Unsupported units: {units}"
+
+    def round_to_first_of_month(self, index, date):
+        date = as_date_series(date, index)
+        return date.dt.asfreq("M").dt.asfreq(DATE_FREQ, how="start")
+
+    def round_to_first_of_year(self, index, date):
+        date = as_date_series(date, index)
+        return date.dt.asfreq("Y").dt.asfreq(DATE_FREQ, how="start")
+
+
+def walk_nodes(node):
+    """
+    Yield `node` and every node it references, directly or indirectly, once each
+    """
+    seen = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        yield node
+        stack.extend(node._get_referenced_nodes())
+
+
+#
+# READING TABLES
+#
+def read_table(directory, name, table):
+    """
+    Read the backend table `name` from its file in `directory` and return it as a
+    DataFrame with the table's declared columns, converted to the appropriate types
+    """
+    # Avoid a circular import: backends import their query engines
+    from ..backends.base import MappedTable
+
+    if isinstance(table, MappedTable):
+        file_stem = table.source
+        source_columns = {
+            column_name: column.source or column_name
+            for column_name, column in table.columns.items()
+        }
+    else:
+        file_stem = name
+        source_columns = {column_name: column_name for column_name in table.columns}
+
+    path = find_table_file(directory, file_stem)
+    usecols = list(dict.fromkeys(source_columns.values()))
+    if path.suffix == ".parquet":
+        raw = pd.read_parquet(path, columns=usecols)
+    else:
+        raw = pd.read_csv(
+            path, usecols=usecols, dtype=str, keep_default_na=False, na_values=[""]
+        )
+
+    frame = pd.DataFrame(
+        {
+            column_name: convert_column(
+                raw[source_columns[column_name]], table.columns[column_name].type
+            )
+            for column_name in table.columns
+        },
+        index=pd.RangeIndex(len(raw)),
+    )
+    # Patient IDs are never null so we use a plain integer type, which makes them
+    # easier to use as an index
+    frame["patient_id"] = frame["patient_id"].astype("int64")
+    return frame
+
+
+def find_table_file(directory, file_stem):
+    for extension in FILE_EXTENSIONS:
+        path = directory / f"{file_stem}{extension}"
+        if path.exists():
+            return path
+    raise FileNotFoundError(
+        f"No file found for table '{file_stem}' in {directory} "
+        f"(expected one of: {', '.join(FILE_EXTENSIONS)})"
+    )
+
+
+def convert_column(values, type_name):
+    """
+    Convert a Series of raw values (strings, if we're reading CSV) into the type we use
+    to represent the given backend column type
+    """
+    values = values.where(values.notna(), None)
+    if type_name == "date":
+        return pd.Series(pd.array(values.to_numpy(), dtype=f"period[{DATE_FREQ}]"))
+    elif type_name == "datetime":
+        return pd.Series(pd.array(values.to_numpy(), dtype=f"period[{DATETIME_FREQ}]"))
+    elif type_name == "integer":
+        return pd.to_numeric(values).astype("Int64")
+    elif type_name == "float":
+        return pd.to_numeric(values).astype("float64")
+    elif type_name == "boolean":
+        return values.map(parse_boolean, na_action="ignore").astype("boolean")
+    elif type_name in ("varchar", "code"):
+        return values.astype(object)
+    else:
+        assert False, f"Unhandled column type: {type_name}"
+
+
+def parse_boolean(value):
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    value = str(value).strip().lower()
+    if value in ("1", "t", "true"):
+        return True
+    elif value in ("0", "f", "false"):
+        return False
+    else:
+        raise ValueError(f"Invalid boolean value: {value!r}")
+
+
+#
+# OPERATIONS ON SERIES
+#
+def compare(lhs, operator_name, rhs):
+    """
+    Apply a comparison operator (e.g. "__lt__") to a pair of Series or static values,
+    returning a nullable boolean Series which is null wherever either side is null
+    """
+    # SQLAlchemy translates comparisons against None into IS (NOT) NULL
+    if rhs is None:
+        if operator_name == "__eq__":
+            return lhs.isna().astype("boolean")
+        elif operator_name == "__ne__":
+            return lhs.notna().astype("boolean")
+
+    lhs, rhs = coerce_operands(lhs, rhs)
+    function = getattr(operator, operator_name.strip("_"))
+    valid = lhs.notna()
+    if isinstance(rhs, pd.Series):
+        valid &= rhs.notna()
+        rhs = rhs[valid]
+    result = pd.Series(pd.NA, index=lhs.index, dtype="boolean")
+    result[valid] = function(lhs[valid], rhs).astype(bool)
+    return result
+
+
+def isin(column, values):
+    values = [coerce_operands(column, value)[1] for value in values]
+    return with_nulls(column.isin(values).astype("boolean"), column)
+
+
+def with_nulls(result, column):
+    """
+    As in SQL, testing membership of a null value gives a null result
+    """
+    result = result.astype("boolean")
+    result[column.isna().to_numpy()] = pd.NA
+    return result
+
+
+def coerce_operands(lhs, rhs):
+    """
+    Convert static date values (e.g. ISO date strings) into Periods so they can be
+    compared against date Series
+    """
+    if isinstance(rhs, pd.Series) and is_date(rhs) and is_date(lhs):
+        if lhs.dt.freq != rhs.dt.freq:
+            lhs = lhs.dt.asfreq(DATE_FREQ)
+            rhs = rhs.dt.asfreq(DATE_FREQ)
+    elif isinstance(rhs, (str, datetime.date)) and is_date(lhs):
+        rhs = pd.Period(rhs, freq=lhs.dt.freq)
+    return lhs, rhs
+
+
+def is_date(values):
+    return isinstance(values, pd.Series) and isinstance(values.dtype, pd.PeriodDtype)
+
+
+def as_boolean(values):
+    if values.dtype != "boolean":
+        values = values.astype("boolean")
+    return values
+
+
+def as_date_series(value, index):
+    """
+    Return a Series of Periods given either a Series or a static date value
+    """
+    if isinstance(value, pd.Series):
+        return value
+    period = pd.Period(value, freq=DATE_FREQ)
+    return pd.Series(
+        pd.array([period] * len(index), dtype=f"period[{DATE_FREQ}]"), index=index
+    )
+
+
+def get_date_parts(value, index):
+    """
+    Return year, month and day for each value as nullable integer Series
+    """
+    value = as_date_series(value, index)
+    null = value.isna()
+    return tuple(
+        getattr(value.dt, part).astype("Int64").mask(null)
+        for part in ("year", "month", "day")
+    )
+
+
+def to_python_values(values):
+    """
+    Convert a Series to a list of standard Python values, with None for nulls
+    """
+    if is_date(values):
+        if values.dt.freq == pd.Period("2000-01-01", DATE_FREQ).freq:
+            convert = period_to_date
+        else:
+            convert = period_to_datetime
+    else:
+        convert = numpy_to_python
+    return [None if pd.isna(value) else convert(value) for value in values]
+
+
+def period_to_date(period):
+    return datetime.date(period.year, period.month, period.day)
+
+
+def period_to_datetime(period):
+    return datetime.datetime(
+        period.year, period.month, period.day, period.hour, period.minute, period.second
+    )
+
+
+def numpy_to_python(value):
+    # Convert numpy scalars (e.g. numpy.int64) to their Python equivalents
+    return value.item() if isinstance(value, np.generic) else value
@@ -1,13 +1,31 @@
 import contextlib
+import datetime
+import logging
+import secrets
+from functools import cached_property
 
 import sqlalchemy
 import sqlalchemy.sql.ddl
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.sql.expression import type_coerce
 
 from .. import sqlalchemy_types
+from ..sqlalchemy_utils import get_temporary_tables_in_setup_order
 from .base_sql import BaseSQLQueryEngine
 from .mssql_dialect import MSSQLDialect
-from .mssql_lib import fetch_results_in_batches, write_query_to_table
+from .mssql_lib import (
+    create_table_if_not_exists,
+    evict_cache_entries,
+    fetch_results_in_batches,
+    get_contents_hash,
+    is_already_exists_error,
+    make_cache_entries_table,
+    record_cache_use,
+    table_exists,
+    write_query_to_table,
+)
+
+log = logging.getLogger(__name__)
 
 
 class MssqlQueryEngine(BaseSQLQueryEngine):
@@ -22,6 +40,39 @@ class MssqlQueryEngine(BaseSQLQueryEngine):
     # temporary tables
     temp_table_prefix = "#"
 
+    # MSSQL doesn't support NULLS FIRST/LAST, but it already sorts NULL as the lowest
+    # value
+    explicit_nulls_order = False
+
+    # Limits on the size of the cache of intermediate tables shared between jobs (see
+    # `uses_shared_cache()`). We can't tell whether another job is still reading from
+    # a table, so we never evict anything used more recently than `min_age`.
+    shared_cache_max_tables = 1000
+    shared_cache_max_age = datetime.timedelta(days=7)
+    shared_cache_min_age = datetime.timedelta(days=1)
+
+    # Results are downloaded in batches which start at `batch_size` rows (a value
+    # copied from the previous cohortextractor) and are then adjusted within these
+    # bounds to maximise throughput, see `BatchSizer`
+    batch_size = 32000
+    min_batch_size = 4000
+    max_batch_size = 256000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Names of the tables which, if they already exist, we can assume were
+        # created by an earlier attempt at this same extraction
+        self.resumable_table_names = set()
+        if self.persists_intermediate_tables():
+            # Session-scoped tables aren't visible to other connections, and don't
+            # survive the connection dropping, so we use regular tables in the
+            # temporary database instead, with a unique prefix. Including the date
+            # makes it easier to clean these up by hand later if we have to.
+            self.temp_table_prefix = "TempSetup_{today}_{random}_".format(
+                today=datetime.date.today().strftime("%Y%m%d"),
+                random=secrets.token_hex(6),
+            )
+
     def query_to_create_temp_table_from_select_query(self, table, select_query):
         """
         Return a query to create `table` and populate it with the results of
@@ -29,12 +80,35 @@ class MssqlQueryEngine(BaseSQLQueryEngine):
         """
         return write_query_to_table(table, select_query)
 
+    def get_index_queries(self, table, column_name):
+        index = sqlalchemy.Index(
+            f"ix_{column_name}",
+            table.c[column_name],
+            mssql_clustered=True,
+        )
+        return [sqlalchemy.schema.CreateIndex(index)]
+
     def temp_table_needs_dropping(self, create_table_query):
         """
-        We're expecting to only ever create tables with the special "#" prefix which
-        marks them as session-scoped temporary tables which don't require cleanup. This
-        method just asserts that this expectation is met.
+        Unless we're persisting intermediate tables, we're expecting to only ever create
+        tables with the special "#" prefix which marks them as session-scoped temporary
+        tables which don't require cleanup. This method just asserts that this
+        expectation is met.
         """
+        if self.persists_intermediate_tables():
+            # Except that tables in the shared cache are left for other jobs to use,
+            # and are only dropped when they're evicted
+            if not self.uses_shared_cache():
+                return True
+            if isinstance(create_table_query, sqlalchemy.sql.Select):
+                # See `write_query_to_table()`
+                into_clause = create_table_query.selected_columns[0].name
+                table_name = into_clause.rsplit(".", 1)[-1]
+            else:
+                table_name = create_table_query.element.name
+            # When we're using the shared cache, the tables named after their
+            # contents are exactly those in the cache
+            return table_name not in self.resumable_table_names
         if isinstance(create_table_query, sqlalchemy.sql.Select):
             into_clause = create_table_query.selected_columns[0].name
             assert into_clause.startswith("* INTO #")
@@ -46,37 +120,239 @@ class MssqlQueryEngine(BaseSQLQueryEngine):
 
         return False
 
+    def persists_intermediate_tables(self):
+        """
+        We write our intermediate tables to the temporary database, if we've got one,
+        when we've been asked to create them concurrently, to share them with other
+        jobs, or to leave them for a later attempt if the extraction fails
+        """
+        return bool(self.backend.temporary_database) and (
+            self.setup_connections > 1
+            or self.shared_cache
+            or self.resume_key is not None
+        )
+
+    def uses_shared_cache(self):
+        """
+        If asked to, we keep those intermediate tables which are named after their
+        contents in the temporary database after we're done with them. Any other job
+        which needs a table with the same contents (for instance, the same codelist,
+        or events filtered by it) can then just use ours, as with a resumed extraction.
+        We record when each table was created and last used, evict any table once
+        it's too old, and evict the least recently used tables once there are too
+        many.
+
+        Note that the tables are identified only by the queries which populate them
+        (and the name of the database), so we can't tell when the data in the database
+        has been refreshed: a table may be reused with stale contents until it's
+        evicted, which is at most `shared_cache_max_age` after it was created.
+        """
+        return self.shared_cache and self.persists_intermediate_tables()
+
+    @cached_property
+    def cache_entries_table(self):
+        return make_cache_entries_table(self.get_temp_database())
+
+    def can_create_tables_concurrently(self):
+        return self.persists_intermediate_tables() and self.setup_connections > 1
+
+    def get_temp_database(self):
+        if self.persists_intermediate_tables():
+            return f"{self.backend.temporary_database}.dbo"
+        return None
+
+    def get_temp_table_name(self, name_hint, contents=None):
+        """
+        Where a table's contents are fully determined by the query or rows which
+        populate it, we name it after a hash of those contents. If an extraction fails
+        part way through and is then re-run with the same `resume_key`, it will
+        generate the same names and so can pick up any tables the previous attempt
+        finished creating.
+
+        Including the key means that no other extraction, even a concurrent one with
+        an identical query, can use (and so drop) the same table, which would be
+        unsafe as we drop these tables once we're done with them. The exception is
+        the shared cache, whose tables are only dropped on eviction.
+        """
+        if not self.persists_intermediate_tables() or contents is None:
+            return super().get_temp_table_name(name_hint, contents)
+        if self.uses_shared_cache():
+            contents_hash = get_contents_hash(self.engine, contents)
+            table_name = f"TempCache_{name_hint}_{contents_hash}"
+        elif self.resume_key is not None:
+            contents_hash = get_contents_hash(
+                self.engine, contents, key=self.resume_key
+            )
+            table_name = f"TempSetup_{name_hint}_{contents_hash}"
+        else:
+            return super().get_temp_table_name(name_hint, contents)
+        self.resumable_table_names.add(table_name)
+        return table_name
+
+    def create_table(self, connection, table, parameters):
+        if table.name not in self.resumable_table_names:
+            return super().create_table(connection, table, parameters)
+        if table_exists(connection, table):
+            log.info(f"Found pre-existing table '{table.name}', skipping its creation")
+            self.record_cache_use(connection, table, hit=True)
+            return
+        # Create and populate the table within an explicit transaction so we can't
+        # end up in a state where the table exists but is half-populated. We have to
+        # commit the existing implicit transaction before we can start the new one.
+        connection.commit()
+        try:
+            with connection.begin():
+                super().create_table(connection, table, parameters)
+                self.record_cache_use(connection, table, hit=False)
+        except DBAPIError as e:
+            # Another job has just created the same table, which we can use instead
+            if not is_already_exists_error(e):
+                raise
+            log.info(f"Table '{table.name}' was created concurrently, using that")
+            self.record_cache_use(connection, table, hit=True)
+
+    def record_cache_use(self, connection, table, hit):
+        if not self.uses_shared_cache():
+            return
+        record_cache_use(
+            connection,
+            self.cache_entries_table,
+            table.name,
+            datetime.datetime.utcnow(),
+            hit,
+        )
+        if hit:
+            connection.commit()
+
+    def evict_from_shared_cache(self):
+        with self.engine.connect() as connection:
+            evict_cache_entries(
+                connection,
+                self.cache_entries_table,
+                datetime.datetime.utcnow(),
+                max_tables=self.shared_cache_max_tables,
+                max_age=self.shared_cache_max_age,
+                min_age=self.shared_cache_min_age,
+            )
+
     @contextlib.contextmanager
-    def execute_query(self):
+    def execute_query(self, parameters=None):
         """Execute a query against an MSSQL backend"""
-        if self.backend.temporary_database:
+        if self.uses_shared_cache():
+            with self.engine.connect() as connection:
+                create_table_if_not_exists(connection, self.cache_entries_table)
+        with super().execute_query(parameters) as results:
+            yield results
+        if self.uses_shared_cache():
+            self.evict_from_shared_cache()
+
+    @contextlib.contextmanager
+    def execute_query_for_shard(self, parameters=None):
+        # The batched download pages through the results by patient_id, which isn't
+        # unique when we evaluate several sets of parameters at once
+        if self.backend.temporary_database and not self.parameter_sets:
             # If we've got access to a temporary database then we use this
             # function to manage storing our results in there and downloading
             # in batches. This gives us the illusion of having a robust
             # connection to the database, whereas in practice in frequently
             # errors out when attempting to download large sets of results.
-            setup_queries, results_query, cleanup_queries = self.get_queries()
-            # We're not expecting to have any cleanup to do here because we should be
-            # using session-scoped temporary tables
-            assert not cleanup_queries
+            setup_queries, results_query, _ = self.queries
+            # Outside of a session, each execution gets a session of its own
+            in_session = self.current_session is not None
+            with contextlib.nullcontext() if in_session else self.session():
+                with self.fetch_results_in_session(
+                    setup_queries, results_query, parameters or {}
+                ) as results:
+                    yield results
+        else:
+            # Otherwise we just execute the queries and download the results in
+            # the normal manner
+            with super().execute_query_for_shard(parameters) as results:
+                yield results
+
+    @contextlib.contextmanager
+    def fetch_results_in_session(self, setup_queries, results_query, parameters):
+        """
+        Download the results in batches (see `execute_query_for_shard()`), creating
+        just those tables which we haven't already kept in the current session from an
+        earlier execution, and keeping any we can for the next one
+
+        Tables in the temporary database are visible to every connection, so
+        `fetch_results_in_batches()` can create them on its own connection. But
+        session-scoped temporary tables have to be created, and the results query run,
+        on the session's connection if later executions are to see them.
+        """
+        session = self.current_session
+        tables = [
+            table
+            for table in get_temporary_tables_in_setup_order(results_query)
+            if table not in session.tables
+        ]
+        created = []
+
+        def run_preparatory_queries(connection):
+            if self.can_create_tables_concurrently():
+                self.create_tables_concurrently(tables, parameters)
+            else:
+                for table in tables:
+                    self.create_table(connection, table, parameters)
+            created.extend(tables)
+
+        succeeded = False
+        try:
             with fetch_results_in_batches(
                 engine=self.engine,
                 queries=setup_queries + [results_query],
-                # The double dot syntax allows us to reference tables in another database
+                parameters=parameters,
+                run_preparatory_queries=run_preparatory_queries,
+                download_connections=self.download_connections,
+                setup_connection=(
+                    None if self.persists_intermediate_tables() else session.connection
+                ),
+                start_key=self.resume_after,
+                # The double dot syntax allows us to reference tables in another
+                # database
                 temp_table_prefix=f"{self.backend.temporary_database}..TempExtract",
-                # This value was copied from the previous cohortextractor. I
-                # suspect it has no real scientific basis.
-                batch_size=32000,
+                batch_size=self.batch_size,
+                min_batch_size=self.min_batch_size,
+                max_batch_size=self.max_batch_size,
+                prefetch=True,
                 max_retries=2,
                 sleep=0.5,
                 reconnect_on_error=True,
             ) as results:
                 yield results
-        else:
-            # Otherwise we just execute the queries and download the results in
-            # the normal manner
-            with super().execute_query() as results:
-                yield results
+            succeeded = True
+        finally:
+            if succeeded:
+                # If we found the results already downloaded from an earlier attempt
+                # then we didn't create anything, and so have nothing to keep
+                disposable_tables = []
+                for table in created:
+                    if self.can_keep_table(table, session):
+                        session.keep_table(table)
+                    else:
+                        disposable_tables.append(table)
+                self.drop_tables(disposable_tables, keep=set())
+            else:
+                # If anything went wrong we leave the tables named after their contents
+                # in place so that the next attempt can reuse them, but we always drop
+                # the rest as nothing else can use them
+                self.drop_tables(tables, keep=self.resumable_table_names)
+
+    def drop_tables(self, tables, keep):
+        """
+        Run the cleanup queries for each of `tables`, except those named in `keep`
+        """
+        if not any(table.cleanup_queries for table in tables):
+            return
+        with self.engine.connect() as connection:
+            for table in reversed(tables):
+                if table.name in keep:
+                    continue
+                for query in table.cleanup_queries:
+                    connection.execute(query)
+            connection.commit()
 
     def round_to_first_of_month(self, date):
         date = type_coerce(date, sqlalchemy_types.Date())
@@ -65,6 +65,8 @@ class MSSQLDateTime(_MSSQLDateTimeBase, sqlalchemy.types.TypeDecorator):
 
 
 class MSSQLDialect(MSDialect_pymssql):
+    supports_statement_cache = True
+
     colspecs = MSDialect_pymssql.colspecs | {
         sqlalchemy.types.Date: MSSQLDate,
         sqlalchemy.types.DateTime: MSSQLDateTime,
@@ -1,11 +1,17 @@
 import contextlib
 import hashlib
 import logging
+import math
+import queue
 import secrets
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy
 
+from ..sqlalchemy_utils import get_bind_parameters
+
 log = logging.getLogger(__name__)
 
 
@@ -22,7 +28,7 @@ def write_query_to_table(table, query):
     # query directly into a temporary table. We can trick SQLAlchemy
     # into generating this for us by giving it a literal column named
     # "* INTO table_name".
-    into_table = sqlalchemy.literal_column(f"* INTO {table.name}")
+    into_table = sqlalchemy.literal_column(f"* INTO {table.fullname}")
     return sqlalchemy.select(into_table).select_from(query.alias())
 
 
@@ -32,6 +38,10 @@ def fetch_results_in_batches(
     queries,
     temp_table_prefix=None,
     key_column="patient_id",
+    parameters=None,
+    run_preparatory_queries=None,
+    download_connections=1,
+    setup_connection=None,
     **batch_fetch_config,
 ):
     """
@@ -54,6 +64,21 @@ def fetch_results_in_batches(
 
         key_column: name of a unique integer column in the results, used for paging
 
+        parameters: dict of values for any bind parameters in the queries
+
+        run_preparatory_queries: function which takes the connection and runs all
+            but the final query, for when they can't simply be run one after another
+            on that connection
+
+        download_connections: how many connections to use at once to download the
+            results (see `fetch_table_in_parallel`); more than one can't be used
+            with session-scoped temporary tables
+
+        setup_connection: an open connection on which to run the queries (though not
+            to download the results), for when they use session-scoped temporary
+            tables created on it earlier; by default we use the same connection as
+            for downloading
+
         batch_size: how many results to fetch in each batch
 
         max_retries: how many *sequential* failures to retry after
@@ -64,46 +89,66 @@ def fetch_results_in_batches(
             after each error; this is robust against more forms of failure, but
             can't be used with session-scoped temporary tables for obvious
             reasons
+
+        start_key: if supplied, only fetch results whose key is greater than this
     """
     preparatory_queries = queries[:-1]
     select_query = queries[-1]
+    parameters = parameters or {}
     assert isinstance(select_query, sqlalchemy.sql.expression.Select)
 
     with ReconnectableConnection(engine) as connection:
+        if setup_connection is None:
+            setup_connection = connection
         # The temporary table name we use contains a hash of all the queries.
         # This not only gives us uniqueness but it means that if the download
         # fails and we have to retry as a new job we can pick up the previously
         # generated results and download them without having to run potentially
         # several hours' worth of queries
-        query_hash = get_query_hash(connection, queries)
+        query_hash = get_query_hash(setup_connection, queries, parameters)
         table_name = f"{temp_table_prefix}_{query_hash}"
         table = make_table_with_key(table_name, key_column)
-        if table_exists(connection, table):
+        if table_exists(setup_connection, table):
             log.info(f"Found pre-existing cache, fetching results from '{table_name}'")
         else:
             log.info(f"No pre-existing cache, will store results in '{table_name}'")
             # Check this before we start running hours' worth of queries
-            assert_temporary_tables_writable(connection, temp_table_prefix)
-            for n, query in enumerate(preparatory_queries):
-                log.info(f"Running query {n}/{len(queries)}")
-                connection.execute(query)
+            assert_temporary_tables_writable(setup_connection, temp_table_prefix)
+            if run_preparatory_queries is not None:
+                log.info(f"Running {len(preparatory_queries)} queries")
+                run_preparatory_queries(setup_connection)
+            else:
+                for n, query in enumerate(preparatory_queries):
+                    log.info(f"Running query {n}/{len(queries)}")
+                    setup_connection.execute(
+                        query, get_bind_parameters(query, parameters)
+                    )
             # Run the write to temporary table within an explicit transaction
             # so we can't end up in a state where the table exists but is
             # half-populated. We have to commit the existing implicit
             # transaction before we can start the new one.
-            connection.commit()
-            with connection.begin():
+            setup_connection.commit()
+            with setup_connection.begin():
                 log.info(f"Running final query and writing results to '{table_name}'")
-                connection.execute(write_query_to_table(table, select_query))
+                setup_connection.execute(
+                    write_query_to_table(table, select_query),
+                    get_bind_parameters(select_query, parameters),
+                )
                 log.info(f"Creating '{key_column}' index on '{table_name}'")
-                connection.execute(create_index_for_table(table))
-                connection.commit()
+                setup_connection.execute(create_index_for_table(table))
+                setup_connection.commit()
 
         # Here we pass back an iterator over the temporary table as the value
         # of the context manager
-        yield fetch_table_in_batches(
-            connection, table, key_column, **batch_fetch_config
-        )
+        if download_connections > 1:
+            assert not temp_table_prefix.startswith("#")
+            yield fetch_table_in_parallel(
+                engine, table, key_column, download_connections, **batch_fetch_config
+            )
+        else:
+            yield fetch_table_in_batches(
+                connection, table, key_column, **batch_fetch_config
+            )
 
         # If all goes well we clean up the temporary table; if there was an
         # error then we'll leave it in place for next time
@@ -119,6 +164,11 @@ def fetch_table_in_batches(
     max_retries=2,
     sleep=0.5,
     reconnect_on_error=False,
+    start_key=None,
+    end_key=None,
+    min_batch_size=None,
+    max_batch_size=None,
+    prefetch=False,
 ):
     """
     Returns an iterator over all the rows in a table by querying it in batches,
@@ -146,30 +196,79 @@ def fetch_table_in_batches(
             session-scoped temporary tables for obvious reasons. If this option
             is supplied then `connection` must be a ReconnectableConnection
             instance
+
+        start_key, end_key: if supplied, only fetch rows whose key is greater
+            than `start_key` and no greater than `end_key`
+
+        min_batch_size, max_batch_size: if supplied, vary the size of each batch
+            within these bounds to fetch as many rows per second as we can (see
+            `BatchSizer`), starting from `batch_size`
+
+        prefetch: fetch each batch in a background thread while the caller is
+            consuming the previous one, so that we're not waiting on the database
+            while the caller is busy and vice versa
     """
     if reconnect_on_error:
         msg = "Connection must be a ReconnectableConnection if `reconnect_on_error` is used"
         assert hasattr(connection, "reconnect"), msg
 
+    batches = fetch_batches(
+        connection,
+        table,
+        key_column,
+        BatchSizer(batch_size, min_batch_size, max_batch_size),
+        max_retries=max_retries,
+        sleep=sleep,
+        reconnect_on_error=reconnect_on_error,
+        start_key=start_key,
+        end_key=end_key,
+    )
+    if prefetch:
+        batches = prefetch_in_background(batches)
+    for batch in batches:
+        yield from batch
+
+
+def fetch_batches(
+    connection,
+    table,
+    key_column,
+    batch_sizer,
+    max_retries,
+    sleep,
+    reconnect_on_error,
+    start_key,
+    end_key,
+):
+    """
+    Yield the rows of `table` as a list per batch, see `fetch_table_in_batches`
+    """
     key = sqlalchemy.Column(key_column)
     retries = 0
     batch_count = 0
     total_rows = 0
-    min_key = None
+    min_key = start_key
 
     while True:
+        batch_size = batch_sizer.size
         query = (
             sqlalchemy.select("*").select_from(table).order_by(key).limit(batch_size)
         )
         if min_key is not None:
             query = query.where(key > min_key)
+        if end_key is not None:
+            query = query.where(key <= end_key)
 
-        log.info(f"Fetching batch {batch_count}")
+        log.info(f"Fetching batch {batch_count} of {batch_size} rows")
+        start_time = time.monotonic()
         try:
-            results = connection.execute(query)
+            # Fetch the whole batch here, so that errors while reading the results
+            # are retried too
+            rows = connection.execute(query).fetchall()
             retries = 0
         except sqlalchemy.exc.OperationalError as e:
             retries += 1
+            batch_sizer.record_error()
             if retries > max_retries:
                 raise
             else:
@@ -179,22 +278,217 @@ def fetch_table_in_batches(
                     connection.reconnect()
                 time.sleep(sleep)
                 continue
+        batch_sizer.record_success(len(rows), time.monotonic() - start_time)
 
-        row_count = 0
-        for row in results:
-            row_count += 1
-            yield row
+        yield rows
 
-        min_key = row[key_column]
-
-        total_rows += row_count
+        total_rows += len(rows)
         batch_count += 1
         log.info(f"Total rows fetched: {total_rows}")
 
-        if row_count < batch_size:
+        if len(rows) < batch_size:
             log.info("Batch fetch complete")
             break
 
+        min_key = rows[-1][key_column]
+
+
+class BatchSizer:
+    """
+    Chooses the size of each batch for `fetch_table_in_batches`
+
+    Larger batches mean fewer round trips to the database but each one takes longer,
+    and is more likely to hit a timeout. Rather than guess at the best size we
+    hill-climb towards it: we keep scaling the size in the same direction while the
+    number of rows we fetch per second goes up, and reverse when it goes down. After
+    an error we halve the size. The size always stays within the given bounds, which
+    default to the initial size (i.e. a fixed size).
+    """
+
+    growth_factor = 1.5
+
+    def __init__(self, initial, minimum=None, maximum=None):
+        self.size = initial
+        self.minimum = minimum or initial
+        self.maximum = maximum or initial
+        self.direction = 1
+        self.last_throughput = None
+
+    def record_success(self, rows, seconds):
+        if rows < self.size:
+            # The final batch is short, so tells us nothing about this size
+            return
+        throughput = rows / max(seconds, 1e-6)
+        if self.last_throughput is not None and throughput < self.last_throughput:
+            self.direction = -self.direction
+        self.last_throughput = throughput
+        self.resize(self.growth_factor ** self.direction)
+
+    def record_error(self):
+        self.direction = -1
+        self.last_throughput = None
+        self.resize(0.5)
+
+    def resize(self, factor):
+        self.size = min(self.maximum, max(self.minimum, int(self.size * factor)))
+
+
+def prefetch_in_background(generator, depth=1):
+    """
+    Iterate over `generator` in a background thread, keeping up to `depth` items
+    ready ahead of the consumer, and yield its items (or raise its exceptions)
+
+    If the consumer stops early we stop the background thread too, and close
+    `generator` there.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Don't block forever if the consumer has gone away
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        end = (False, None)
+        try:
+            for item in generator:
+                if not put((True, item)):
+                    break
+        except BaseException as e:
+            # Including the likes of KeyboardInterrupt and SystemExit, which would
+            # otherwise end the thread without the consumer ever knowing
+            end = (False, e)
+        finally:
+            try:
+                generator.close()
+            finally:
+                # However we finished, tell the consumer so it doesn't wait forever
+                put(end)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            has_item, value = items.get()
+            if not has_item:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+def fetch_table_in_parallel(
+    engine,
+    table,
+    key_column,
+    connections,
+    batch_size=32000,
+    batches_per_slice=4,
+    start_key=None,
+    **batch_fetch_config,
+):
+    """
+    As `fetch_table_in_batches`, but downloading disjoint slices of the table's key
+    range over several connections at once
+
+    Fetching a batch is dominated by the round trip to the database, so with
+    `connections` connections we can fetch (nearly) that many batches in the time it
+    takes to fetch one. Each slice is fetched on its own `ReconnectableConnection`
+    with the usual retries, and the slices are yielded in key order. We only fetch a
+    limited number of slices ahead of the one we're yielding, so that we never hold
+    more than a few slices in memory.
+
+    Args:
+        engine: sqlalchemy.Engine instance
+
+        connections: how many connections to use at once
+
+        batches_per_slice: roughly how many batches make up each slice
+
+    The remaining arguments are as for `fetch_table_in_batches`, and
+    `reconnect_on_error` must be set as each connection is reconnected independently.
+    """
+    assert batch_fetch_config.get("reconnect_on_error")
+    key = sqlalchemy.Column(key_column)
+    query = sqlalchemy.select(
+        sqlalchemy.func.count(),
+        sqlalchemy.func.min(key),
+        sqlalchemy.func.max(key),
+    ).select_from(table)
+    if start_key is not None:
+        query = query.where(key > start_key)
+    with engine.connect() as connection:
+        row_count, min_key, max_key = connection.execute(query).one()
+    if not row_count:
+        return
+    # We don't know how the keys are distributed, so we assume they're spread evenly
+    # across the range
+    slice_count = max(
+        connections, math.ceil(row_count / (batch_size * batches_per_slice))
+    )
+    boundaries = sorted(
+        {
+            min_key - 1 + (max_key - min_key + 1) * i // slice_count
+            for i in range(slice_count + 1)
+        }
+    )
+    slices = list(zip(boundaries[:-1], boundaries[1:]))
+    log.info(f"Fetching {len(slices)} slices over {connections} connections")
+
+    idle_connections = queue.Queue()
+    for _ in range(connections):
+        idle_connections.put(ReconnectableConnection(engine))
+
+    def fetch_slice(key_range):
+        connection = idle_connections.get()
+        try:
+            return list(
+                fetch_table_in_batches(
+                    connection,
+                    table,
+                    key_column,
+                    batch_size=batch_size,
+                    start_key=key_range[0],
+                    end_key=key_range[1],
+                    # We're already fetching in the background
+                    **dict(batch_fetch_config, prefetch=False),
+                )
+            )
+        finally:
+            idle_connections.put(connection)
+
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            pending = []
+            remaining = iter(slices)
+            try:
+                while True:
+                    # Keep every connection busy, and a slice's worth of work in hand
+                    # for each of them, but no more than that
+                    while len(pending) < 2 * connections:
+                        key_range = next(remaining, None)
+                        if key_range is None:
+                            break
+                        pending.append(executor.submit(fetch_slice, key_range))
+                    if not pending:
+                        break
+                    yield from pending.pop(0).result()
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        while not idle_connections.empty():
+            idle_connections.get().__exit__(None, None, None)
+
 
 class ReconnectableConnection:
     """
@@ -220,6 +514,9 @@ class ReconnectableConnection:
 
     def __exit__(self, *args):
         if self._conn is not None:
+            # Don't return the connection to the pool: it may hold session-scoped
+            # temporary tables which would clash with those of the next user
+            self._conn.detach()
             self._conn.close()
 
     @property
@@ -254,21 +551,24 @@ class ReconnectableConnection:
         self._conn = None
 
 
-def get_query_hash(connection, queries):
+def get_query_hash(connection, queries, parameters=None):
     """
     Create a hash of the entire contents of a list of SQLAlchemy queries
     """
     hashobj = hashlib.sha256()
-    for component in get_query_hash_components(connection, queries):
+    for component in get_query_hash_components(connection, queries, parameters):
         hashobj.update(str(component).encode("utf-8"))
     return hashobj.hexdigest()[:32]
 
 
-def get_query_hash_components(connection, queries):
+def get_query_hash_components(connection, queries, parameters=None):
     for query in queries:
         compiled = query.compile(connection)
         yield str(compiled)
         yield compiled.params
+    # The same queries executed with different parameters give different results
+    if parameters:
+        yield sorted(parameters.items())
     # Because we run queries against multiple different databases but store
     # temporary results in a single common database, we need to include the
     # name of the database being run against as part of the hash. This is not
@@ -278,6 +578,29 @@ def get_query_hash_components(connection, queries):
     yield connection.engine.url.database
 
 
+def get_contents_hash(connection, contents, key=None):
+    """
+    Create a hash identifying the contents of a table, given either the query which
+    populates it or the rows inserted into it
+
+    If `key` is given then it's included in the hash, so that the same contents get
+    a different hash for each key.
+    """
+    if isinstance(contents, sqlalchemy.sql.ClauseElement):
+        contents_hash = get_query_hash(connection, [contents])
+    else:
+        hashobj = hashlib.sha256()
+        hashobj.update(repr(contents).encode("utf-8"))
+        # See `get_query_hash_components` above for why we include the database name
+        hashobj.update(str(connection.engine.url.database).encode("utf-8"))
+        contents_hash = hashobj.hexdigest()[:32]
+    if key is None:
+        return contents_hash
+    hashobj = hashlib.sha256()
+    hashobj.update(f"{key}:{contents_hash}".encode("utf-8"))
+    return hashobj.hexdigest()[:32]
+
+
 def table_exists(connection, table):
     # We don't always have sufficient permissions to check this in the "proper"
     # way so we have to try reading from it and catch the error
@@ -297,6 +620,104 @@ def table_exists(connection, table):
             raise
 
 
+def is_already_exists_error(error):
+    # As above, the message is the most robust way to identify this error
+    return "There is already an object named" in str(error)
+
+
+def create_table_if_not_exists(connection, table):
+    if table_exists(connection, table):
+        return
+    try:
+        connection.execute(sqlalchemy.schema.CreateTable(table))
+        connection.commit()
+    except sqlalchemy.exc.DBAPIError as e:
+        # Another process may have got there first, which is fine
+        if not is_already_exists_error(e):
+            raise
+        connection.rollback()
+
+
+def make_cache_entries_table(schema):
+    """
+    Return the table which records the contents of the cache of intermediate tables
+    shared between jobs, see `MssqlQueryEngine.uses_shared_cache()`
+    """
+    return sqlalchemy.Table(
+        "TempCacheEntries",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column("table_name", sqlalchemy.String(200), primary_key=True),
+        sqlalchemy.Column("created_at", sqlalchemy.DateTime(), nullable=False),
+        sqlalchemy.Column("last_used_at", sqlalchemy.DateTime(), nullable=False),
+        sqlalchemy.Column("hits", sqlalchemy.Integer(), nullable=False),
+        schema=schema,
+    )
+
+
+def record_cache_use(connection, entries, table_name, now, hit):
+    """
+    Record that we've just created (or, if `hit`, reused) the cached table `table_name`
+    """
+    log.info(f"Shared cache {'hit' if hit else 'miss'} for '{table_name}'")
+    result = connection.execute(
+        sqlalchemy.update(entries)
+        .where(entries.c.table_name == table_name)
+        .values(last_used_at=now, hits=entries.c.hits + (1 if hit else 0))
+    )
+    if result.rowcount == 0:
+        connection.execute(
+            sqlalchemy.insert(entries).values(
+                table_name=table_name,
+                created_at=now,
+                last_used_at=now,
+                hits=1 if hit else 0,
+            )
+        )
+
+
+def evict_cache_entries(connection, entries, now, max_tables, max_age, min_age):
+    """
+    Drop the cached tables chosen by `get_cache_entries_to_evict()` and forget about
+    them
+    """
+    rows = connection.execute(
+        sqlalchemy.select(
+            entries.c.table_name, entries.c.created_at, entries.c.last_used_at
+        )
+    ).all()
+    evicted = get_cache_entries_to_evict(rows, now, max_tables, max_age, min_age)
+    for table_name in evicted:
+        log.info(f"Evicting '{table_name}' from the shared cache")
+        table = sqlalchemy.Table(
+            table_name, sqlalchemy.MetaData(), schema=entries.schema
+        )
+        connection.execute(sqlalchemy.schema.DropTable(table, if_exists=True))
+        connection.execute(
+            sqlalchemy.delete(entries).where(entries.c.table_name == table_name)
+        )
+        connection.commit()
+    return evicted
+
+
+def get_cache_entries_to_evict(rows, now, max_tables, max_age, min_age):
+    """
+    Given (table_name, created_at, last_used_at) tuples, return the names of the tables
+    which either were created more than `max_age` ago or are beyond the `max_tables`
+    most recently used
+
+    A table is expired by age however recently it was used, so that nothing is served
+    from the cache for longer than `max_age` after it was created. Otherwise nothing
+    used within `min_age` is evicted, as another job may still be reading it.
+    """
+    rows = sorted(rows, key=lambda row: row[2], reverse=True)
+    return [
+        table_name
+        for position, (table_name, created_at, last_used_at) in enumerate(rows)
+        if created_at < now - max_age
+        or (position >= max_tables and last_used_at < now - min_age)
+    ]
+
+
 def assert_temporary_tables_writable(connection, temp_table_prefix):
     """
     Check that we can write temporary tables before we start potentially very
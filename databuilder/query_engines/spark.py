@@ -4,6 +4,7 @@ import secrets
 import sqlalchemy
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql.expression import ClauseElement, Executable, type_coerce
+from sqlalchemy.sql.visitors import InternalTraversal
 
 from .. import sqlalchemy_types
 from .base_sql import BaseSQLQueryEngine
@@ -11,6 +12,12 @@ from .spark_dialect import SparkDialect
 
 
 class CreateViewAs(Executable, ClauseElement):
+    # Allows SQLAlchemy to cache the compiled form of these queries
+    _traverse_internals = [
+        ("name", InternalTraversal.dp_string),
+        ("query", InternalTraversal.dp_clauseelement),
+    ]
+
     def __init__(self, name, query):
         self.name = name
         self.query = query
@@ -56,6 +63,10 @@ class SparkQueryEngine(BaseSQLQueryEngine):
         # Anything else is a regular table which does require dropping
         return True
 
+    def get_drop_temp_table_query(self, table):
+        # The only tables we recreate are those written from queries, which are views
+        return sqlalchemy.text(f"DROP VIEW IF EXISTS {table.name}")
+
     def get_temp_database(self):
         return self.backend.temporary_database
 
@@ -19,6 +19,7 @@ from sqlalchemy.sql.expression import cast
 
 class SparkDate(sqlalchemy.types.TypeDecorator):
     impl = sqlalchemy.types.Date
+    cache_ok = True
 
     def process_result_value(self, value, dialect):
         """
@@ -46,6 +47,7 @@ class SparkDate(sqlalchemy.types.TypeDecorator):
 
 class SparkDateTime(sqlalchemy.types.TypeDecorator):
     impl = sqlalchemy.types.DateTime
+    cache_ok = True
 
     def bind_expression(self, bindvalue):
         """
@@ -114,6 +116,7 @@ class SparkDialect(HiveHTTPDialect):
     """
 
     name = "spark"
+    supports_statement_cache = True
 
     ddl_compiler = SparkDDLCompiler
     type_compiler = SparkTypeCompiler
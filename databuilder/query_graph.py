@@ -0,0 +1,193 @@
+"""
+An explicit graph representation of the Query Model DAG for a set of column definitions.
+
+The Query Model itself is just a collection of nodes holding references to other nodes,
+and nodes are heavily shared (a single filtered table may feed dozens of variables). So
+naive recursive walks over the model can visit the same subgraph exponentially many
+times. `QueryGraph` walks the model exactly once and records:
+
+  * a topological order of the nodes (every node appears after all the nodes it
+    references);
+  * the child and parent adjacency of each node, keyed by a small integer node id.
+
+Optimisation passes can then run in O(nodes + edges) by iterating over this order, and
+can rewrite the graph without mutating the (shared, interned) Query Model nodes by using
+`QueryGraph.rewrite()`, which rebuilds only the nodes whose descendants have changed.
+"""
+import dataclasses
+import hashlib
+
+from .query_model import Parameter, QueryNode, ValueFromFunction
+
+
+class QueryGraph:
+    def __init__(self, column_definitions):
+        self.column_definitions = dict(column_definitions)
+        # Nodes in topological order, indexed by node id
+        self.nodes = []
+        # Map from the Python identity of each node to its node id
+        self._node_ids = {}
+        self.children = []
+        self.parents = []
+        for root in self.column_definitions.values():
+            self._add(root)
+
+    def _add(self, root):
+        # An iterative post-order traversal, so that very deep graphs can't exhaust the
+        # recursion limit
+        stack = [(root, False)]
+        while stack:
+            node, children_added = stack.pop()
+            if id(node) in self._node_ids:
+                continue
+            referenced = node._get_referenced_nodes()
+            if children_added:
+                node_id = len(self.nodes)
+                self._node_ids[id(node)] = node_id
+                self.nodes.append(node)
+                self.parents.append([])
+                child_ids = tuple(self._node_ids[id(child)] for child in referenced)
+                self.children.append(child_ids)
+                for child_id in child_ids:
+                    self.parents[child_id].append(node_id)
+            else:
+                stack.append((node, True))
+                stack.extend(
+                    (child, False)
+                    for child in reversed(referenced)
+                    if id(child) not in self._node_ids
+                )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        """Iterate over the nodes in topological order"""
+        return iter(self.nodes)
+
+    def node_id(self, node):
+        return self._node_ids[id(node)]
+
+    def get_children(self, node):
+        return [self.nodes[i] for i in self.children[self.node_id(node)]]
+
+    def get_parents(self, node):
+        return [self.nodes[i] for i in self.parents[self.node_id(node)]]
+
+    def rewrite(self, replacements):
+        """
+        Return a new QueryGraph in which each node in the `replacements` dict has been
+        substituted by its replacement
+
+        No nodes are modified: any node which references a replaced node (directly or
+        indirectly) is rebuilt with the new references, and everything else is shared
+        with the original graph.
+        """
+        new_nodes = {
+            self.node_id(node): replacement
+            for node, replacement in replacements.items()
+        }
+        for node_id, node in enumerate(self.nodes):
+            if node_id in new_nodes:
+                continue
+            mapping = {
+                id(self.nodes[i]): new_nodes[i]
+                for i in self.children[node_id]
+                if i in new_nodes
+            }
+            if mapping:
+                new_nodes[node_id] = replace_children(node, mapping)
+        return QueryGraph(
+            {
+                name: new_nodes.get(self.node_id(node), node)
+                for name, node in self.column_definitions.items()
+            }
+        )
+
+
+def replace_children(node, mapping):
+    """
+    Return a copy of `node` with each referenced node replaced according to `mapping`
+    (which maps the identity of the old node to the new node)
+    """
+    if isinstance(node, ValueFromFunction):
+        return type(node)(*_replace_nodes(node.arguments, mapping))
+    changes = {}
+    for field in dataclasses.fields(node):
+        value = getattr(node, field.name)
+        new_value = _replace_nodes(value, mapping)
+        if new_value is not value:
+            changes[field.name] = new_value
+    return dataclasses.replace(node, **changes)
+
+
+def _replace_nodes(value, mapping):
+    if isinstance(value, QueryNode):
+        return mapping.get(id(value), value)
+    elif isinstance(value, tuple):
+        items = tuple(_replace_nodes(item, mapping) for item in value)
+        changed = any(new is not old for new, old in zip(items, value))
+        return items if changed else value
+    elif isinstance(value, dict):
+        items = {key: _replace_nodes(item, mapping) for key, item in value.items()}
+        changed = any(items[key] is not item for key, item in value.items())
+        return items if changed else value
+    else:
+        return value
+
+
+def get_parameter_dependent_nodes(graph):
+    """
+    Return the set of nodes in `graph` whose values depend, directly or indirectly, on
+    a Parameter
+
+    The values of all other nodes are the same whatever values the parameters take, so
+    when we evaluate the graph for several sets of parameter values we need only
+    evaluate those nodes once.
+    """
+    dependent = set()
+    # Children come before their parents, so we only need a single pass
+    for node in graph:
+        if isinstance(node, Parameter) or any(
+            child in dependent for child in graph.get_children(node)
+        ):
+            dependent.add(node)
+    return dependent
+
+
+def get_structural_hashes(graph):
+    """
+    Return a dict mapping the name of each column in `graph` to a hash of the structure
+    of its subgraph
+
+    Two columns have the same hash only if they are defined by structurally identical
+    Query Model graphs. Unlike the identity of the (interned) nodes themselves, the
+    hashes are stable between processes, so they can be stored and compared with those
+    of a later run.
+    """
+    hashes = []
+    for node in graph:
+        description = f"{type(node).__name__}{_describe(vars(node), graph, hashes)}"
+        hashes.append(hashlib.sha256(description.encode("utf-8")).hexdigest())
+    return {
+        name: hashes[graph.node_id(node)]
+        for name, node in graph.column_definitions.items()
+    }
+
+
+def _describe(value, graph, hashes):
+    # Compare `_structural_key()` in the Query Model, which does the same job within a
+    # single process
+    if isinstance(value, QueryNode):
+        return f"<{hashes[graph.node_id(value)]}>"
+    elif isinstance(value, (tuple, list)):
+        items = ",".join(_describe(item, graph, hashes) for item in value)
+        return f"{type(value).__name__}({items})"
+    elif isinstance(value, dict):
+        items = ",".join(
+            f"{_describe(k, graph, hashes)}:{_describe(v, graph, hashes)}"
+            for k, v in value.items()
+        )
+        return f"dict({items})"
+    else:
+        return f"{type(value).__name__}:{value!r}"
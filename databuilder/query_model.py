@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import threading
+import weakref
 from dataclasses import dataclass
 from typing import Any
 
@@ -31,10 +33,59 @@ def table(name):
 # created.  Additionally, in order for the comparison operators on Value and its
 # subclasses to work, we need to stop dataclasses from overriding these methods on the
 # subclasses.
+#
+# A note about identity...  Nodes are "hash-consed": constructing a node which is
+# structurally identical to one which already exists returns the existing instance (see
+# `_InternedNode`). This means that identity and structural equality coincide, so nodes
+# hash and compare by identity which is O(1) regardless of the size of the graph below
+# them, and identical subgraphs (e.g. the same `age_as_of()` used in two variables) are
+# automatically shared and only evaluated once by the query engines.
+
+
+# Canonical instances of each node, keyed by the node's type and its attributes (with
+# child nodes represented by their identity). We hold the nodes weakly so that we don't
+# keep every graph we've ever built alive. `setdefault()` isn't atomic on a
+# WeakValueDictionary, so we hold a lock while interning in case several threads
+# (e.g. with `--jobs`) build graphs at once.
+_interned_nodes = weakref.WeakValueDictionary()
+_interned_nodes_lock = threading.Lock()
+
+
+class _InternedNode(type):
+    def __call__(cls, *args, **kwargs):
+        node = super().__call__(*args, **kwargs)
+        try:
+            key = (cls, _structural_key(vars(node)))
+        except TypeError:
+            # Some attribute is unhashable, so we can't intern this node
+            return node
+        with _interned_nodes_lock:
+            return _interned_nodes.setdefault(key, node)
+
 
+def _structural_key(value):
+    """
+    Return a hashable key for `value` such that two values have equal keys only if they
+    are structurally identical
+    """
+    if isinstance(value, QueryNode):
+        # Nodes are interned, so identity is structural identity. We can't compare the
+        # nodes themselves because `Value.__eq__` returns a Comparator.
+        return QueryNode, id(value)
+    elif isinstance(value, (tuple, list)):
+        return type(value), tuple(_structural_key(item) for item in value)
+    elif isinstance(value, dict):
+        return dict, tuple(
+            (_structural_key(k), _structural_key(v)) for k, v in value.items()
+        )
+    else:
+        # Include the type so that e.g. `True`, `1` and `1.0` are kept distinct
+        hash(value)
+        return type(value), value
 
-@dataclass(frozen=True)
-class QueryNode:
+
+@dataclass(frozen=True, eq=False)
+class QueryNode(metaclass=_InternedNode):
     def _get_referenced_nodes(self):
         """
         Return a tuple of all QueryNodes to which this node holds a reference
@@ -42,7 +93,7 @@ class QueryNode:
         raise NotImplementedError()
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Comparator(QueryNode):
     """A generic comparator to represent a comparison between a source object and a
     value.
@@ -106,6 +157,9 @@ class Comparator(QueryNode):
     def __ne__(self, other):
         return self._compare(other, "__ne__")
 
+    def __hash__(self):
+        return id(self)
+
     def _combine(self, other, conn):
         assert isinstance(other, Comparator)
         return type(self)(connector=conn, lhs=self, rhs=other)
@@ -219,7 +273,7 @@ class BaseTable(QueryNode):
         return ValueFromAggregate(row, output_column)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Table(BaseTable):
     name: str
 
@@ -261,8 +315,7 @@ class Table(BaseTable):
         )
 
 
-# @dataclass(unsafe_hash=True)
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class FilteredTable(BaseTable):
     source: Any
     column: Any
@@ -277,7 +330,7 @@ class FilteredTable(BaseTable):
         return nodes
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Column(QueryNode):
     source: Any
     column: Any
@@ -286,7 +339,7 @@ class Column(QueryNode):
         return (self.source,)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Row(QueryNode):
     source: Any
     sort_columns: Any
@@ -299,7 +352,7 @@ class Row(QueryNode):
         return ValueFromRow(source=self, column=column)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class RowFromAggregate(QueryNode):
     source: QueryNode
     function: Any
@@ -354,7 +407,7 @@ class Value(QueryNode):
         return id(self)
 
 
-@dataclass(frozen=True, eq=False, order=False)
+@dataclass(frozen=True, eq=False)
 class ValueFromRow(Value):
     source: Any
     column: Any
@@ -363,7 +416,7 @@ class ValueFromRow(Value):
         return (self.source,)
 
 
-@dataclass(frozen=True, eq=False, order=False)
+@dataclass(frozen=True, eq=False)
 class ValueFromAggregate(Value):
     source: RowFromAggregate
     column: Any
@@ -380,7 +433,7 @@ def categorise(mapping, default=None):
     return ValueFromCategory(mapping, default)
 
 
-@dataclass(frozen=True, eq=False, order=False)
+@dataclass(frozen=True, eq=False)
 class ValueFromCategory(Value):
     definitions: dict
     default: str | int | float | None
@@ -393,7 +446,7 @@ class ValueFromCategory(Value):
         return nodes
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class Codelist(QueryNode):
     codes: tuple
     system: str
@@ -414,6 +467,20 @@ class Codelist(QueryNode):
         return f"Codelist(system={self.system}, codes={codes})"
 
 
+@dataclass(frozen=True, eq=False)
+class Parameter(QueryNode):
+    """
+    A placeholder for a value which is only supplied when the query is executed, such as
+    the index date of a study with an `index_date_range`. This lets the same Query Model
+    (and so the same compiled SQL) be executed many times with different values.
+    """
+
+    name: str
+
+    def _get_referenced_nodes(self):
+        return ()
+
+
 class ValueFromFunction(Value):
     def __init__(self, *args):
         self.arguments = args
@@ -1,5 +1,28 @@
+import datetime
+
 from .dsl import Cohort as DSLCohort
-from .query_model import Value
+from .query_model import (
+    Comparator,
+    DateDifference,
+    FilteredTable,
+    RoundToFirstOfMonth,
+    RoundToFirstOfYear,
+    Value,
+    ValueFromAggregate,
+    ValueFromCategory,
+    ValueFromRow,
+)
+
+# The names (as in `TYPES_BY_NAME`) of the types of the Python values we might find in
+# a Query Model
+TYPE_NAMES = {
+    bool: "boolean",
+    int: "integer",
+    float: "float",
+    str: "varchar",
+    datetime.date: "date",
+    datetime.datetime: "datetime",
+}
 
 
 def get_class_vars(cls):
@@ -40,3 +63,59 @@ def get_measures(cohort_cls):
         if name == "measures":
             return value
     return []
+
+
+def get_column_types(column_definitions, backend):
+    """
+    Return a dict mapping the name of each column to the name of the type of its values
+
+    The names are those of `TYPES_BY_NAME`, plus "category" for the results of
+    `categorise()` with string labels. Where we can't tell the type the name is None.
+    """
+    return {
+        name: get_value_type(definition, backend)
+        for name, definition in column_definitions.items()
+    }
+
+
+def get_value_type(node, backend):
+    if isinstance(node, Comparator):
+        return "boolean"
+    elif isinstance(node, ValueFromRow):
+        return get_table_column_type(node.source.source, node.column, backend)
+    elif isinstance(node, ValueFromAggregate):
+        aggregate = node.source
+        if aggregate.function == "exists":
+            return "boolean"
+        elif aggregate.function == "count":
+            return "integer"
+        else:
+            return get_table_column_type(
+                aggregate.source, aggregate.input_column, backend
+            )
+    elif isinstance(node, ValueFromCategory):
+        labels = list(node.definitions)
+        if node.default is not None:
+            labels.append(node.default)
+        label_types = {type(label) for label in labels}
+        if label_types == {str}:
+            return "category"
+        elif len(label_types) == 1:
+            return TYPE_NAMES.get(label_types.pop())
+        return None
+    elif isinstance(node, DateDifference):
+        return "integer"
+    elif isinstance(node, (RoundToFirstOfMonth, RoundToFirstOfYear)):
+        return "date"
+    return None
+
+
+def get_table_column_type(node, column, backend):
+    while isinstance(node, FilteredTable):
+        node = node.source
+    if column == "patient_id":
+        return "integer"
+    table = backend.tables.get(getattr(node, "name", None))
+    if table is None or column not in table.columns:
+        return None
+    return table.columns[column].type
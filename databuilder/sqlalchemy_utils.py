@@ -1,4 +1,5 @@
-from collections.abc import Iterable
+from collections.abc import Hashable, Iterable
+from typing import Optional
 
 import sqlalchemy
 from sqlalchemy import Table
@@ -13,16 +14,44 @@ from sqlalchemy.sql.selectable import Select
 # mypy: ignore-errors
 
 
+def get_order_by_columns(
+    table_expr,
+    sort_columns: Iterable[str],
+    descending: bool,
+    explicit_nulls_order: bool = True,
+) -> list:
+    """
+    Return the expressions to ORDER BY to sort `table_expr` by `sort_columns`
+
+    NULL sorts as the lowest possible value on every query engine: that is, first in
+    ascending order and last in descending order. We say so explicitly, unless
+    `explicit_nulls_order` is False for a database which behaves this way by default but
+    doesn't support NULLS FIRST/LAST.
+    """
+    order_columns = [table_expr.c[column] for column in sort_columns]
+    if descending:
+        order_columns = [c.desc() for c in order_columns]
+    if explicit_nulls_order:
+        if descending:
+            order_columns = [c.nullslast() for c in order_columns]
+        else:
+            order_columns = [c.nullsfirst() for c in order_columns]
+    return order_columns
+
+
 def select_first_row_per_partition(
     query: Select,
-    partition_column: str,
+    partition_columns: Iterable[str],
     sort_columns: Iterable[str],
     descending: bool,
+    explicit_nulls_order: bool = True,
 ) -> Select:
     """
-    Given a SQLAlchemy SELECT query, partition it by the specified column, sort
+    Given a SQLAlchemy SELECT query, partition it by the specified columns, sort
     within each partition by `sort_columns` and then return a query containing just
     the first row for each partition.
+
+    See `get_order_by_columns()` for how NULLs are sorted.
     """
     # Get the base table - the first in the FROM clauses
     table_expr = get_primary_table(query)
@@ -31,15 +60,17 @@ def select_first_row_per_partition(
     column_names = [column.name for column in query.selected_columns]
 
     # Query to select the columns that we need to sort on
-    order_columns = [table_expr.c[column] for column in sort_columns]
-    # change ordering to descending on all order columns if necessary
-    if descending:
-        order_columns = [c.desc() for c in order_columns]
+    order_columns = get_order_by_columns(
+        table_expr, sort_columns, descending, explicit_nulls_order
+    )
 
-    # Number rows sequentially over the order by columns for each patient id
+    # Number rows sequentially over the order by columns for each partition
     row_num = (
         sqlalchemy.func.row_number()
-        .over(order_by=order_columns, partition_by=table_expr.c[partition_column])
+        .over(
+            order_by=order_columns,
+            partition_by=[table_expr.c[column] for column in partition_columns],
+        )
         .label("_row_num")
     )
     # Add the _row_num column and select just the first row
@@ -50,32 +81,92 @@ def select_first_row_per_partition(
     return query
 
 
+def select_first_rows_per_partition(
+    query: Select,
+    partition_columns: Iterable[str],
+    orderings: Iterable[tuple[Iterable[str], bool]],
+    explicit_nulls_order: bool = True,
+) -> Select:
+    """
+    Given a SQLAlchemy SELECT query and several (sort_columns, descending) orderings,
+    number the rows in each partition according to each ordering and return a query
+    containing just the rows which come first in at least one of the orderings.
+
+    The row numbers are included as columns `_row_num_0`, `_row_num_1` etc. (one per
+    ordering) so that the first row for the Nth ordering can be selected using:
+
+        WHERE _row_num_N = 1
+
+    See `get_order_by_columns()` for how NULLs are sorted.
+    """
+    table_expr = get_primary_table(query)
+    column_names = [column.name for column in query.selected_columns]
+
+    row_num_names = []
+    for i, (sort_columns, descending) in enumerate(orderings):
+        order_columns = get_order_by_columns(
+            table_expr, sort_columns, descending, explicit_nulls_order
+        )
+        row_num_name = f"_row_num_{i}"
+        row_num = (
+            sqlalchemy.func.row_number()
+            .over(
+                order_by=order_columns,
+                partition_by=[table_expr.c[column] for column in partition_columns],
+            )
+            .label(row_num_name)
+        )
+        query = query.add_columns(row_num)
+        row_num_names.append(row_num_name)
+
+    subquery = query.alias()
+    query = sqlalchemy.select(
+        [subquery.c[column] for column in column_names + row_num_names]
+    )
+    return query.select_from(subquery).where(
+        sqlalchemy.or_(*[subquery.c[name] == 1 for name in row_num_names])
+    )
+
+
 def group_and_aggregate(
     query: Select,
-    group_by_column: str,
+    group_by_columns: Iterable[str],
     input_column: str,
     function_name: str,
     output_column: str,
 ) -> Select:
     """
     Given a SQLAlchemy SELECT query, apply the aggregation specified by `function_name`
-    to `input_colum`, grouping by `group_by_column` and labelling the result as
+    to `input_colum`, grouping by `group_by_columns` and labelling the result as
     `output_column`
     """
-    if function_name == "exists":
-        aggregate_value = sqlalchemy.literal(True)
-    else:
-        function = getattr(sqlalchemy.func, function_name)
-        source_column = query.selected_columns[input_column]
-        aggregate_value = function(source_column)
-
-    query = query.with_only_columns(
-        [
-            query.selected_columns[group_by_column],
-            aggregate_value.label(output_column),
-        ]
+    return group_and_aggregate_many(
+        query, group_by_columns, [(function_name, input_column, output_column)]
     )
-    return query.group_by(query.selected_columns[group_by_column])
+
+
+def group_and_aggregate_many(
+    query: Select,
+    group_by_columns: Iterable[str],
+    aggregates: Iterable[tuple[str, str, str]],
+) -> Select:
+    """
+    As `group_and_aggregate` above, but applying several aggregations in a single query.
+    `aggregates` is a sequence of (function_name, input_column, output_column) triples.
+    """
+    aggregate_values = []
+    for function_name, input_column, output_column in aggregates:
+        if function_name == "exists":
+            aggregate_value = sqlalchemy.literal(True)
+        else:
+            function = getattr(sqlalchemy.func, function_name)
+            source_column = query.selected_columns[input_column]
+            aggregate_value = function(source_column)
+        aggregate_values.append(aggregate_value.label(output_column))
+
+    group_by = [query.selected_columns[column] for column in group_by_columns]
+    query = query.with_only_columns([*group_by, *aggregate_values])
+    return query.group_by(*group_by)
 
 
 def get_joined_tables(select_query: Select) -> list[Table]:
@@ -104,11 +195,11 @@ def get_primary_table(select_query: Select) -> Table:
 
 
 def include_joined_tables(
-    select_query: Select, tables: Iterable[Table], join_column: str
+    select_query: Select, tables: Iterable[Table], join_columns: Iterable[str]
 ) -> Select:
     """
     Ensure that each table in `tables` is included in the join conditions for
-    `select_query`
+    `select_query`, joining on each of `join_columns` which the table has
     """
     current_tables = get_joined_tables(select_query)
     for table in tables:
@@ -117,7 +208,13 @@ def include_joined_tables(
         join = sqlalchemy.join(
             select_query.get_final_froms()[0],
             table,
-            select_query.selected_columns[join_column] == table.c[join_column],
+            sqlalchemy.and_(
+                *[
+                    select_query.selected_columns[column] == table.c[column]
+                    for column in join_columns
+                    if column in table.c
+                ]
+            ),
             isouter=True,
         )
         select_query = select_query.select_from(join)
@@ -152,6 +249,12 @@ class TemporaryTable(Table):
 
     setup_queries: list[Executable]
     cleanup_queries: list[Executable]
+    # Whether the contents of the table depend on the values of any bind parameters, in
+    # which case it must be recreated whenever those values change
+    depends_on_parameters: bool = True
+    # A hashable key which identifies the contents of the table, if known, so that the
+    # table can be shared by any query which needs the same contents
+    content_key: Optional[Hashable] = None
 
 
 def get_setup_and_cleanup_queries(
@@ -165,6 +268,24 @@ def get_setup_and_cleanup_queries(
 
     which are the combination of all the setup and cleanup queries from those
     TemporaryTables in the correct order for execution.
+    """
+    tables = get_temporary_tables_in_setup_order(clause)
+
+    setup_queries = flatten_lists(t.setup_queries for t in tables)
+    # Concatenate cleanup queries into one list, but in reverse order to that which we
+    # created them in. This means that if there are any database-level dependencies
+    # between the tables (e.g. if one is a materialized view over another) then we don't
+    # risk errors by trying to delete objects which still have dependents.
+    cleanup_queries = flatten_lists(t.cleanup_queries for t in reversed(tables))
+
+    return setup_queries, cleanup_queries
+
+
+def get_temporary_tables_in_setup_order(clause: ClauseElement) -> list[TemporaryTable]:
+    """
+    Given a SQLAlchemy ClauseElement find all TemporaryTables embeded in it (including
+    those needed to set up other TemporaryTables) and return them in an order in which
+    they can be created
 
     There's obviously a bit of algorithmic complexity here, but it's a fairly generic,
     graph traversal kind of complexity, contained in one place, which allows us to avoid
@@ -202,20 +323,39 @@ def get_setup_and_cleanup_queries(
             )
 
     # Sort tables in reverse order by level
-    tables = sorted(
+    return sorted(
         table_levels.keys(),
         key=table_levels.__getitem__,
         reverse=True,
     )
 
-    setup_queries = flatten_lists(t.setup_queries for t in tables)
-    # Concatenate cleanup queries into one list, but in reverse order to that which we
-    # created them in. This means that if there are any database-level dependencies
-    # between the tables (e.g. if one is a materialized view over another) then we don't
-    # risk errors by trying to delete objects which still have dependents.
-    cleanup_queries = flatten_lists(t.cleanup_queries for t in reversed(tables))
 
-    return setup_queries, cleanup_queries
+def get_bind_parameters(clause: ClauseElement, parameters: dict) -> dict:
+    """
+    Return just those items from `parameters` which are used as bind parameters in
+    `clause`
+
+    SQLAlchemy treats any unused parameters passed to an INSERT as values for columns
+    which don't exist, so we have to be careful to pass each query only what it needs.
+    """
+    names = {
+        element.key
+        for element in sqlalchemy.sql.visitors.iterate(clause)
+        if isinstance(element, sqlalchemy.sql.expression.BindParameter)
+    }
+    return {name: value for name, value in parameters.items() if name in names}
+
+
+def get_setup_dependencies(table: TemporaryTable) -> list[TemporaryTable]:
+    """
+    Return the other TemporaryTables which must exist before `table` can be created
+    """
+    return [
+        other
+        for query in table.setup_queries
+        for other in get_temporary_tables(query)
+        if other is not table
+    ]
 
 
 def get_temporary_tables(clause: ClauseElement) -> list[TemporaryTable]:
@@ -1,6 +1,6 @@
 import pytest
 
-from databuilder.backends.base import BaseBackend, Column, MappedTable
+from databuilder.backends.base import BaseBackend, Column, MappedTable, QueryTable
 from databuilder.contracts import types
 from databuilder.contracts.base import BackendContractError
 from databuilder.contracts.base import Column as ColumnContract
@@ -134,3 +134,41 @@ def test_get_table_implementing():
     backend = Backend(database_url="test")
     table = backend.get_table_implementing(PatientsContract)
     assert table.source == "Patient"
+
+
+def test_mapped_table_selects_only_requested_columns():
+    table = MappedTable(
+        source="coded_events",
+        columns=dict(
+            code=Column("code", source="EventCode"),
+            date=Column("date", source="Date"),
+            value=Column("float", source="Value"),
+        ),
+    )
+    table.learn_patient_join("Patient_ID")
+
+    assert [c.name for c in table.get_query().selected_columns] == [
+        "code",
+        "date",
+        "value",
+        "patient_id",
+    ]
+    assert [c.name for c in table.get_query({"date"}).selected_columns] == [
+        "date",
+        "patient_id",
+    ]
+
+
+def test_query_table_selects_only_requested_columns():
+    table = QueryTable(
+        query="SELECT Patient_ID AS patient_id, Code AS code, Value AS value FROM t",
+        columns=dict(
+            code=Column("code"),
+            value=Column("float"),
+        ),
+    )
+    table.learn_patient_join("Patient_ID")
+
+    query = table.get_query({"value"})
+    assert [c.name for c in query.selected_columns] == ["value", "patient_id"]
+    assert str(query).startswith("SELECT anon_1.value, anon_1.patient_id \nFROM (")
@@ -0,0 +1,777 @@
+import csv
+from datetime import date, datetime
+
+import duckdb
+import pandas
+import pytest
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+import databuilder.main
+from databuilder.backends.duckdb import DuckDBBackend
+from databuilder.main import (
+    extract,
+    generate_cohort,
+    get_column_definitions,
+    run_cohort_action,
+)
+from databuilder.query_engines.base import (
+    SAMPLE_HASH_MODULUS,
+    SAMPLE_HASH_MULTIPLIER,
+    get_sample_hash,
+)
+from databuilder.query_engines.duckdb import DuckDBQueryEngine
+from databuilder.query_model import RoundToFirstOfYear, table
+
+from ..lib.util import (
+    NULL_SORT_EVENTS,
+    NULL_SORT_EXPECTED,
+    NullSortCohort,
+    OldCohortWithPopulation,
+    make_codelist,
+)
+
+REGISTRATIONS = [
+    (1, date(2000, 1, 1), None),
+    (2, date(2000, 1, 1), None),
+    (3, date(2000, 1, 1), None),
+]
+PATIENTS = [
+    (1, "M", date(1990, 8, 1)),
+    (2, "F", date(2000, 3, 1)),
+    (3, "F", date(1985, 12, 1)),
+]
+EVENTS = [
+    (1, "Code1", "ctv3", date(2021, 1, 3), 10.0),
+    (1, "Code1", "ctv3", date(2021, 5, 2), 20.0),
+    (1, "Code2", "ctv3", date(2021, 2, 1), 30.0),
+    (2, "Code1", "snomed", date(2021, 6, 5), 40.0),
+    (3, "Code1", "ctv3", date(2020, 11, 20), None),
+]
+
+
+class Cohort(OldCohortWithPopulation):
+    _events = table("clinical_events").filter("code", is_in=make_codelist("Code1"))
+    _first_date = _events.earliest().get("date")
+    first_year = RoundToFirstOfYear(_first_date)
+    last_value = _events.latest().get("numeric_value")
+    event_count = _events.count()
+    age = table("patients").age_as_of(_first_date)
+    age_in_2021 = table("patients").age_as_of("2021-01-31")
+
+
+EXPECTED = [
+    dict(
+        patient_id=1,
+        first_year=date(2021, 1, 1),
+        last_value=20.0,
+        event_count=2,
+        age=30,
+        age_in_2021=30,
+    ),
+    dict(
+        patient_id=2,
+        first_year=None,
+        last_value=None,
+        event_count=None,
+        age=None,
+        age_in_2021=20,
+    ),
+    dict(
+        patient_id=3,
+        first_year=date(2020, 1, 1),
+        last_value=None,
+        event_count=1,
+        age=34,
+        age_in_2021=35,
+    ),
+]
+
+
+def populate(connection):
+    connection.execute(
+        "CREATE TABLE practice_registrations "
+        "(patient_id INTEGER, date_start TIMESTAMP, date_end TIMESTAMP, "
+        "pseudo_id INTEGER, nuts1_region_name VARCHAR)"
+    )
+    connection.executemany(
+        "INSERT INTO practice_registrations (patient_id, date_start, date_end) "
+        "VALUES (?, ?, ?)",
+        REGISTRATIONS,
+    )
+    connection.execute(
+        "CREATE TABLE patients (patient_id INTEGER, sex VARCHAR, date_of_birth DATE)"
+    )
+    connection.executemany("INSERT INTO patients VALUES (?, ?, ?)", PATIENTS)
+    connection.execute(
+        "CREATE TABLE clinical_events "
+        "(patient_id INTEGER, code VARCHAR, system VARCHAR, date TIMESTAMP, "
+        "numeric_value DOUBLE)"
+    )
+    connection.executemany("INSERT INTO clinical_events VALUES (?, ?, ?, ?, ?)", EVENTS)
+
+
+@pytest.fixture
+def duckdb_file(tmp_path):
+    path = tmp_path / "data.duckdb"
+    connection = duckdb.connect(str(path))
+    populate(connection)
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def parquet_directory(tmp_path):
+    directory = tmp_path / "parquet"
+    directory.mkdir()
+    connection = duckdb.connect()
+    populate(connection)
+    for name in ["practice_registrations", "patients", "clinical_events"]:
+        connection.execute(
+            f"COPY {name} TO '{directory / name}.parquet' (FORMAT PARQUET)"
+        )
+    connection.close()
+    return directory
+
+
+def test_extract_from_duckdb_file(duckdb_file):
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    assert sorted(extract(Cohort, backend), key=lambda r: r["patient_id"]) == EXPECTED
+
+
+def test_extract_from_parquet_directory(parquet_directory):
+    backend = DuckDBBackend(f"duckdb:///{parquet_directory}")
+    assert sorted(extract(Cohort, backend), key=lambda r: r["patient_id"]) == EXPECTED
+
+
+def test_null_sort_values(duckdb_file):
+    connection = duckdb.connect(str(duckdb_file))
+    connection.execute("DELETE FROM practice_registrations WHERE patient_id > 2")
+    connection.execute("DELETE FROM clinical_events")
+    connection.executemany(
+        "INSERT INTO clinical_events (patient_id, code, date) VALUES (?, ?, ?)",
+        NULL_SORT_EVENTS,
+    )
+    connection.close()
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = sorted(extract(NullSortCohort, backend), key=lambda r: r["patient_id"])
+    assert results == NULL_SORT_EXPECTED
+
+
+def test_temporary_tables_are_not_written_to_database(duckdb_file):
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    query_engine = DuckDBQueryEngine(get_column_definitions(Cohort), backend)
+    with query_engine.execute_query() as results:
+        list(results)
+    with query_engine.engine.connect() as connection:
+        tables = connection.exec_driver_sql(
+            "SELECT table_name FROM duckdb_tables() WHERE NOT temporary"
+        )
+        assert {row[0] for row in tables} == {
+            "practice_registrations",
+            "patients",
+            "clinical_events",
+        }
+
+
+def test_consolidated_codelist_filters(duckdb_file):
+    events = table("clinical_events")
+
+    class MultipleCodelists(OldCohortWithPopulation):
+        code1_count = events.filter("code", is_in=make_codelist("Code1")).count()
+        code2_count = events.filter("code", is_in=make_codelist("Code2")).count()
+        either_value = (
+            events.filter("code", is_in=make_codelist("Code1", "Code2"))
+            .latest()
+            .get("numeric_value")
+        )
+
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = sorted(extract(MultipleCodelists, backend), key=lambda r: r["patient_id"])
+    assert results == [
+        dict(patient_id=1, code1_count=2, code2_count=1, either_value=20.0),
+        dict(patient_id=2, code1_count=None, code2_count=None, either_value=None),
+        dict(patient_id=3, code1_count=1, code2_count=None, either_value=None),
+    ]
+
+
+@pytest.mark.parametrize("population_first", [False, True])
+def test_population_first(duckdb_file, population_first):
+    class SmallPopulation:
+        population = table("patients").filter(sex="F").exists()
+        event_count = table("clinical_events").count()
+        first_date = table("clinical_events").earliest().get("date")
+
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = extract(SmallPopulation, backend, population_first=population_first)
+    assert sorted(results, key=lambda r: r["patient_id"]) == [
+        dict(patient_id=2, event_count=1, first_date=datetime(2021, 6, 5)),
+        dict(patient_id=3, event_count=1, first_date=datetime(2020, 11, 20)),
+    ]
+
+
+def test_combined_aggregates(duckdb_file):
+    events = table("clinical_events").filter("code", is_in=make_codelist("Code1"))
+
+    class Aggregates(OldCohortWithPopulation):
+        has_event = events.exists()
+        event_count = events.count()
+        value_total = events.sum("numeric_value")
+
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = sorted(extract(Aggregates, backend), key=lambda r: r["patient_id"])
+    assert results == [
+        dict(patient_id=1, has_event=True, event_count=2, value_total=30.0),
+        dict(patient_id=2, has_event=None, event_count=None, value_total=None),
+        dict(patient_id=3, has_event=True, event_count=1, value_total=None),
+    ]
+
+
+def test_combined_rows(duckdb_file):
+    events = table("clinical_events")
+
+    class FirstAndLast(OldCohortWithPopulation):
+        first_code = events.earliest().get("code")
+        last_code = events.latest().get("code")
+        last_date = events.latest().get("date")
+        smallest_value = events.first_by("numeric_value").get("numeric_value")
+
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = sorted(extract(FirstAndLast, backend), key=lambda r: r["patient_id"])
+    assert results == [
+        dict(
+            patient_id=1,
+            first_code="Code1",
+            last_code="Code1",
+            last_date=datetime(2021, 5, 2),
+            smallest_value=10.0,
+        ),
+        dict(
+            patient_id=2,
+            first_code="Code1",
+            last_code="Code1",
+            last_date=datetime(2021, 6, 5),
+            smallest_value=40.0,
+        ),
+        dict(
+            patient_id=3,
+            first_code="Code1",
+            last_code="Code1",
+            last_date=datetime(2020, 11, 20),
+            smallest_value=None,
+        ),
+    ]
+
+
+PARAMETERISED_DEFINITION = """
+from databuilder import codelist, table
+
+index_date_range = ["2021-01-31", "2021-05-31"]
+parameterise_index_date = True
+
+def cohort(index_date):
+    class Cohort:
+        population = table("practice_registrations").date_in_range(index_date).exists()
+        event_count = table("clinical_events").filter(
+            "date", on_or_before=index_date
+        ).count()
+        age = table("patients").age_as_of(index_date)
+        first_value = (
+            table("clinical_events")
+            .filter("code", is_in=codelist(["Code1"], "ctv3"))
+            .earliest()
+            .get("numeric_value")
+        )
+
+    return Cohort
+"""
+
+PARAMETERISED_EXPECTED = {
+    "2021-01-31": [
+        dict(patient_id="1", event_count="1", age="30", first_value="10.0"),
+        dict(patient_id="2", event_count="", age="20", first_value=""),
+        dict(patient_id="3", event_count="1", age="35", first_value=""),
+    ],
+    "2021-05-31": [
+        dict(patient_id="1", event_count="3", age="30", first_value="10.0"),
+        dict(patient_id="2", event_count="", age="21", first_value=""),
+        dict(patient_id="3", event_count="1", age="35", first_value=""),
+    ],
+}
+
+
+@pytest.fixture
+def parameterised_definition(tmp_path):
+    # Each test gets its own module name as they're cached once imported
+    path = tmp_path / f"parameterised_{tmp_path.name}.py"
+    path.write_text(PARAMETERISED_DEFINITION)
+    return path
+
+
+def test_parameterised_index_date(
+    duckdb_file, parameterised_definition, tmp_path, mocker
+):
+    get_queries = mocker.spy(DuckDBQueryEngine, "get_queries")
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+    )
+    # The queries are built once and executed for each index date
+    assert get_queries.call_count == 1
+    for index_date, expected in PARAMETERISED_EXPECTED.items():
+        assert read_csv(tmp_path / f"cohort_{index_date}.csv") == expected
+
+
+@pytest.fixture
+def created_tables():
+    """
+    Record the name of each temporary table as it's created
+    """
+    names = []
+
+    def record_create(conn, cursor, statement, *args):
+        if statement.split()[:3] == ["CREATE", "TEMPORARY", "TABLE"]:
+            names.append(statement.split()[3])
+
+    sqlalchemy.event.listen(Engine, "before_cursor_execute", record_create)
+    yield names
+    sqlalchemy.event.remove(Engine, "before_cursor_execute", record_create)
+
+
+def test_parameterised_index_date_reuses_independent_tables(
+    duckdb_file, parameterised_definition, tmp_path, created_tables
+):
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+    )
+    for index_date, expected in PARAMETERISED_EXPECTED.items():
+        assert read_csv(tmp_path / f"cohort_{index_date}.csv") == expected
+    # The codelist and the tables of patients' dates of birth and first values don't
+    # depend on the index date so they're created just once, while the tables of
+    # registrations and event counts are recreated for each date
+    counts = {name: created_tables.count(name) for name in created_tables}
+    assert sorted(counts.values()) == [1, 1, 1, 2, 2]
+
+
+def test_index_date_range_shares_tables_between_dates(
+    duckdb_file, parameterised_definition, tmp_path, created_tables
+):
+    parameterised_definition.write_text(
+        PARAMETERISED_DEFINITION.replace("parameterise_index_date = True", "")
+    )
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+    )
+    for index_date, expected in PARAMETERISED_EXPECTED.items():
+        assert read_csv(tmp_path / f"cohort_{index_date}.csv") == expected
+    # Each date gets its own cohort, but the codelist and the tables of patients' dates
+    # of birth and first values are the same for both and are created just once
+    assert len(set(created_tables)) == len(created_tables)
+    assert len([name for name in created_tables if "codelist" in name]) == 1
+    assert len(created_tables) == 3 + 2 * 2
+
+
+def test_session_only_connects_when_needed(duckdb_file, mocker):
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    query_engine = DuckDBQueryEngine({}, backend)
+    connect = mocker.spy(query_engine.engine, "connect")
+    with query_engine.session() as session:
+        assert connect.call_count == 0
+        assert list(extract(Cohort, backend, session=session))
+        assert connect.call_count == 1
+
+
+@pytest.mark.parametrize("parameterise", [True, False])
+def test_index_dates_in_parallel(
+    duckdb_file, parameterised_definition, tmp_path, parameterise
+):
+    definition = PARAMETERISED_DEFINITION
+    if not parameterise:
+        definition = definition.replace("parameterise_index_date = True", "")
+    parameterised_definition.write_text(definition)
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+        jobs=2,
+    )
+    for index_date, expected in PARAMETERISED_EXPECTED.items():
+        assert read_csv(tmp_path / f"cohort_{index_date}.csv") == expected
+
+
+@pytest.mark.parametrize("population_first", [False, True])
+def test_index_date_range_with_changing_population(
+    duckdb_file, parameterised_definition, tmp_path, population_first
+):
+    # Patient 4 is only registered, and so in the population, on the second date
+    connection = duckdb.connect(str(duckdb_file))
+    connection.execute(
+        "INSERT INTO practice_registrations (patient_id, date_start) "
+        "VALUES (4, DATE '2021-03-01')"
+    )
+    connection.execute(
+        "INSERT INTO clinical_events VALUES (4, 'Code1', 'ctv3', DATE '2020-01-01', 1.0)"
+    )
+    connection.close()
+    parameterised_definition.write_text(
+        """
+from databuilder import table
+
+index_date_range = ["2021-01-31", "2021-05-31"]
+parameterise_index_date = True
+
+def cohort(index_date):
+    class Cohort:
+        population = table("practice_registrations").date_in_range(index_date).exists()
+        first_code = table("clinical_events").earliest().get("code")
+
+    return Cohort
+"""
+    )
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+        population_first=population_first,
+    )
+    first_codes = {"1": "Code1", "2": "Code1", "3": "Code1", "4": "Code1"}
+    assert read_csv(tmp_path / "cohort_2021-01-31.csv") == [
+        dict(patient_id=patient_id, first_code=first_codes[patient_id])
+        for patient_id in ["1", "2", "3"]
+    ]
+    assert read_csv(tmp_path / "cohort_2021-05-31.csv") == [
+        dict(patient_id=patient_id, first_code=first_codes[patient_id])
+        for patient_id in ["1", "2", "3", "4"]
+    ]
+
+
+def test_vectorised_index_dates(
+    duckdb_file, parameterised_definition, tmp_path, mocker
+):
+    execute_query = mocker.spy(DuckDBQueryEngine, "execute_query")
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+        vectorise_index_dates=True,
+    )
+    assert execute_query.call_count == 1
+    for index_date, expected in PARAMETERISED_EXPECTED.items():
+        assert read_csv(tmp_path / f"cohort_{index_date}.csv") == expected
+
+
+@pytest.mark.parametrize("population_first", [False, True])
+def test_vectorised_index_dates_with_population_derived_from_index_date(
+    duckdb_file, parameterised_definition, tmp_path, population_first
+):
+    # Patient 4 is only registered, and so in the population, on the second date
+    connection = duckdb.connect(str(duckdb_file))
+    connection.execute(
+        "INSERT INTO practice_registrations (patient_id, date_start) "
+        "VALUES (4, DATE '2021-03-01')"
+    )
+    connection.close()
+    parameterised_definition.write_text(
+        """
+from databuilder import table
+from databuilder.query_model import RoundToFirstOfMonth
+
+index_date_range = ["2021-01-31", "2021-05-31"]
+parameterise_index_date = True
+
+def cohort(index_date):
+    class Cohort:
+        population = table("practice_registrations").filter(
+            "date_start", on_or_before=RoundToFirstOfMonth(index_date)
+        ).exists()
+        event_count = table("clinical_events").filter(
+            "date", less_than=RoundToFirstOfMonth(index_date)
+        ).count()
+
+    return Cohort
+"""
+    )
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort_*.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+        population_first=population_first,
+        vectorise_index_dates=True,
+    )
+    # Each file is written in patient_id order
+    with (tmp_path / "cohort_2021-01-31.csv").open() as f:
+        assert list(csv.DictReader(f)) == [
+            dict(patient_id="1", event_count=""),
+            dict(patient_id="2", event_count=""),
+            dict(patient_id="3", event_count="1"),
+        ]
+    with (tmp_path / "cohort_2021-05-31.csv").open() as f:
+        assert list(csv.DictReader(f)) == [
+            dict(patient_id="1", event_count="2"),
+            dict(patient_id="2", event_count=""),
+            dict(patient_id="3", event_count="1"),
+            dict(patient_id="4", event_count=""),
+        ]
+
+
+def test_vectorised_index_dates_rejects_filter_on_index_date_and_table(
+    duckdb_file, parameterised_definition, tmp_path
+):
+    parameterised_definition.write_text(
+        """
+from databuilder import table
+
+index_date_range = ["2021-01-31", "2021-05-31"]
+parameterise_index_date = True
+
+def cohort(index_date):
+    class Cohort:
+        population = table("practice_registrations").exists()
+        _last_event_date = (
+            table("clinical_events")
+            .filter("date", on_or_before=index_date)
+            .latest()
+            .get("date")
+        )
+        event_count = table("clinical_events").filter(
+            "date", less_than=_last_event_date
+        ).count()
+
+    return Cohort
+"""
+    )
+    with pytest.raises(ValueError, match="depends on both the index date"):
+        run_cohort_action(
+            generate_cohort,
+            parameterised_definition,
+            tmp_path / "cohort_*.csv",
+            backend_id="duckdb",
+            db_url=f"duckdb:///{duckdb_file}",
+            vectorise_index_dates=True,
+        )
+
+
+def test_vectorised_index_dates_to_single_file(
+    duckdb_file, parameterised_definition, tmp_path
+):
+    run_cohort_action(
+        generate_cohort,
+        parameterised_definition,
+        tmp_path / "cohort.csv",
+        backend_id="duckdb",
+        db_url=f"duckdb:///{duckdb_file}",
+        vectorise_index_dates=True,
+    )
+    with (tmp_path / "cohort.csv").open() as f:
+        results = list(csv.DictReader(f))
+    assert results == [
+        dict(index_date=index_date, **row)
+        for index_date, expected in PARAMETERISED_EXPECTED.items()
+        for row in expected
+    ]
+
+
+def test_vectorised_index_dates_requires_parameterised_definition(
+    duckdb_file, parameterised_definition, tmp_path
+):
+    parameterised_definition.write_text(
+        PARAMETERISED_DEFINITION.replace("parameterise_index_date = True", "")
+    )
+    with pytest.raises(ValueError, match="parameterise_index_date"):
+        run_cohort_action(
+            generate_cohort,
+            parameterised_definition,
+            tmp_path / "cohort_*.csv",
+            backend_id="duckdb",
+            db_url=f"duckdb:///{duckdb_file}",
+            vectorise_index_dates=True,
+        )
+
+
+def test_sharding(duckdb_file, created_tables):
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    results = list(extract(Cohort, backend, shards=2))
+    # Patient IDs run from 1 to 3, so patient 1 is in the first shard and patients 2
+    # and 3 in the second, and the shards' results come out in that order
+    assert results == EXPECTED
+    # Every table is created afresh for each shard
+    counts = {name: created_tables.count(name) for name in created_tables}
+    assert set(counts.values()) == {2}
+
+
+def test_resuming_extraction(duckdb_file):
+    backend = DuckDBBackend(f"duckdb:///{duckdb_file}")
+    query_engine = backend.query_engine_class({}, backend)
+    assert query_engine.yields_results_in_patient_id_order()
+    # Without sorting them ourselves, the results are in patient_id order and start
+    # after the given patient, however many shards we split them into
+    for shards in [1, 2]:
+        results = list(extract(Cohort, backend, resume_after=1, shards=shards))
+        assert results == EXPECTED[1:]
+
+
+def test_sampling(tmp_path):
+    path = tmp_path / "sample.duckdb"
+    connection = duckdb.connect(str(path))
+    populate(connection)
+    connection.execute(
+        "INSERT INTO practice_registrations (patient_id, date_start) "
+        "SELECT range, DATE '2000-01-01' FROM range(4, 1001)"
+    )
+    connection.close()
+
+    class Cohort(OldCohortWithPopulation):
+        sex = table("patients").first_by("patient_id").get("sex")
+
+    backend = DuckDBBackend(f"duckdb:///{path}")
+    results = list(extract(Cohort, backend, sample_percent=10))
+    sampled = {row["patient_id"] for row in results}
+    threshold = int(SAMPLE_HASH_MODULUS * 10 / 100)
+    assert sampled == {
+        patient_id
+        for patient_id in range(1, 1001)
+        if (patient_id * SAMPLE_HASH_MULTIPLIER) % SAMPLE_HASH_MODULUS < threshold
+    }
+    assert 50 < len(sampled) < 150
+    # A larger sample includes the smaller one
+    assert sampled < {
+        row["patient_id"] for row in extract(Cohort, backend, sample_percent=20)
+    }
+
+
+def test_sample_hash_is_the_same_in_sql_and_pandas():
+    # Including ids large enough to overflow a naive multiplication, and negative ids
+    # for which SQL and Python disagree about remainders
+    patient_ids = [1, 2 ** 31, 3_500_000_000, 2 ** 32 + 5, 2 ** 62, 2 ** 63 - 1, -1]
+    patient_ids.append(-(2 ** 40))
+    expected = [
+        (patient_id * SAMPLE_HASH_MULTIPLIER) % SAMPLE_HASH_MODULUS
+        for patient_id in patient_ids
+    ]
+    hashes = get_sample_hash(pandas.Series(patient_ids, dtype="int64"))
+    assert list(hashes) == expected
+    engine = sqlalchemy.create_engine("duckdb://")
+    query = sqlalchemy.select(
+        [
+            get_sample_hash(sqlalchemy.literal(patient_id, sqlalchemy.BigInteger))
+            for patient_id in patient_ids
+        ]
+    )
+    with engine.connect() as connection:
+        assert list(connection.execute(query).one()) == expected
+
+
+def test_incremental_extraction(duckdb_file, tmp_path, mocker):
+    class Original(OldCohortWithPopulation):
+        _events = table("clinical_events").filter("code", is_in=make_codelist("Code1"))
+        event_count = _events.count()
+        last_value = _events.latest().get("numeric_value")
+
+    class Edited(OldCohortWithPopulation):
+        _events = table("clinical_events").filter("code", is_in=make_codelist("Code1"))
+        event_count = _events.count()
+        last_value = _events.earliest().get("numeric_value")
+        sex = table("patients").first_by("patient_id").get("sex")
+
+    def generate(cohort):
+        generate_cohort(
+            cohort,
+            None,
+            tmp_path / "cohort.csv",
+            "",
+            backend_id="duckdb",
+            db_url=f"duckdb:///{duckdb_file}",
+            incremental=True,
+        )
+        return read_csv(tmp_path / "cohort.csv")
+
+    spy = mocker.spy(databuilder.main, "extract")
+    assert generate(Original) == [
+        dict(patient_id="1", event_count="2", last_value="20.0"),
+        dict(patient_id="2", event_count="", last_value=""),
+        dict(patient_id="3", event_count="1", last_value=""),
+    ]
+    assert (tmp_path / "cohort.csv.manifest.json").exists()
+    assert spy.call_args.kwargs.get("columns") is None
+
+    # Only the changed and new columns are extracted
+    assert generate(Edited) == [
+        dict(patient_id="1", event_count="2", last_value="10.0", sex="M"),
+        dict(patient_id="2", event_count="", last_value="", sex="F"),
+        dict(patient_id="3", event_count="1", last_value="", sex="F"),
+    ]
+    assert spy.call_args.kwargs["columns"] == ["last_value", "sex"]
+
+    # And with nothing changed, nothing but the population is extracted
+    generate(Edited)
+    assert spy.call_args.kwargs["columns"] == []
+
+
+def test_incremental_extraction_with_changed_patients(duckdb_file, tmp_path, mocker):
+    class Original(OldCohortWithPopulation):
+        event_count = table("clinical_events").count()
+
+    class Edited(OldCohortWithPopulation):
+        event_count = table("clinical_events").count()
+        sex = table("patients").first_by("patient_id").get("sex")
+
+    output_file = tmp_path / "cohort.csv"
+
+    def generate(cohort):
+        generate_cohort(
+            cohort,
+            None,
+            output_file,
+            "",
+            backend_id="duckdb",
+            db_url=f"duckdb:///{duckdb_file}",
+            incremental=True,
+        )
+
+    generate(Original)
+    # Lose the last patient from the previous output, so that it no longer matches
+    lines = output_file.read_text().splitlines(keepends=True)
+    output_file.write_text("".join(lines[:-1]))
+
+    spy = mocker.spy(databuilder.main, "extract")
+    generate(Edited)
+    # We tried extracting just the new column, and then gave up and extracted
+    # everything
+    assert [call.kwargs.get("columns") for call in spy.call_args_list] == [
+        ["sex"],
+        None,
+    ]
+    assert read_csv(output_file) == [
+        dict(patient_id="1", event_count="3", sex="M"),
+        dict(patient_id="2", event_count="1", sex="F"),
+        dict(patient_id="3", event_count="1", sex="F"),
+    ]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "cohort.csv",
+        "cohort.csv.manifest.json",
+        "data.duckdb",
+    ]
+
+
+def read_csv(path):
+    with path.open() as f:
+        return sorted(csv.DictReader(f), key=lambda r: int(r["patient_id"]))
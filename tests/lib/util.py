@@ -44,6 +44,32 @@ class OldCohortWithPopulation:
             cls.population = table("practice_registrations").exists()
 
 
+# Every query engine should agree on which rows come first when the sort values include
+# NULLs, which sort as the lowest value. Each engine's tests populate clinical_events
+# with NULL_SORT_EVENTS as (patient_id, code, date) and check the results are
+# NULL_SORT_EXPECTED.
+NULL_SORT_EVENTS = [
+    (1, "Code1", None),
+    (1, "Code2", "2021-01-01"),
+    (1, "Code3", "2021-02-01"),
+    (2, "Code4", "2021-03-01"),
+    (2, "Code5", None),
+]
+
+
+class NullSortCohort(OldCohortWithPopulation):
+    first_code = table("clinical_events").earliest().get("code")
+    last_code = table("clinical_events").latest().get("code")
+    # MIN() would skip the NULL and give the first non-NULL date
+    first_date = table("clinical_events").earliest().get("date")
+
+
+NULL_SORT_EXPECTED = [
+    dict(patient_id=1, first_code="Code1", last_code="Code3", first_date=None),
+    dict(patient_id=2, first_code="Code5", last_code="Code4", first_date=None),
+]
+
+
 class MockPatientsTable(EventFrame):
     patient_id = IdColumn("patient_id")
     height = IntColumn("height")
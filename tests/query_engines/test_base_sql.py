@@ -1,6 +1,21 @@
+import contextlib
+import threading
+import time
+
 import pytest
 
-from databuilder.query_engines.base_sql import split_list_into_batches
+from databuilder.backends.duckdb import DuckDBBackend
+from databuilder.backends.tpp import TPPBackend
+from databuilder.query_engines.base_sql import (
+    run_in_dependency_order,
+    split_list_into_batches,
+    split_range,
+)
+from databuilder.query_model import Parameter, table
+from databuilder.query_utils import get_column_definitions
+from databuilder.sqlalchemy_utils import get_temporary_tables_in_setup_order
+
+from ..lib.util import OldCohortWithPopulation, make_codelist
 
 
 @pytest.mark.parametrize(
@@ -18,3 +33,419 @@ def test_split_list_into_batches(lst, size, expected):
     results = split_list_into_batches(lst, size)
     results = list(results)
     assert results == expected
+
+
+@pytest.mark.parametrize(
+    "start,end,parts,expected",
+    [
+        (0, 10, 3, [(0, 3), (3, 6), (6, 10)]),
+        (5, 7, 4, [(5, 6), (6, 7)]),
+        (1, 2, 1, [(1, 2)]),
+        (0, 0, 3, [(0, 0)]),
+    ],
+)
+def test_split_range(start, end, parts, expected):
+    assert split_range(start, end, parts) == expected
+
+
+def test_run_in_dependency_order():
+    dependencies = {"a": [], "b": [], "c": ["a", "b"], "d": ["c"], "e": []}
+    finished = []
+    running = set()
+    max_running = 0
+    lock = threading.Lock()
+
+    def run(item):
+        nonlocal max_running
+        with lock:
+            assert all(other in finished for other in dependencies[item])
+            running.add(item)
+            max_running = max(max_running, len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(item)
+            finished.append(item)
+
+    run_in_dependency_order(dependencies, run, max_workers=2)
+    assert sorted(finished) == ["a", "b", "c", "d", "e"]
+    assert max_running == 2
+
+
+def test_run_in_dependency_order_reraises_errors():
+    def run(item):
+        if item == "b":
+            raise ValueError("b failed")
+
+    with pytest.raises(ValueError, match="b failed"):
+        run_in_dependency_order({"a": [], "b": ["a"]}, run, max_workers=2)
+
+
+def get_queries(cohort):
+    backend = DuckDBBackend("duckdb://")
+    query_engine = backend.query_engine_class(get_column_definitions(cohort), backend)
+    return query_engine.get_queries()
+
+
+def get_setup_queries(cohort):
+    setup_queries, _, _ = get_queries(cohort)
+    return setup_queries
+
+
+def count_table_scans(cohort, table_name):
+    setup_queries, results_query, _ = get_queries(cohort)
+    sql = "\n".join(str(query) for query in setup_queries + [results_query])
+    return sql.count(f"FROM {table_name}")
+
+
+def test_identical_subexpressions_are_only_evaluated_once():
+    def latest_event_date():
+        # Filtering on a value derived from another table gives us a subgraph which
+        # isn't simply a chain of table operations
+        registrations = table("practice_registrations")
+        registration_date = registrations.earliest("date_start").get("date_start")
+        events = table("clinical_events").filter("code", is_in=make_codelist("abc"))
+        events = events.filter("date", on_or_after=registration_date)
+        return events.latest().get("date")
+
+    class OneVariable(OldCohortWithPopulation):
+        date_1 = latest_event_date()
+
+    class TwoIdenticalVariables(OldCohortWithPopulation):
+        date_1 = latest_event_date()
+        date_2 = latest_event_date()
+
+    assert len(get_setup_queries(TwoIdenticalVariables)) == len(
+        get_setup_queries(OneVariable)
+    )
+
+
+def test_codelist_filters_on_the_same_table_share_a_single_scan():
+    events = table("clinical_events")
+
+    class Cohort(OldCohortWithPopulation):
+        has_a = events.filter("code", is_in=make_codelist("a1", "a2")).exists()
+        has_b = events.filter("code", is_in=make_codelist("b1")).exists()
+        c_date = events.filter("code", is_in=make_codelist("c1")).latest().get("date")
+        # A different coding system, so this can't share the scan
+        has_d = events.filter(
+            "code", is_in=make_codelist("d1", system="snomed")
+        ).exists()
+
+    assert count_table_scans(Cohort, "clinical_events") == 2
+
+
+def test_single_codelist_filter_is_not_materialized():
+    class Cohort(OldCohortWithPopulation):
+        has_a = (
+            table("clinical_events").filter("code", is_in=make_codelist("a1")).exists()
+        )
+
+    setup_queries = get_setup_queries(Cohort)
+    assert not any("materialized_table" in str(query) for query in setup_queries)
+
+
+def test_population_first_restricts_tables_to_population():
+    class Cohort:
+        population = table("patients").filter(sex="F").exists()
+        event_count = table("clinical_events").count()
+
+    backend = DuckDBBackend("duckdb://")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, population_first=True
+    )
+    setup_queries, results_query, _ = query_engine.get_queries()
+    population_table = query_engine.population_table
+    # The population is written to a table first, and then used to restrict the events
+    table_names = [query.name for query in setup_queries]
+    (events_query,) = [q for q in setup_queries if "clinical_events" in str(q)]
+    assert table_names.index(population_table.name) < table_names.index(
+        events_query.name
+    )
+    assert f"IN (SELECT {population_table.name}.patient_id" in str(events_query)
+    assert f"FROM {population_table.name} LEFT OUTER JOIN" in str(results_query)
+
+
+def test_mssql_writes_intermediate_tables_to_temporary_database():
+    class Cohort(OldCohortWithPopulation):
+        _events = table("clinical_events").filter("code", is_in=make_codelist("abc"))
+        first_date = _events.earliest().get("date")
+        last_date = _events.latest().get("date")
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, setup_connections=4
+    )
+    setup_queries, results_query, cleanup_queries = query_engine.get_queries()
+    assert query_engine.can_create_tables_concurrently()
+    # Every intermediate table lives in the temporary database, where other
+    # connections can see it, and is dropped afterwards
+    assert not any("#" in str(query) for query in setup_queries)
+    results_sql = str(results_query.compile(dialect=query_engine.engine.dialect))
+    assert "FROM [TempDB].dbo.[TempSetup_" in results_sql
+    assert len(cleanup_queries) == len(setup_queries) - 1
+
+
+def test_mssql_names_intermediate_tables_after_their_contents():
+    def get_table_names(code, resume_key="job-1"):
+        class Cohort(OldCohortWithPopulation):
+            _events = table("clinical_events").filter("code", is_in=make_codelist(code))
+            first_date = _events.earliest().get("date")
+
+        backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+        query_engine = backend.query_engine_class(
+            get_column_definitions(Cohort), backend, resume_key=resume_key
+        )
+        _, results_query, _ = query_engine.get_queries()
+        return {
+            table.name for table in get_temporary_tables_in_setup_order(results_query)
+        }
+
+    # The names are the same each time we build the queries, so a re-run can find the
+    # tables created by an earlier attempt
+    names = get_table_names("abc")
+    assert names == get_table_names("abc")
+    assert all(name.startswith("TempSetup_") for name in names)
+    # But they change along with what the tables contain, so only the population
+    # table is the same for a different codelist
+    assert len(names & get_table_names("def")) == 1
+    # And no other extraction can find (and drop) our tables
+    assert not names & get_table_names("abc", resume_key="job-2")
+    # Unless we've been asked to, we don't leave anything in the temporary database
+    assert all(name.startswith("#") for name in get_table_names("abc", None))
+
+
+def test_mssql_leaves_tables_in_shared_cache():
+    class Cohort(OldCohortWithPopulation):
+        has_event = (
+            table("clinical_events").filter("code", is_in=make_codelist("abc")).exists()
+        )
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, shared_cache=True
+    )
+    _, results_query, cleanup_queries = query_engine.get_queries()
+    assert query_engine.uses_shared_cache()
+    tables = get_temporary_tables_in_setup_order(results_query)
+    assert all(table.name.startswith("TempCache_") for table in tables)
+    # Nothing is dropped when we finish: these tables are only dropped on eviction
+    assert cleanup_queries == []
+
+
+def test_mssql_drops_tables_outside_shared_cache():
+    class Cohort(OldCohortWithPopulation):
+        has_event = (
+            table("clinical_events").filter("code", is_in=make_codelist("abc")).exists()
+        )
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    # When sharding, everything derived from a table depends on the shard and so
+    # can't be shared
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, shared_cache=True, shards=2
+    )
+    _, results_query, _ = query_engine.get_queries()
+    tables = get_temporary_tables_in_setup_order(results_query)
+    cached = [table for table in tables if table.cleanup_queries == []]
+    assert [table.name for table in cached] == list(query_engine.resumable_table_names)
+    assert len(cached) < len(tables)
+
+
+def test_mssql_skips_creating_tables_which_already_exist(mocker):
+    class Cohort(OldCohortWithPopulation):
+        has_event = (
+            table("clinical_events").filter("code", is_in=make_codelist("abc")).exists()
+        )
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, resume_key="job-1"
+    )
+    _, results_query, _ = query_engine.get_queries()
+    (codelist_table,) = [
+        table
+        for table in get_temporary_tables_in_setup_order(results_query)
+        if "codelist" in table.name
+    ]
+    connection = mocker.MagicMock()
+
+    mocker.patch("databuilder.query_engines.mssql.table_exists", return_value=True)
+    query_engine.create_table(connection, codelist_table, {})
+    connection.execute.assert_not_called()
+
+    mocker.patch("databuilder.query_engines.mssql.table_exists", return_value=False)
+    query_engine.create_table(connection, codelist_table, {})
+    assert connection.execute.call_count == len(codelist_table.setup_queries)
+    connection.begin.assert_called_once()
+
+
+def test_mssql_batched_download_reuses_tables_within_session(mocker):
+    class Cohort(OldCohortWithPopulation):
+        _events = table("clinical_events").filter("code", is_in=make_codelist("abc"))
+        first_date = _events.earliest().get("date")
+        recent_event = _events.filter(
+            "date", on_or_after=Parameter("index_date")
+        ).exists()
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    query_engine = backend.query_engine_class(get_column_definitions(Cohort), backend)
+    connect = mocker.patch.object(query_engine.engine, "connect")
+
+    @contextlib.contextmanager
+    def fetch_results_in_batches(run_preparatory_queries, setup_connection, **kwargs):
+        run_preparatory_queries(setup_connection)
+        yield iter([])
+
+    mocker.patch(
+        "databuilder.query_engines.mssql.fetch_results_in_batches",
+        fetch_results_in_batches,
+    )
+    create_table = mocker.patch.object(query_engine, "create_table")
+    created = []
+    with query_engine.session():
+        for index_date in ["2021-01-01", "2021-02-01"]:
+            with query_engine.execute_query({"index_date": index_date}) as results:
+                assert list(results) == []
+            created.append([call.args[1] for call in create_table.call_args_list])
+            create_table.reset_mock()
+    # The second execution only recreates the tables which depend on the index date
+    first, second = created
+    assert set(second) < set(first)
+    assert all(table.depends_on_parameters for table in second)
+    # Which we create on the session's connection, where the tables we've kept are
+    # session-scoped temporary tables
+    assert connect.call_count == 1
+    assert all(table.name.startswith("#") for table in first)
+
+
+def test_mssql_drops_tables_after_failed_download(mocker):
+    class Cohort(OldCohortWithPopulation):
+        has_event = (
+            table("clinical_events").filter("code", is_in=make_codelist("abc")).exists()
+        )
+
+    backend = TPPBackend("mssql://localhost", temporary_database="TempDB")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, resume_key="job-1"
+    )
+    mocker.patch(
+        "databuilder.query_engines.mssql.fetch_results_in_batches",
+        side_effect=RuntimeError("download failed"),
+    )
+    drop_tables = mocker.patch.object(query_engine, "drop_tables")
+    with pytest.raises(RuntimeError, match="download failed"):
+        with query_engine.execute_query():
+            pass  # pragma: no cover
+    # Only the tables named after their contents are left for the next attempt
+    assert query_engine.resumable_table_names
+    drop_tables.assert_called_once_with(
+        mocker.ANY, keep=query_engine.resumable_table_names
+    )
+
+
+def test_create_tables_concurrently_connects_on_calling_thread(mocker):
+    class Cohort(OldCohortWithPopulation):
+        has_a = (
+            table("clinical_events").filter("code", is_in=make_codelist("a")).exists()
+        )
+        has_b = (
+            table("clinical_events").filter("code", is_in=make_codelist("b")).exists()
+        )
+
+    backend = DuckDBBackend("duckdb://")
+    query_engine = backend.query_engine_class(
+        get_column_definitions(Cohort), backend, setup_connections=2
+    )
+    _, results_query, _ = query_engine.get_queries()
+    tables = get_temporary_tables_in_setup_order(results_query)
+    connecting_threads = []
+
+    def connect():
+        connecting_threads.append(threading.current_thread())
+        return mocker.MagicMock()
+
+    mocker.patch.object(query_engine, "engine").connect.side_effect = connect
+    query_engine.create_tables_concurrently(tables, {})
+    assert connecting_threads == [threading.current_thread()] * 2
+
+
+def test_only_required_columns_are_selected_from_tables():
+    class Cohort(OldCohortWithPopulation):
+        first_date = table("clinical_events").earliest().get("date")
+        has_code = (
+            table("clinical_events").filter("code", is_in=make_codelist("a")).exists()
+        )
+
+    setup_queries, results_query, _ = get_queries(Cohort)
+    sql = "\n".join(str(query) for query in setup_queries + [results_query])
+    assert "clinical_events.date" in sql
+    assert "clinical_events.system" in sql
+    assert "numeric_value" not in sql
+
+
+def test_aggregates_over_the_same_source_are_combined():
+    events = table("clinical_events").filter("code", is_in=make_codelist("a"))
+
+    class Cohort(OldCohortWithPopulation):
+        has_event = events.exists()
+        event_count = events.count()
+        value_total = events.sum("numeric_value")
+
+    setup_queries = get_setup_queries(Cohort)
+    # One for the codelist, one for the population and one for all three aggregates
+    assert len(setup_queries) == 4
+    (aggregate_query,) = [q for q in setup_queries if "clinical_events" in str(q)]
+    sql = str(aggregate_query)
+    assert sql.count("GROUP BY") == 1
+    assert "count(" in sql and "sum(" in sql and "patient_id_exists" in sql
+
+
+def test_first_and_last_rows_share_a_single_sort():
+    events = table("clinical_events").filter("code", is_in=make_codelist("a"))
+
+    class Cohort(OldCohortWithPopulation):
+        first_code = events.earliest().get("code")
+        last_code = events.latest().get("code")
+        first_value = events.first_by("numeric_value").get("code")
+
+    setup_queries, results_query, _ = get_queries(Cohort)
+    sql = "\n".join(str(query) for query in setup_queries + [results_query])
+    assert sql.count("FROM clinical_events") == 1
+    assert sql.count("row_number()") == 3
+
+
+def test_last_date_uses_max():
+    events = table("clinical_events").filter("code", is_in=make_codelist("a"))
+
+    class Cohort(OldCohortWithPopulation):
+        first_date = events.earliest().get("date")
+        last_date = events.latest().get("date")
+        event_count = events.count()
+
+    setup_queries, results_query, _ = get_queries(Cohort)
+    sql = "\n".join(str(query) for query in setup_queries + [results_query])
+    # The earliest date may be NULL, which MIN would skip, so that needs a sort
+    assert sql.count("row_number()") == 1
+    assert "NULLS FIRST" in sql
+    # The other two are computed by a single aggregation
+    assert sql.count("GROUP BY") == 2
+    assert "min(" not in sql and "max(" in sql
+
+
+@pytest.mark.parametrize(
+    "backend,descending,expected",
+    [
+        # NULLs sort first in ascending order, so `earliest()` would find a NULL where
+        # MIN would not
+        (DuckDBBackend, False, "window"),
+        (DuckDBBackend, True, "aggregate"),
+        (TPPBackend, False, "window"),
+        (TPPBackend, True, "aggregate"),
+    ],
+)
+def test_first_row_strategy(backend, descending, expected):
+    events = table("clinical_events")
+    row = events.last_by("date") if descending else events.first_by("date")
+    query_engine = backend.query_engine_class({}, backend(None))
+    assert query_engine.first_row_strategy(row, {"date"}) == expected
+    assert query_engine.first_row_strategy(row, {"date", "code"}) == "window"
@@ -0,0 +1,388 @@
+import csv
+from datetime import date
+
+import pytest
+
+from databuilder import main
+from databuilder.main import (
+    extract,
+    extract_all_index_dates,
+    extract_for_index_dates,
+    get_checkpoint_path,
+    write_output_resumably,
+)
+from databuilder.query_engines.in_memory import InMemoryQueryEngine
+from databuilder.query_model import Parameter, categorise, table
+
+from ..lib.mock_backend import backend_factory
+from ..lib.util import (
+    NULL_SORT_EVENTS,
+    NULL_SORT_EXPECTED,
+    NullSortCohort,
+    OldCohortWithPopulation,
+    make_codelist,
+)
+
+InMemoryBackend = backend_factory(InMemoryQueryEngine)
+
+
+@pytest.fixture
+def in_memory(tmp_path):
+    def run(cohort, **tables):
+        # Every patient needs a registration in order to be in the default population
+        patient_ids = {
+            row.get("PatientId", row.get("patient_id"))
+            for rows in tables.values()
+            for row in rows
+        }
+        tables.setdefault(
+            "practice_registrations",
+            [
+                dict(PatientId=patient_id, StartDate="1900-01-01", EndDate="9999-12-31")
+                for patient_id in patient_ids
+            ],
+        )
+        for name, rows in tables.items():
+            write_csv(tmp_path / f"{name}.csv", get_file_columns(name), rows)
+        return list(extract(cohort, InMemoryBackend(str(tmp_path))))
+
+    return run
+
+
+def get_file_columns(file_stem):
+    if file_stem == "positive_tests":
+        return list(InMemoryBackend.positive_tests.columns)
+    (table,) = [
+        table
+        for table in InMemoryBackend.tables.values()
+        if getattr(table, "source", None) == file_stem
+    ]
+    return [column.source for column in table.columns.values()]
+
+
+def write_csv(path, headers, rows):
+    with path.open("w", newline="") as f:
+        writer = csv.DictWriter(f, headers)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def event(patient_id, code, date=None, value=None, system="ctv3"):
+    return dict(
+        PatientId=patient_id,
+        EventCode=code,
+        System=system,
+        Date=date,
+        ResultValue=value,
+    )
+
+
+def test_null_sort_values(in_memory):
+    events = [
+        event(patient_id, code, date) for patient_id, code, date in NULL_SORT_EVENTS
+    ]
+    results = in_memory(NullSortCohort, events=events)
+    assert results == NULL_SORT_EXPECTED
+
+
+def test_first_and_last_row_per_patient(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        first_code = table("clinical_events").earliest().get("code")
+        last_date = table("clinical_events").latest().get("date")
+
+    events = [
+        event(1, "Code1", "2021-01-03"),
+        event(1, "Code2", "2021-05-02"),
+        event(1, "Code3", "2021-02-01"),
+        event(2, "Code4", "2021-06-05"),
+        event(2, "Code5", "2021-02-04"),
+    ]
+    assert in_memory(Cohort, events=events) == [
+        dict(patient_id=1, first_code="Code1", last_date=date(2021, 5, 2)),
+        dict(patient_id=2, first_code="Code5", last_date=date(2021, 6, 5)),
+    ]
+
+
+def test_filters_and_aggregates(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        _events = (
+            table("clinical_events")
+            .filter("code", is_in=make_codelist("Code1"))
+            .filter("date", between=["2021-01-01", "2021-12-31"])
+        )
+        has_event = _events.exists()
+        event_count = _events.count()
+        value_sum = _events.sum("result")
+
+    events = [
+        event(1, "Code1", "2021-01-01", 10.5),
+        event(1, "Code1", "2021-12-31", 2.0),
+        # Outside the date range
+        event(1, "Code1", "2022-01-01", 100.0),
+        # Matching code from a different system
+        event(2, "Code1", "2021-06-01", 5.0, system="snomed"),
+        event(3, "Code1", "2021-06-01"),
+    ]
+    assert in_memory(Cohort, events=events) == [
+        dict(patient_id=1, has_event=True, event_count=2, value_sum=12.5),
+        dict(patient_id=2, has_event=None, event_count=None, value_sum=None),
+        dict(patient_id=3, has_event=True, event_count=1, value_sum=None),
+    ]
+
+
+def test_filter_with_nulls_and_not_in(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        high_or_missing = (
+            table("clinical_events")
+            .filter("result", greater_than=15, include_null=True)
+            .count()
+        )
+        not_code1 = (
+            table("clinical_events")
+            .filter("code", not_in=make_codelist("Code1"))
+            .count()
+        )
+
+    events = [
+        event(1, "Code1", value=10),
+        event(1, "Code2", value=20),
+        event(2, "Code1"),
+    ]
+    assert in_memory(Cohort, events=events) == [
+        dict(patient_id=1, high_or_missing=1, not_code1=1),
+        dict(patient_id=2, high_or_missing=1, not_code1=None),
+    ]
+
+
+def test_filter_between_values_from_other_tables(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        _positive_tests = table("positive_tests").filter(result=True)
+        first_pos = _positive_tests.earliest("test_date").get("test_date")
+        last_pos = _positive_tests.latest("test_date").get("test_date")
+        _events = (
+            table("clinical_events")
+            .filter("date", between=[first_pos, last_pos])
+            .filter("date", not_in=table("positive_tests").get("test_date"))
+        )
+        value = _events.latest().get("result")
+
+    positive_tests = [
+        dict(patient_id=1, result="true", test_date="2021-01-01"),
+        dict(patient_id=1, result="false", test_date="2021-02-01"),
+        dict(patient_id=1, result="true", test_date="2021-03-01"),
+    ]
+    events = [
+        event(1, "Code1", "2021-01-15", 1.0),
+        # On a test date
+        event(1, "Code1", "2021-02-01", 2.0),
+        # After the last positive test
+        event(1, "Code1", "2021-04-01", 3.0),
+    ]
+    assert in_memory(Cohort, events=events, positive_tests=positive_tests) == [
+        dict(
+            patient_id=1,
+            first_pos=date(2021, 1, 1),
+            last_pos=date(2021, 3, 1),
+            value=1.0,
+        ),
+    ]
+
+
+def test_categorise(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        _height = table("patients").first_by("patient_id").get("height")
+        _code = table("clinical_events").first_by("patient_id").get("code")
+        height_group = categorise(
+            {
+                "tall_or_code": (_height > 190) | ((_height < 150) & (_code == "abc")),
+                "not_tall": ~(_height > 190),
+            },
+            default="na",
+        )
+
+    patients = [
+        dict(PatientId=1, Height=194),
+        dict(PatientId=2, Height=140.5),
+        dict(PatientId=3, Height=170),
+        dict(PatientId=4, Height=None),
+    ]
+    events = [event(2, "abc")]
+    # Patient 5 is registered but has no other data
+    registrations = [
+        dict(PatientId=patient_id, StartDate="2000-01-01") for patient_id in range(1, 6)
+    ]
+    results = in_memory(
+        Cohort,
+        patients=patients,
+        events=events,
+        practice_registrations=registrations,
+    )
+    assert results == [
+        dict(patient_id=1, height_group="tall_or_code"),
+        dict(patient_id=2, height_group="tall_or_code"),
+        dict(patient_id=3, height_group="not_tall"),
+        dict(patient_id=4, height_group="na"),
+        dict(patient_id=5, height_group="na"),
+    ]
+
+
+def test_date_functions(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        _last_event_date = table("clinical_events").latest().get("date")
+        age_in_2010 = table("patients").age_as_of("2010-06-01")
+        age_at_last_event = table("patients").age_as_of(_last_event_date)
+
+    patients = [
+        dict(PatientId=1, DateOfBirth="1990-08-10"),
+        dict(PatientId=2, DateOfBirth="2000-03-20"),
+    ]
+    events = [event(1, "abc", "2020-10-01"), event(2, "abc", "2018-02-01")]
+    assert in_memory(Cohort, patients=patients, events=events) == [
+        dict(patient_id=1, age_in_2010=19, age_at_last_event=30),
+        dict(patient_id=2, age_in_2010=10, age_at_last_event=17),
+    ]
+
+
+def test_date_in_range_with_far_future_end_dates(in_memory):
+    class Cohort:
+        _registrations = table("practice_registrations").date_in_range("2021-03-02")
+        population = _registrations.exists()
+        stp = _registrations.first_by("date_start").get("stp")
+
+    registrations = [
+        dict(PatientId=1, StpId="STP1", StartDate="2021-01-02", EndDate="9999-12-31"),
+        dict(PatientId=2, StpId="STP2", StartDate="2021-03-03", EndDate="9999-12-31"),
+        dict(PatientId=3, StpId="STP3", StartDate="2021-01-01", EndDate=None),
+    ]
+    assert in_memory(Cohort, practice_registrations=registrations) == [
+        dict(patient_id=1, stp="STP1"),
+        dict(patient_id=3, stp="STP3"),
+    ]
+
+
+def test_parameterised_index_date(tmp_path):
+    index_date = Parameter("index_date")
+
+    class Cohort(OldCohortWithPopulation):
+        event_count = (
+            table("clinical_events").filter("date", on_or_before=index_date).count()
+        )
+        age = table("patients").age_as_of(index_date)
+
+    write_csv(
+        tmp_path / "patients.csv",
+        get_file_columns("patients"),
+        [dict(PatientId=1, DateOfBirth="1990-08-10")],
+    )
+    write_csv(
+        tmp_path / "events.csv",
+        get_file_columns("events"),
+        [event(1, "abc", "2020-10-01"), event(1, "abc", "2021-02-01")],
+    )
+    write_csv(
+        tmp_path / "practice_registrations.csv",
+        get_file_columns("practice_registrations"),
+        [dict(PatientId=1, StartDate="2000-01-01")],
+    )
+    backend = InMemoryBackend(str(tmp_path))
+    index_dates = ["2021-01-01", "2021-08-10"]
+    results = extract_for_index_dates(Cohort, backend, index_dates)
+    assert [(index_date, list(rows)) for index_date, rows in results] == [
+        ("2021-01-01", [dict(patient_id=1, event_count=1, age=30)]),
+        ("2021-08-10", [dict(patient_id=1, event_count=2, age=31)]),
+    ]
+    assert list(extract_all_index_dates(Cohort, backend, index_dates)) == [
+        dict(patient_id=1, index_date="2021-01-01", event_count=1, age=30),
+        dict(patient_id=1, index_date="2021-08-10", event_count=2, age=31),
+    ]
+
+
+def test_sampling(tmp_path):
+    class Cohort(OldCohortWithPopulation):
+        code = table("clinical_events").first_by("patient_id").get("code")
+
+    write_csv(
+        tmp_path / "practice_registrations.csv",
+        get_file_columns("practice_registrations"),
+        [
+            dict(PatientId=patient_id, StartDate="2000-01-01")
+            for patient_id in range(1, 11)
+        ],
+    )
+    write_csv(
+        tmp_path / "events.csv",
+        get_file_columns("events"),
+        [event(patient_id, "abc") for patient_id in range(1, 11)],
+    )
+    backend = InMemoryBackend(str(tmp_path))
+    # Each of these patient_ids hashes to a value in the lowest 30%, see
+    # `BaseQueryEngine.get_sample_threshold()`
+    assert list(extract(Cohort, backend, sample_percent=30)) == [
+        dict(patient_id=patient_id, code="abc") for patient_id in [2, 5, 10]
+    ]
+
+
+def test_resumable_extraction(tmp_path, monkeypatch):
+    class Cohort(OldCohortWithPopulation):
+        code = table("clinical_events").first_by("patient_id").get("code")
+
+    write_csv(
+        tmp_path / "practice_registrations.csv",
+        get_file_columns("practice_registrations"),
+        [
+            dict(PatientId=patient_id, StartDate="2000-01-01")
+            for patient_id in range(1, 11)
+        ],
+    )
+    write_csv(
+        tmp_path / "events.csv",
+        get_file_columns("events"),
+        # Multi-byte characters make sure that the checkpointed offsets count bytes
+        [event(patient_id, f"cøde{patient_id}") for patient_id in range(1, 11)],
+    )
+    backend = InMemoryBackend(str(tmp_path))
+    output_file = tmp_path / "output.csv"
+    monkeypatch.setattr(main, "CHECKPOINT_INTERVAL", 3)
+
+    resume_keys = []
+
+    # Fail after writing 7 rows, by which point we've checkpointed after patient 6
+    def interrupted_extract(*args, **kwargs):
+        resume_keys.append(kwargs["resume_key"])
+        for n, row in enumerate(extract(*args, **kwargs)):
+            if n == 7:
+                raise RuntimeError("Connection lost")
+            yield row
+
+    monkeypatch.setattr(main, "extract", interrupted_extract)
+    with pytest.raises(RuntimeError):
+        write_output_resumably(Cohort, backend, output_file)
+    assert get_checkpoint_path(output_file).exists()
+
+    resumed_from = []
+
+    def resumed_extract(*args, resume_after=None, **kwargs):
+        resumed_from.append(resume_after)
+        resume_keys.append(kwargs["resume_key"])
+        return extract(*args, resume_after=resume_after, **kwargs)
+
+    monkeypatch.setattr(main, "extract", resumed_extract)
+    write_output_resumably(Cohort, backend, output_file)
+    assert resumed_from == [6]
+    # The second attempt is recognisably the same extraction as the first
+    assert resume_keys[0] is not None
+    assert resume_keys[1] == resume_keys[0]
+    assert not get_checkpoint_path(output_file).exists()
+    with output_file.open(newline="", encoding="utf-8") as f:
+        assert list(csv.DictReader(f)) == [
+            dict(patient_id=str(patient_id), code=f"cøde{patient_id}")
+            for patient_id in range(1, 11)
+        ]
+
+
+def test_missing_table_file(in_memory):
+    class Cohort(OldCohortWithPopulation):
+        code = table("clinical_events").first_by("patient_id").get("code")
+
+    with pytest.raises(FileNotFoundError, match="No file found for table 'events'"):
+        in_memory(Cohort, patients=[dict(PatientId=1)])
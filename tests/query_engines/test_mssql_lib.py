@@ -1,11 +1,17 @@
+from datetime import datetime, timedelta
 from unittest import mock
 
 import pytest
 import sqlalchemy
 
 from databuilder.query_engines.mssql_lib import (
+    BatchSizer,
     ReconnectableConnection,
     fetch_results_in_batches,
+    fetch_table_in_batches,
+    fetch_table_in_parallel,
+    get_cache_entries_to_evict,
+    prefetch_in_background,
 )
 
 
@@ -81,6 +87,186 @@ def test_fetch_results_in_batches_with_reconnect_and_retry(database):
             assert execute.call_count == 5
 
 
+@pytest.mark.integration
+def test_fetch_results_in_batches_with_several_download_connections(
+    database, temp_tables
+):
+    table = sqlalchemy.table("test_table")
+    test_data = _make_test_data(rows=50)
+
+    engine = database.engine()
+    with engine.connect() as conn:
+        _populate_table(conn, table, test_data)
+
+    query = sqlalchemy.select("*").select_from(table)
+    with fetch_results_in_batches(
+        engine,
+        [query],
+        # Other connections can't see session-scoped temporary tables
+        temp_table_prefix=temp_tables.prefix,
+        batch_size=5,
+        max_retries=0,
+        reconnect_on_error=True,
+        download_connections=3,
+    ) as results:
+        assert _as_dicts(results) == test_data
+
+
+def test_fetch_table_in_parallel(tmp_path):
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        future=True,
+        connect_args={"check_same_thread": False},
+    )
+    table = sqlalchemy.table("test_table")
+    # Leave gaps in the keys so that some slices are empty
+    test_data = [
+        row for row in _make_test_data(rows=100) if not 20 < row["patient_id"] < 60
+    ]
+    with engine.connect() as conn:
+        _populate_table(conn, table, test_data)
+
+    results = fetch_table_in_parallel(
+        engine,
+        table,
+        "patient_id",
+        connections=3,
+        batch_size=4,
+        batches_per_slice=2,
+        max_retries=0,
+        reconnect_on_error=True,
+    )
+    assert _as_dicts(results) == test_data
+
+
+def test_fetch_table_in_parallel_from_start_key(tmp_path):
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        future=True,
+        connect_args={"check_same_thread": False},
+    )
+    table = sqlalchemy.table("test_table")
+    test_data = _make_test_data(rows=50)
+    with engine.connect() as conn:
+        _populate_table(conn, table, test_data)
+
+    results = fetch_table_in_parallel(
+        engine,
+        table,
+        "patient_id",
+        connections=2,
+        batch_size=4,
+        start_key=30,
+        reconnect_on_error=True,
+    )
+    assert _as_dicts(results) == test_data[30:]
+
+
+def test_fetch_table_in_parallel_with_empty_table(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    table = sqlalchemy.table("test_table")
+    with engine.connect() as conn:
+        _populate_table(conn, table, _make_test_data(rows=1))
+        conn.execute(sqlalchemy.text("DELETE FROM test_table"))
+        conn.commit()
+
+    results = fetch_table_in_parallel(
+        engine, table, "patient_id", connections=2, reconnect_on_error=True
+    )
+    assert list(results) == []
+
+
+def test_fetch_table_in_batches_with_prefetch_and_adaptive_batch_size(tmp_path):
+    engine = sqlalchemy.create_engine(
+        f"sqlite:///{tmp_path / 'test.db'}",
+        future=True,
+        connect_args={"check_same_thread": False},
+    )
+    table = sqlalchemy.table("test_table")
+    test_data = _make_test_data(rows=100)
+    with engine.connect() as conn:
+        _populate_table(conn, table, test_data)
+        results = fetch_table_in_batches(
+            conn,
+            table,
+            "patient_id",
+            batch_size=4,
+            min_batch_size=2,
+            max_batch_size=16,
+            prefetch=True,
+        )
+        assert _as_dicts(results) == test_data
+
+
+def test_batch_sizer_climbs_while_throughput_improves():
+    sizer = BatchSizer(100, minimum=50, maximum=300)
+    sizer.record_success(rows=100, seconds=1.0)
+    assert sizer.size == 150
+    sizer.record_success(rows=150, seconds=1.0)
+    assert sizer.size == 225
+    # Capped at the maximum
+    sizer.record_success(rows=225, seconds=1.0)
+    assert sizer.size == 300
+    # Throughput fell, so turn back
+    sizer.record_success(rows=300, seconds=2.0)
+    assert sizer.size == 200
+    # A short final batch tells us nothing
+    sizer.record_success(rows=10, seconds=1.0)
+    assert sizer.size == 200
+    # Errors halve the size, down to the minimum
+    sizer.record_error()
+    assert sizer.size == 100
+    sizer.record_error()
+    assert sizer.size == 50
+
+
+def test_batch_sizer_without_bounds_is_fixed():
+    sizer = BatchSizer(100)
+    sizer.record_success(rows=100, seconds=1.0)
+    sizer.record_error()
+    assert sizer.size == 100
+
+
+def test_prefetch_in_background_forwards_errors():
+    def generate():
+        yield 1
+        raise ValueError("boom")
+
+    results = prefetch_in_background(generate())
+    assert next(results) == 1
+    with pytest.raises(ValueError, match="boom"):
+        next(results)
+
+
+def test_prefetch_in_background_forwards_base_exceptions():
+    def generate():
+        yield 1
+        raise KeyboardInterrupt()
+
+    results = prefetch_in_background(generate())
+    assert next(results) == 1
+    with pytest.raises(KeyboardInterrupt):
+        next(results)
+
+
+def test_prefetch_in_background_stops_when_closed():
+    closed = []
+
+    def generate():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.append(True)
+
+    results = prefetch_in_background(generate())
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    results.close()
+    assert closed == [True]
+
+
 @pytest.mark.integration
 def test_fetch_results_in_batches_caches_results(database, temp_tables):
     table = sqlalchemy.table("test_table")
@@ -220,3 +406,53 @@ class TempTables:
             for table in tables:
                 conn.execute(sqlalchemy.text(f"DROP TABLE {self.database}..{table}"))
             conn.commit()
+
+
+def test_get_cache_entries_to_evict():
+    now = datetime(2022, 6, 1, 12, 0)
+    rows = [
+        ("stale", now - timedelta(days=10), now - timedelta(days=10)),
+        ("old", now - timedelta(days=3), now - timedelta(days=3)),
+        ("older", now - timedelta(days=4), now - timedelta(days=4)),
+        ("recent", now - timedelta(days=2), now - timedelta(hours=1)),
+        ("very_recent", now - timedelta(minutes=5), now - timedelta(minutes=5)),
+    ]
+    evicted = get_cache_entries_to_evict(
+        rows,
+        now,
+        max_tables=2,
+        max_age=timedelta(days=7),
+        min_age=timedelta(days=1),
+    )
+    # "stale" has expired, and "old" and "older" are beyond the two most recently used
+    # tables. Recently used tables are kept, even if that takes us over the limit.
+    assert sorted(evicted) == ["old", "older", "stale"]
+    evicted = get_cache_entries_to_evict(
+        rows,
+        now,
+        max_tables=1,
+        max_age=timedelta(days=7),
+        min_age=timedelta(days=1),
+    )
+    assert sorted(evicted) == ["old", "older", "stale"]
+    evicted = get_cache_entries_to_evict(
+        rows,
+        now,
+        max_tables=10,
+        max_age=timedelta(days=7),
+        min_age=timedelta(days=1),
+    )
+    assert evicted == ["stale"]
+
+
+def test_get_cache_entries_to_evict_expires_tables_which_are_still_in_use():
+    now = datetime(2022, 6, 1, 12, 0)
+    rows = [("popular", now - timedelta(days=8), now - timedelta(hours=1))]
+    evicted = get_cache_entries_to_evict(
+        rows,
+        now,
+        max_tables=10,
+        max_age=timedelta(days=7),
+        min_age=timedelta(days=1),
+    )
+    assert evicted == ["popular"]
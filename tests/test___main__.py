@@ -26,6 +26,53 @@ def test_generate_cohort_with_database_url(mocker, monkeypatch, tmp_path):
     patched.assert_called_once()
 
 
+@pytest.mark.parametrize(
+    "args,kwarg,expected",
+    [
+        (["--population-first"], "population_first", True),
+        (["--vectorise-index-dates"], "vectorise_index_dates", True),
+        (["--jobs", "4"], "jobs", 4),
+        (["--setup-connections", "8"], "setup_connections", 8),
+        (["--shared-cache"], "shared_cache", True),
+        (["--incremental"], "incremental", True),
+        (["--resumable"], "resumable", True),
+        (["--sample-percent", "2.5"], "sample_percent", 2.5),
+        (["--shards", "16"], "shards", 16),
+        (["--download-connections", "4"], "download_connections", 4),
+    ],
+)
+def test_generate_cohort_with_option(
+    mocker, monkeypatch, tmp_path, args, kwarg, expected
+):
+    patched = mocker.patch("databuilder.__main__.run_cohort_action")
+    monkeypatch.setenv("DATABASE_URL", "scheme:path")
+    cohort_definition_path = tmp_path / "cohort.py"
+    cohort_definition_path.touch()
+    argv = [
+        "generate_cohort",
+        "--cohort-definition",
+        str(cohort_definition_path),
+        *args,
+    ]
+    main(argv)
+    assert patched.call_args.kwargs[kwarg] == expected
+
+
+@pytest.mark.parametrize("value", ["0", "101", "some"])
+def test_generate_cohort_with_invalid_sample(value, tmp_path):
+    cohort_definition_path = tmp_path / "cohort.py"
+    cohort_definition_path.touch()
+    argv = [
+        "generate_cohort",
+        "--cohort-definition",
+        str(cohort_definition_path),
+        "--sample-percent",
+        value,
+    ]
+    with pytest.raises(SystemExit):
+        main(argv)
+
+
 def test_generate_cohort_with_dummy_data(mocker, tmp_path):
     # Verify that the generate_cohort subcommand can be invoked when --dummy-data-file
     # is provided.
@@ -12,7 +12,13 @@ from .lib.mock_backend import (
     patient,
     positive_test,
 )
-from .lib.util import OldCohortWithPopulation, make_codelist
+from .lib.util import (
+    NULL_SORT_EVENTS,
+    NULL_SORT_EXPECTED,
+    NullSortCohort,
+    OldCohortWithPopulation,
+    make_codelist,
+)
 
 # Mark the whole module as containing integration tests
 pytestmark = pytest.mark.integration
@@ -150,6 +156,14 @@ def test_run_generated_sql_get_single_row_per_patient(
     assert engine.extract(Cohort) == expected
 
 
+def test_null_sort_values(engine):
+    engine.setup(
+        patient(1, *[ctv3_event(code, date) for _, code, date in NULL_SORT_EVENTS[:3]]),
+        patient(2, *[ctv3_event(code, date) for _, code, date in NULL_SORT_EVENTS[3:]]),
+    )
+    assert engine.extract(NullSortCohort) == NULL_SORT_EXPECTED
+
+
 @pytest.mark.parametrize(
     "data,filtered_table,expected",
     [
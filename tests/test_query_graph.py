@@ -0,0 +1,134 @@
+from databuilder.query_graph import (
+    QueryGraph,
+    get_parameter_dependent_nodes,
+    get_structural_hashes,
+)
+from databuilder.query_model import (
+    DateDifference,
+    FilteredTable,
+    Parameter,
+    Row,
+    Table,
+    ValueFromRow,
+    table,
+)
+from databuilder.query_utils import get_column_definitions
+
+from .lib.util import OldCohortWithPopulation, make_codelist
+
+
+def test_nodes_are_in_topological_order():
+    events = table("clinical_events")
+    first_date = events.earliest().get("date")
+    later_events = events.filter("date", greater_than=first_date)
+    graph = QueryGraph(
+        dict(
+            population=table("practice_registrations").exists(),
+            count=later_events.count(),
+            age=table("patients").age_as_of(first_date),
+        )
+    )
+    positions = {id(node): i for i, node in enumerate(graph)}
+    for node in graph:
+        for child in node._get_referenced_nodes():
+            assert positions[id(child)] < positions[id(node)]
+
+
+def test_heavily_shared_graph_is_walked_once():
+    # Each level references the previous level twice, so there are 2**50 distinct paths
+    # from the root to the leaf
+    value = table("patients").first_by("patient_id").get("height")
+    condition = value > 0
+    for _ in range(50):
+        condition = condition & condition
+    graph = QueryGraph(dict(population=condition))
+    # 50 levels, plus the initial comparator, ValueFromRow, Row and Table
+    assert len(graph) == 54
+
+
+def test_adjacency():
+    events = table("clinical_events")
+    row = events.earliest()
+    code = row.get("code")
+    date = row.get("date")
+    graph = QueryGraph(dict(code=code, date=date))
+    assert graph.get_children(code) == [row]
+    assert graph.get_parents(events) == [row]
+    assert set(map(id, graph.get_parents(row))) == {id(code), id(date)}
+
+
+def test_rewrite_rebuilds_only_the_ancestors_of_replaced_nodes():
+    events = table("clinical_events")
+    row = events.earliest()
+    date = row.get("date")
+    age = DateDifference(table("patients").first_by("patient_id").get("dob"), date)
+    other = table("patients").first_by("patient_id").get("sex")
+    graph = QueryGraph(dict(age=age, other=other))
+
+    new_row = events.filter("code", equals="abc").earliest()
+    new_graph = graph.rewrite({row: new_row})
+
+    new_age = new_graph.column_definitions["age"]
+    assert isinstance(new_age, DateDifference)
+    assert new_age is not age
+    assert new_age.arguments[0] is age.arguments[0]
+    assert new_age.arguments[1] is new_row.get("date")
+    assert new_age.arguments[2] == "years"
+    # Untouched parts of the graph are shared
+    assert new_graph.column_definitions["other"] is other
+    # And the original graph is unchanged
+    assert graph.column_definitions["age"] is age
+    assert date.source is row
+
+
+def test_rewritten_nodes_are_interned():
+    events = table("clinical_events")
+    graph = QueryGraph(dict(date=events.earliest().get("date")))
+    filtered = events.filter("code", equals="abc")
+    new_graph = graph.rewrite({events: filtered})
+    assert new_graph.column_definitions["date"] is ValueFromRow(
+        Row(
+            FilteredTable(Table("clinical_events"), "code", "__eq__", "abc"),
+            ("date",),
+            False,
+        ),
+        "date",
+    )
+
+
+def test_parameter_dependent_nodes():
+    index_date = Parameter("index_date")
+    events = table("clinical_events")
+    recent_events = events.filter("date", on_or_after=index_date)
+    first_date = events.earliest().get("date")
+    recent_count = recent_events.count()
+    graph = QueryGraph(dict(first_date=first_date, recent_count=recent_count))
+    dependent = get_parameter_dependent_nodes(graph)
+    assert {index_date, recent_events, recent_count} <= dependent
+    assert not dependent & {events, first_date, first_date.source}
+
+
+def test_structural_hashes():
+    def get_hashes(code, threshold):
+        class Cohort(OldCohortWithPopulation):
+            _events = table("clinical_events").filter("code", is_in=make_codelist(code))
+            event_count = _events.count()
+            has_large_value = _events.filter(
+                "numeric_value", greater_than=threshold
+            ).exists()
+
+        return get_structural_hashes(QueryGraph(get_column_definitions(Cohort)))
+
+    hashes = get_hashes("abc", 10)
+    assert hashes == get_hashes("abc", 10)
+    # Changing one column's definition only changes its own hash
+    changed = get_hashes("abc", 20)
+    assert changed["population"] == hashes["population"]
+    assert changed["event_count"] == hashes["event_count"]
+    assert changed["has_large_value"] != hashes["has_large_value"]
+    # Values which compare equal but have different types are kept distinct
+    assert get_hashes("abc", 10.0)["has_large_value"] != hashes["has_large_value"]
+    # While changing something they share changes them both
+    changed = get_hashes("def", 10)
+    assert changed["event_count"] != hashes["event_count"]
+    assert changed["has_large_value"] != hashes["has_large_value"]
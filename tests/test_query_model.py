@@ -1,4 +1,5 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -73,6 +74,40 @@ def test_comparator_ne():
     assert repr(output) == repr(expected)
 
 
+def test_structurally_identical_nodes_are_the_same_instance():
+    events = table("clinical_events").filter("code", is_in=make_codelist("abc"))
+    value_1 = events.latest().get("date")
+    value_2 = table("clinical_events").filter("code", is_in=make_codelist("abc"))
+    value_2 = value_2.latest().get("date")
+    assert value_1 is value_2
+    assert table("patients").age_as_of("2020-01-01") is table("patients").age_as_of(
+        "2020-01-01"
+    )
+
+
+def test_nodes_built_in_several_threads_are_the_same_instance():
+    def build(_):
+        return table("patients").age_as_of("2020-01-01")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(build, range(200)))
+    assert all(value is values[0] for value in values)
+
+
+@pytest.mark.parametrize(
+    "value_1,value_2",
+    [
+        (1, True),
+        (1, 1.0),
+        ("2020-01-01", "2020-01-02"),
+        ((1, 2), [1, 2]),
+    ],
+)
+def test_structurally_different_nodes_are_different_instances(value_1, value_2):
+    events = table("clinical_events")
+    assert events.filter(value=value_1) is not events.filter(value=value_2)
+
+
 def test_cohort_column_definitions_simple_query():
     class Cohort(OldCohortWithPopulation):
         #  Define tables of interest, filtered to relevant values
@@ -0,0 +1,117 @@
+from datetime import date, datetime
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import pytest
+
+from databuilder import main
+from databuilder.main import write_output
+from databuilder.query_model import categorise, table
+
+from .lib.mock_backend import MockBackend
+from .lib.util import OldCohortWithPopulation
+
+
+class Cohort(OldCohortWithPopulation):
+    _events = table("clinical_events")
+    has_event = _events.exists()
+    event_count = _events.count()
+    first_date = _events.earliest().get("date")
+    value_sum = _events.sum("result")
+    value_group = categorise({"high": _events.latest().get("result") > 5})
+
+
+def read_columnar_output(output_file):
+    if output_file.suffix == ".parquet":
+        return pyarrow.parquet.read_table(output_file)
+    return pyarrow.ipc.open_file(output_file).read_all()
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".arrow", ".feather"])
+def test_columnar_output(tmp_path, monkeypatch, extension):
+    # Values as different databases might give them to us, which need coercing to
+    # the type of their column
+    results = [
+        dict(
+            patient_id=1,
+            has_event=1,
+            event_count=2,
+            first_date=datetime(2021, 1, 3),
+            value_sum=12.5,
+            value_group=None,
+        ),
+        dict(
+            patient_id=2,
+            has_event=True,
+            event_count=1,
+            first_date="2021-02-01",
+            value_sum=6,
+            value_group="high",
+        ),
+        dict(
+            patient_id=3,
+            has_event=None,
+            event_count=None,
+            first_date=None,
+            value_sum=None,
+            value_group=None,
+        ),
+    ]
+    output_file = tmp_path / f"output{extension}"
+    # Make sure we write more than one batch
+    monkeypatch.setattr(main, "COLUMNAR_BATCH_SIZE", 2)
+    write_output(iter(results), output_file, Cohort, MockBackend(None))
+
+    output = read_columnar_output(output_file)
+    assert output.schema == pyarrow.schema(
+        [
+            ("patient_id", pyarrow.int64()),
+            ("has_event", pyarrow.bool_()),
+            ("event_count", pyarrow.int64()),
+            ("first_date", pyarrow.date32()),
+            ("value_sum", pyarrow.float64()),
+            ("value_group", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ]
+    )
+    assert output.to_pylist() == [
+        dict(
+            patient_id=1,
+            has_event=True,
+            event_count=2,
+            first_date=date(2021, 1, 3),
+            value_sum=12.5,
+            value_group=None,
+        ),
+        dict(
+            patient_id=2,
+            has_event=True,
+            event_count=1,
+            first_date=date(2021, 2, 1),
+            value_sum=6.0,
+            value_group="high",
+        ),
+        dict(
+            patient_id=3,
+            has_event=None,
+            event_count=None,
+            first_date=None,
+            value_sum=None,
+            value_group=None,
+        ),
+    ]
+
+
+def test_columnar_output_without_results(tmp_path):
+    output_file = tmp_path / "output.parquet"
+    write_output(iter([]), output_file, Cohort, MockBackend(None))
+    output = read_columnar_output(output_file)
+    assert output.num_rows == 0
+    assert output.schema.names == [
+        "patient_id",
+        "has_event",
+        "event_count",
+        "first_date",
+        "value_sum",
+        "value_group",
+    ]